@@ -1,448 +1,4076 @@
-"""
-Interval Training MP3 Generator
-Created by Colin
-
-This program creates custom workout MP3s that alternate between intense and moderate music
-based on popular interval training methods. Inspired by Resident Evil's dynamic music system!
-
-Required packages (install these first):
-    pip install pydub
-    pip install gTTS
-    
-You'll also need ffmpeg installed on your system for pydub to work:
-    - Windows: Download from https://ffmpeg.org/ or use: pip install ffmpeg-python
-    - Mac: brew install ffmpeg
-    - Linux: sudo apt-get install ffmpeg
-"""
-
-import tkinter as tk
-from tkinter import filedialog, messagebox, ttk
-from pydub import AudioSegment
-from gtts import gTTS
-import os
-import tempfile
-
-# Define the workout methods with their intervals (in seconds)
-WORKOUT_METHODS = {
-    "Tabata": {"work": 20, "recovery": 10, "default_rounds": 8},
-    "Gibala": {"work": 60, "recovery": 75, "default_rounds": 10},
-    "Zuniga": {"work": 30, "recovery": 30, "default_rounds": 10},
-    "General": {"work": 30, "recovery": 15, "default_rounds": 10},
-    "Custom": {"work": 30, "recovery": 30, "default_rounds": 10}  # Default values for custom
-}
-
-
-class IntervalTrainingApp:
-    def __init__(self, root):
-        self.root = root
-        self.root.title("Interval Training MP3 Generator")
-        self.root.geometry("600x700")
-        
-        # Variables to store user choices
-        self.intense_mp3_path = tk.StringVar()
-        self.moderate_mp3_path = tk.StringVar()
-        self.selected_method = tk.StringVar(value="Tabata")
-        self.num_rounds = tk.IntVar(value=8)
-        self.warmup_time = tk.IntVar(value=180)  # 3 minutes in seconds
-        self.cooldown_time = tk.IntVar(value=180)  # 3 minutes in seconds
-        self.cycle_through = tk.BooleanVar(value=False)
-        self.workout_length = tk.StringVar(value="4:00")
-        self.custom_work = tk.IntVar(value=30)  # Custom work interval
-        self.custom_recovery = tk.IntVar(value=30)  # Custom recovery interval
-        
-        self.create_widgets()
-        self.update_workout_length()  # Calculate initial workout length
-        
-    def create_widgets(self):
-        # Title
-        title_label = tk.Label(self.root, text="Interval Training MP3 Generator", 
-                              font=("Arial", 16, "bold"))
-        title_label.pack(pady=10)
-        
-        # Frame for MP3 file selections
-        file_frame = tk.LabelFrame(self.root, text="Select Music Files", padx=10, pady=10)
-        file_frame.pack(padx=10, pady=10, fill="x")
-        
-        # Intense MP3 selection
-        tk.Label(file_frame, text="Intense Music MP3:").grid(row=0, column=0, sticky="w", pady=5)
-        tk.Entry(file_frame, textvariable=self.intense_mp3_path, width=40).grid(row=0, column=1, padx=5)
-        tk.Button(file_frame, text="Browse", command=self.browse_intense_mp3).grid(row=0, column=2)
-        
-        # Moderate MP3 selection
-        tk.Label(file_frame, text="Moderate Music MP3:").grid(row=1, column=0, sticky="w", pady=5)
-        tk.Entry(file_frame, textvariable=self.moderate_mp3_path, width=40).grid(row=1, column=1, padx=5)
-        tk.Button(file_frame, text="Browse", command=self.browse_moderate_mp3).grid(row=1, column=2)
-        
-        # Frame for workout settings
-        settings_frame = tk.LabelFrame(self.root, text="Workout Settings", padx=10, pady=10)
-        settings_frame.pack(padx=10, pady=10, fill="x")
-        
-        # Method selection
-        tk.Label(settings_frame, text="Workout Method:").grid(row=0, column=0, sticky="w", pady=5)
-        method_dropdown = ttk.Combobox(settings_frame, textvariable=self.selected_method, 
-                                       values=list(WORKOUT_METHODS.keys()), state="readonly", width=15)
-        method_dropdown.grid(row=0, column=1, sticky="w", padx=5)
-        method_dropdown.bind("<<ComboboxSelected>>", lambda e: self.on_method_change())
-        
-        # Custom interval inputs (only visible when Custom is selected)
-        self.custom_frame = tk.Frame(settings_frame)
-        self.custom_frame.grid(row=1, column=0, columnspan=3, sticky="w", pady=5)
-        
-        tk.Label(self.custom_frame, text="  Work interval (seconds):").grid(row=0, column=0, sticky="w", padx=(20,5))
-        self.custom_work_spinbox = tk.Spinbox(self.custom_frame, from_=1, to=300, 
-                                              textvariable=self.custom_work, width=10,
-                                              command=self.update_workout_length)
-        self.custom_work_spinbox.grid(row=0, column=1, sticky="w")
-        # Update when user types (not just when using arrows)
-        self.custom_work.trace_add('write', lambda *args: self.update_workout_length())
-        
-        tk.Label(self.custom_frame, text="  Recovery interval (seconds):").grid(row=1, column=0, sticky="w", padx=(20,5))
-        self.custom_recovery_spinbox = tk.Spinbox(self.custom_frame, from_=1, to=300, 
-                                                  textvariable=self.custom_recovery, width=10,
-                                                  command=self.update_workout_length)
-        self.custom_recovery_spinbox.grid(row=1, column=1, sticky="w")
-        # Update when user types (not just when using arrows)
-        self.custom_recovery.trace_add('write', lambda *args: self.update_workout_length())
-        
-        # Hide custom inputs by default
-        self.custom_frame.grid_remove()
-        
-        # Number of rounds
-        tk.Label(settings_frame, text="Number of Rounds:").grid(row=2, column=0, sticky="w", pady=5)
-        rounds_spinbox = tk.Spinbox(settings_frame, from_=1, to=100, textvariable=self.num_rounds, 
-                                    width=10, command=self.update_workout_length)
-        rounds_spinbox.grid(row=2, column=1, sticky="w", padx=5)
-        # Update when user types (not just when using arrows)
-        self.num_rounds.trace_add('write', lambda *args: self.update_workout_length())
-        
-        # Workout length display (calculated automatically)
-        tk.Label(settings_frame, text="Workout Length:").grid(row=3, column=0, sticky="w", pady=5)
-        tk.Label(settings_frame, textvariable=self.workout_length, font=("Arial", 10, "bold")).grid(
-            row=3, column=1, sticky="w", padx=5)
-        
-        # Warm-up time
-        tk.Label(settings_frame, text="Warm-up Time (seconds):").grid(row=4, column=0, sticky="w", pady=5)
-        tk.Spinbox(settings_frame, from_=0, to=600, textvariable=self.warmup_time, 
-                  width=10).grid(row=4, column=1, sticky="w", padx=5)
-        
-        # Cool-down time
-        tk.Label(settings_frame, text="Cool-down Time (seconds):").grid(row=5, column=0, sticky="w", pady=5)
-        tk.Spinbox(settings_frame, from_=0, to=600, textvariable=self.cooldown_time, 
-                  width=10).grid(row=5, column=1, sticky="w", padx=5)
-        
-        # Cycle through option
-        tk.Checkbutton(settings_frame, text="Cycle through music (instead of repeating from start)", 
-                      variable=self.cycle_through).grid(row=6, column=0, columnspan=2, sticky="w", pady=10)
-        
-        # Info box explaining the methods
-        info_frame = tk.LabelFrame(self.root, text="Method Information", padx=10, pady=10)
-        info_frame.pack(padx=10, pady=10, fill="both", expand=True)
-        
-        info_text = tk.Text(info_frame, height=8, wrap=tk.WORD)
-        info_text.pack(fill="both", expand=True)
-        info_text.insert("1.0", 
-            "Tabata: 20s work / 10s recovery (high intensity, short bursts)\n"
-            "Gibala: 60s work / 75s recovery (moderate volume for regular folks)\n"
-            "Zuniga: 30s work / 30s recovery (balanced work-rest ratio)\n"
-            "General: 30s work / 15s recovery (2:1 work-to-rest ratio)\n"
-            "Custom: Set your own work and recovery intervals\n\n"
-            "The program will create an MP3 with:\n"
-            "• Safety disclaimer at the start\n"
-            "• Warm-up section with your moderate music\n"
-            "• Alternating intense/moderate intervals\n"
-            "• Cool-down section with your moderate music")
-        info_text.config(state="disabled")
-        
-        # Generate button
-        generate_btn = tk.Button(self.root, text="Generate Workout MP3", 
-                                command=self.generate_mp3, bg="#4CAF50", fg="white", 
-                                font=("Arial", 12, "bold"), pady=10)
-        generate_btn.pack(padx=10, pady=20, fill="x")
-        
-    def browse_intense_mp3(self):
-        """Opens a file browser to select the intense music MP3"""
-        filename = filedialog.askopenfilename(
-            title="Select Intense Music MP3",
-            filetypes=[("MP3 files", "*.mp3"), ("All files", "*.*")]
-        )
-        if filename:
-            self.intense_mp3_path.set(filename)
-    
-    def browse_moderate_mp3(self):
-        """Opens a file browser to select the moderate music MP3"""
-        filename = filedialog.askopenfilename(
-            title="Select Moderate Music MP3",
-            filetypes=[("MP3 files", "*.mp3"), ("All files", "*.*")]
-        )
-        if filename:
-            self.moderate_mp3_path.set(filename)
-    
-    def on_method_change(self):
-        """When the user changes the method, update the default rounds and workout length"""
-        method = self.selected_method.get()
-        
-        # Show or hide custom interval inputs
-        if method == "Custom":
-            self.custom_frame.grid()
-        else:
-            self.custom_frame.grid_remove()
-        
-        default_rounds = WORKOUT_METHODS[method]["default_rounds"]
-        self.num_rounds.set(default_rounds)
-        self.update_workout_length()
-    
-    def update_workout_length(self):
-        """Calculate and display the total workout time (excluding warm-up/cool-down)"""
-        method = self.selected_method.get()
-        
-        # Get work and recovery times based on method
-        if method == "Custom":
-            try:
-                work_time = self.custom_work.get()
-                recovery_time = self.custom_recovery.get()
-            except:
-                # If the boxes are empty or invalid, use default values
-                work_time = 30
-                recovery_time = 30
-        else:
-            work_time = WORKOUT_METHODS[method]["work"]
-            recovery_time = WORKOUT_METHODS[method]["recovery"]
-        
-        try:
-            rounds = self.num_rounds.get()
-        except:
-            rounds = 1
-        
-        total_seconds = (work_time + recovery_time) * rounds
-        minutes = total_seconds // 60
-        seconds = total_seconds % 60
-        
-        self.workout_length.set(f"{minutes}:{seconds:02d}")
-    
-    def format_time_for_speech(self, time_string):
-        """Converts time format (4:00) into natural speech (4 minutes)"""
-        parts = time_string.split(":")
-        minutes = int(parts[0])
-        seconds = int(parts[1])
-        
-        if seconds == 0:
-            return f"{minutes} minutes"
-        else:
-            return f"{minutes} minutes and {seconds} seconds"
-    
-    def create_tts_audio(self, text, filename):
-        """Creates a text-to-speech audio file from the given text, sped up by 25%"""
-        tts = gTTS(text=text, lang='en', slow=False)
-        tts.save(filename)
-        audio = AudioSegment.from_mp3(filename)
-        # Speed up by 25% (1.25x speed)
-        faster_audio = audio.speedup(playback_speed=1.25)
-        return faster_audio
-    
-    def get_audio_segment(self, audio, start_ms, duration_ms, cycle_mode, cycle_position):
-        """
-        Gets a segment of audio based on the mode:
-        - If cycle_mode is False: always start from the beginning
-        - If cycle_mode is True: continue from where we left off, looping if necessary
-        """
-        audio_duration = len(audio)
-        
-        if not cycle_mode:
-            # Simple mode: always pull from the start
-            if duration_ms <= audio_duration:
-                return audio[:duration_ms]
-            else:
-                # If the audio is shorter than needed, loop it
-                loops_needed = (duration_ms // audio_duration) + 1
-                looped_audio = audio * loops_needed
-                return looped_audio[:duration_ms]
-        else:
-            # Cycle through mode: continue from cycle_position
-            if cycle_position + duration_ms <= audio_duration:
-                # We can get the segment without looping
-                return audio[cycle_position:cycle_position + duration_ms]
-            else:
-                # We need to loop back to the beginning
-                segment = audio[cycle_position:]
-                remaining_duration = duration_ms - len(segment)
-                
-                # Loop the audio until we have enough
-                while remaining_duration > 0:
-                    if remaining_duration <= audio_duration:
-                        segment += audio[:remaining_duration]
-                        remaining_duration = 0
-                    else:
-                        segment += audio
-                        remaining_duration -= audio_duration
-                
-                return segment
-    
-    def generate_mp3(self):
-        """Main function that generates the workout MP3"""
-        
-        # Validate inputs
-        if not self.intense_mp3_path.get() or not self.moderate_mp3_path.get():
-            messagebox.showerror("Error", "Please select both intense and moderate music MP3 files.")
-            return
-        
-        if not os.path.exists(self.intense_mp3_path.get()):
-            messagebox.showerror("Error", "Intense music file not found.")
-            return
-            
-        if not os.path.exists(self.moderate_mp3_path.get()):
-            messagebox.showerror("Error", "Moderate music file not found.")
-            return
-        
-        # Ask where to save the output
-        output_path = filedialog.asksaveasfilename(
-            defaultextension=".mp3",
-            filetypes=[("MP3 files", "*.mp3")],
-            title="Save Workout MP3 As"
-        )
-        
-        if not output_path:
-            return
-        
-        try:
-            # Show progress message
-            progress_window = tk.Toplevel(self.root)
-            progress_window.title("Generating...")
-            progress_window.geometry("300x100")
-            tk.Label(progress_window, text="Generating your workout MP3...\nThis may take a minute.", 
-                    font=("Arial", 10)).pack(pady=20)
-            progress_window.update()
-            
-            # Load the music files
-            intense_music = AudioSegment.from_mp3(self.intense_mp3_path.get())
-            moderate_music = AudioSegment.from_mp3(self.moderate_mp3_path.get())
-            
-            # Get workout parameters
-            method = self.selected_method.get()
-            
-            # Get work and recovery intervals based on method
-            if method == "Custom":
-                work_interval = self.custom_work.get() * 1000  # Convert to milliseconds
-                recovery_interval = self.custom_recovery.get() * 1000
-            else:
-                work_interval = WORKOUT_METHODS[method]["work"] * 1000
-                recovery_interval = WORKOUT_METHODS[method]["recovery"] * 1000
-            
-            rounds = self.num_rounds.get()
-            warmup_duration = self.warmup_time.get() * 1000
-            cooldown_duration = self.cooldown_time.get() * 1000
-            cycle_mode = self.cycle_through.get()
-            
-            # Create temporary directory for TTS files
-            temp_dir = tempfile.mkdtemp()
-            
-            # Create TTS segments
-            disclaimer_text = ("Warning: Consult with a medical professional before starting any new exercise regimen. "
-                             "Do not over-exert yourself. Listen to your body and stop if you feel pain or discomfort.")
-            
-            # Create method-specific announcement
-            if method == "Custom":
-                workout_info_text = (f"You have selected a custom workout. "
-                                   f"{rounds} rounds. "
-                                   f"Work intervals are {self.custom_work.get()} seconds. "
-                                   f"Recovery intervals are {self.custom_recovery.get()} seconds. "
-                                   f"Total workout time: {self.format_time_for_speech(self.workout_length.get())}.")
-            else:
-                workout_info_text = (f"You have selected the {method} regimen. "
-                                   f"{rounds} rounds. "
-                                   f"Work intervals are {WORKOUT_METHODS[method]['work']} seconds. "
-                                   f"Recovery intervals are {WORKOUT_METHODS[method]['recovery']} seconds. "
-                                   f"Total workout time: {self.format_time_for_speech(self.workout_length.get())}.")
-            
-            disclaimer_audio = self.create_tts_audio(disclaimer_text, os.path.join(temp_dir, "disclaimer.mp3"))
-            workout_info_audio = self.create_tts_audio(workout_info_text, os.path.join(temp_dir, "info.mp3"))
-            warmup_start_audio = self.create_tts_audio("Begin warm-up.", os.path.join(temp_dir, "warmup.mp3"))
-            workout_start_audio = self.create_tts_audio("Begin workout.", os.path.join(temp_dir, "workout.mp3"))
-            cooldown_start_audio = self.create_tts_audio("Begin cool-down.", os.path.join(temp_dir, "cooldown.mp3"))
-            workout_complete_audio = self.create_tts_audio("Workout complete. Great job!", os.path.join(temp_dir, "complete.mp3"))
-            
-            # Start building the final audio
-            final_audio = AudioSegment.silent(duration=500)  # Start with half-second of silence
-            
-            # Add disclaimer
-            final_audio += disclaimer_audio
-            final_audio += AudioSegment.silent(duration=1000)
-            
-            # Add workout info
-            final_audio += workout_info_audio
-            final_audio += AudioSegment.silent(duration=1000)
-            
-            # Add warm-up
-            final_audio += warmup_start_audio
-            final_audio += AudioSegment.silent(duration=500)
-            
-            # Add warm-up music (use moderate music)
-            if warmup_duration > 0:
-                warmup_segment = self.get_audio_segment(moderate_music, 0, warmup_duration, False, 0)
-                final_audio += warmup_segment
-                final_audio += AudioSegment.silent(duration=500)
-            
-            # Add workout start announcement
-            final_audio += workout_start_audio
-            final_audio += AudioSegment.silent(duration=500)
-            
-            # Add the workout intervals
-            intense_position = 0  # Track position in intense music if cycling
-            moderate_position = 0  # Track position in moderate music if cycling
-            
-            for round_num in range(rounds):
-                # Work interval (intense music)
-                intense_segment = self.get_audio_segment(intense_music, 0, work_interval, 
-                                                        cycle_mode, intense_position)
-                final_audio += intense_segment
-                
-                if cycle_mode:
-                    intense_position = (intense_position + work_interval) % len(intense_music)
-                
-                # Recovery interval (moderate music)
-                moderate_segment = self.get_audio_segment(moderate_music, 0, recovery_interval, 
-                                                         cycle_mode, moderate_position)
-                final_audio += moderate_segment
-                
-                if cycle_mode:
-                    moderate_position = (moderate_position + recovery_interval) % len(moderate_music)
-            
-            # Add cool-down
-            final_audio += AudioSegment.silent(duration=500)
-            final_audio += cooldown_start_audio
-            final_audio += AudioSegment.silent(duration=500)
-            
-            if cooldown_duration > 0:
-                cooldown_segment = self.get_audio_segment(moderate_music, 0, cooldown_duration, False, 0)
-                final_audio += cooldown_segment
-                final_audio += AudioSegment.silent(duration=500)
-            
-            # Add completion message
-            final_audio += workout_complete_audio
-            final_audio += AudioSegment.silent(duration=500)
-            
-            # Export the final MP3
-            final_audio.export(output_path, format="mp3")
-            
-            # Clean up temporary files
-            for file in os.listdir(temp_dir):
-                os.remove(os.path.join(temp_dir, file))
-            os.rmdir(temp_dir)
-            
-            # Close progress window and show success
-            progress_window.destroy()
-            messagebox.showinfo("Success", f"Workout MP3 generated successfully!\n\nSaved to:\n{output_path}")
-            
-        except Exception as e:
-            if 'progress_window' in locals():
-                progress_window.destroy()
-            messagebox.showerror("Error", f"An error occurred while generating the MP3:\n\n{str(e)}")
-
-
-def main():
-    root = tk.Tk()
-    app = IntervalTrainingApp(root)
-    root.mainloop()
-
-
-if __name__ == "__main__":
+"""
+Interval Training MP3 Generator
+Created by Colin
+
+This program creates custom workout MP3s that alternate between intense and moderate music
+based on popular interval training methods. Inspired by Resident Evil's dynamic music system!
+
+Required packages (install these first):
+    pip install pydub
+    pip install gTTS
+    pip install numpy
+
+For voice announcements without an internet connection, install espeak (or espeak-ng)
+or pip install pyttsx3 and pick it from the Voice dropdown.
+    
+You'll also need ffmpeg installed on your system for pydub to work:
+    - Windows: Download from https://ffmpeg.org/ or use: pip install ffmpeg-python
+    - Mac: brew install ffmpeg
+    - Linux: sudo apt-get install ffmpeg
+
+Run it with no arguments for the GUI, or headless from the command line:
+    python interval-training-mp3-generator.py generate --intense a.mp3 --moderate b.mp3 -o out.mp3
+    python interval-training-mp3-generator.py batch workouts.json
+(add --help to either for all the options)
+"""
+
+try:
+    import tkinter as tk
+    from tkinter import filedialog, messagebox, ttk
+except ImportError:
+    tk = None  # Only the GUI needs tkinter, the command line works without it
+
+try:
+    import resource
+except ImportError:
+    resource = None  # Not on Windows, where the benchmark can't report peak memory
+
+from pydub import AudioSegment
+import numpy as np
+from pydub.exceptions import CouldntDecodeError, CouldntEncodeError
+from collections import deque, namedtuple, OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+import argparse
+import contextlib
+import hashlib
+import json
+import mmap
+import multiprocessing
+import os
+import platform
+import queue
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# Define the workout methods with their intervals (in seconds)
+WORKOUT_METHODS = {
+    "Tabata": {"work": 20, "recovery": 10, "default_rounds": 8},
+    "Gibala": {"work": 60, "recovery": 75, "default_rounds": 10},
+    "Zuniga": {"work": 30, "recovery": 30, "default_rounds": 10},
+    "General": {"work": 30, "recovery": 15, "default_rounds": 10},
+    "Custom": {"work": 30, "recovery": 30, "default_rounds": 10}  # Default values for custom
+}
+
+# Where decoded music (and other generated data) is kept between runs
+CACHE_DIR = os.environ.get("INTERVAL_TRAINING_CACHE_DIR") or os.path.join(
+    os.path.expanduser("~"), ".cache", "interval-training-mp3-generator")
+
+# Decoded PCM is big (about 10MB per minute of stereo audio), so cap the disk cache
+DECODED_CACHE_MAX_BYTES = 2 * 1024 ** 3
+
+# How much decoded music to keep in memory at once (songs and decoded windows of
+# songs, least recently used first out). Set INTERVAL_TRAINING_MEMORY_MB to change it.
+DECODED_MEMORY_MAX_BYTES = int(os.environ.get("INTERVAL_TRAINING_MEMORY_MB", 512)) * 1024 ** 2
+
+# Playlist files that can be used instead of a single MP3 (a folder of MP3s works too)
+PLAYLIST_EXTENSIONS = (".m3u", ".m3u8")
+
+# Finished workouts the HTTP service keeps on disk, so repeat requests are just downloads
+RESULT_CACHE_MAX_BYTES = 1024 ** 3
+
+# Voice clips are sped up by 25% for punchier delivery
+VOICE_SPEED = 1.25
+
+# Window length for the voice time-stretch (long enough to hold a couple of
+# periods of a low voice, short enough not to smear syllables together)
+STRETCH_WINDOW_MS = 30
+
+# Spoken round cues duck the music by this much, fading down over the attack
+# time before the cue and back up over the release time after it
+CUE_DUCK_DB = -12
+CUE_DUCK_ATTACK_MS = 60
+CUE_DUCK_RELEASE_MS = 250
+
+# How many voice clips to synthesize at the same time
+VOICE_WORKERS = 6
+
+# How much audio the streaming encoder is handed at a time (about 1.5 seconds at 44.1kHz)
+STREAM_CHUNK_FRAMES = 65536
+
+# ffmpeg raw PCM formats for each pydub sample width (pydub keeps 8-bit audio signed)
+PCM_FORMATS = {1: "s8", 2: "s16le", 4: "s32le"}
+
+# How many ffmpeg encoders to run at the same time, and roughly how long the chunks
+# of the workout they encode are (shorter for short workouts, so every core gets some)
+ENCODE_WORKERS = os.cpu_count() or 2
+ENCODE_CHUNK_SECONDS = (10, 60)
+# The first chunk is always short, so streamed output starts right away
+ENCODE_FIRST_CHUNK_SECONDS = 2
+
+# Output MP3s are constant bitrate, which lets separately encoded pieces be joined frame by frame
+MP3_BITRATE = "128k"
+
+# numpy sample types for each pydub sample width
+SAMPLE_TYPES = {1: np.int8, 2: np.int16, 4: np.int32}
+
+# Samples per MPEG-1 Layer III frame, and how many samples LAME delays its output by
+MP3_FRAME_SAMPLES = 1152
+LAME_ENCODER_DELAY = 576
+
+# Bitrates (kbps) and sample rates used to decode MP3 frame headers
+MP3_BITRATES = {
+    1: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    2: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+MP3_SAMPLE_RATES = {1: [44100, 48000, 32000], 2: [22050, 24000, 16000], 2.5: [11025, 12000, 8000]}
+
+
+# One piece of the workout timeline. Offsets and lengths are in milliseconds.
+#   "voice":   source is the name of a voice clip (length is the clip length)
+#   "silence": source is None
+#   "music":   source is "intense" or "moderate", offset is where in the song to start,
+#              gain is a volume change in dB (see WorkoutTimeline.match_levels)
+Span = namedtuple("Span", ["kind", "source", "offset", "length", "gain"], defaults=[0])
+
+# A voice clip played over the timeline, offset milliseconds after the start of
+# spans[span] (the music keeps playing underneath, ducked)
+Cue = namedtuple("Cue", ["source", "span", "offset"])
+
+
+class WorkoutTimeline:
+    """
+    Describes the whole workout as a list of spans before any audio is copied.
+    Rendering walks the list once and streams every span's PCM straight to the
+    encoder, so the cost grows linearly with the workout length (repeated
+    `final_audio += segment` copies everything built so far each time).
+    """
+
+    def __init__(self):
+        self.spans = []
+        self.cues = []
+
+    def add_voice(self, name, clip):
+        self.spans.append(Span("voice", name, 0, len(clip)))
+
+    def add_silence(self, duration_ms):
+        if duration_ms > 0:
+            self.spans.append(Span("silence", None, 0, duration_ms))
+
+    def add_music(self, source, offset_ms, duration_ms):
+        if duration_ms > 0:
+            self.spans.append(Span("music", source, offset_ms, duration_ms))
+
+    def add_cue(self, name, offset_ms, span=None):
+        """
+        Plays the voice clip `name` offset_ms after the start of spans[span] (the
+        last span added, by default). The offset can run past the end of the span.
+        """
+        self.cues.append(Cue(name, len(self.spans) - 1 if span is None else span, offset_ms))
+
+    def duration_ms(self):
+        return sum(span.length for span in self.spans)
+
+    def output_format(self, sources, clips):
+        """Picks the same format pydub would end up with after adding everything together"""
+        used = [sources[span.source] for span in self.spans if span.kind == "music"]
+        used += [clips[span.source] for span in self.spans if span.kind == "voice"]
+        used += [clips[cue.source] for cue in self.cues]
+        if not used:
+            return 44100, 2, 2
+        return (max(audio.frame_rate for audio in used),
+                max(audio.channels for audio in used),
+                max(audio.sample_width for audio in used))
+
+    def prepare(self, sources, clips):
+        """Converts every source and clip to the output format once, up front"""
+        frame_rate, channels, sample_width = self.output_format(sources, clips)
+        used_sources = {span.source for span in self.spans if span.kind == "music"}
+        used_clips = {span.source for span in self.spans if span.kind == "voice"}
+        used_clips |= {cue.source for cue in self.cues}
+        sources = {name: match_format(sources[name], frame_rate, channels, sample_width)
+                   for name in used_sources}
+        clips = {name: match_format(clips[name], frame_rate, channels, sample_width)
+                 for name in used_clips}
+        # Songs that are decoded lazily get told which parts of them will be needed
+        for name, audio in sources.items():
+            if isinstance(audio, LazySource):
+                audio.plan(self.source_ranges(name, frame_rate, int(audio.frame_count())))
+        return (frame_rate, channels, sample_width), sources, clips
+
+    def source_ranges(self, name, frame_rate, total_frames):
+        """The (start, end) frame ranges of a song that the timeline actually plays"""
+        ranges = []
+        for span in self.spans:
+            if span.kind != "music" or span.source != name:
+                continue
+            length = self.span_frames(span, frame_rate, None)
+            if length >= total_frames:
+                ranges.append((0, total_frames))
+                continue
+            start = int(span.offset * frame_rate / 1000) % total_frames
+            if start + length <= total_frames:
+                ranges.append((start, start + length))
+            else:
+                # Wraps around to the start of the song
+                ranges += [(start, total_frames), (0, start + length - total_frames)]
+        return ranges
+
+    def span_frames(self, span, frame_rate, clips):
+        """Number of audio frames a span takes up in the output"""
+        if span.kind == "voice":
+            return int(clips[span.source].frame_count())
+        return int(span.length * frame_rate / 1000)
+
+    def iter_span_data(self, span, frame_rate, frame_width, sources, clips):
+        """Yields the raw PCM bytes for one span, without building any AudioSegments"""
+        if span.kind == "voice":
+            yield memoryview(clips[span.source].raw_data)
+        elif span.kind == "silence":
+            yield bytes(self.span_frames(span, frame_rate, clips) * frame_width)
+        else:
+            audio = sources[span.source]
+            start = int(span.offset * frame_rate / 1000)
+            for chunk in iter_looped_frames(audio, start, self.span_frames(span, frame_rate, clips)):
+                yield apply_gain(chunk, span.gain, audio.sample_width) if span.gain else chunk
+
+    def match_levels(self, analyses):
+        """
+        Gives every music span a gain that brings its song to the same loudness as
+        the others, so the switches between songs don't jump in volume. The songs
+        meet at their average level, or lower if one of them can't be turned up that
+        far without clipping. analyses maps source names to TrackAnalysis.
+        """
+        audible = {name: analysis for name, analysis in analyses.items()
+                   if analysis.level > TrackAnalysis.SILENCE_DB}
+        if not audible:
+            return
+        target = min(min(analysis.level - analysis.peak for analysis in audible.values()),
+                     sum(analysis.level for analysis in audible.values()) / len(audible))
+        gains = {name: round(target - analysis.level, 2) for name, analysis in audible.items()}
+        self.spans = [span._replace(gain=gains.get(span.source, 0)) if span.kind == "music" else span
+                      for span in self.spans]
+
+    def iter_pcm(self, sources, clips, chunk_frames=STREAM_CHUNK_FRAMES):
+        """
+        Yields the rendered workout as raw PCM chunks of at most chunk_frames frames.
+        Sources and clips must already be in the output format (see prepare()).
+        Music and voice chunks are views into the source audio, so nothing the size
+        of the whole workout is ever held in memory.
+        """
+        chunks = self.iter_spans_pcm(sources, clips, chunk_frames)
+        if not self.cues:
+            return chunks
+        frame_rate, channels, sample_width = self.output_format(sources, clips)
+        return self.cue_mixer(frame_rate, channels, sample_width, clips).iter_mixed(chunks)
+
+    def iter_spans_pcm(self, sources, clips, chunk_frames):
+        """iter_pcm without the cues"""
+        frame_rate, channels, sample_width = self.output_format(sources, clips)
+        frame_width = channels * sample_width
+        chunk_bytes = chunk_frames * frame_width
+        silence = bytes(chunk_bytes)
+
+        for span in self.spans:
+            if span.kind == "silence":
+                remaining = self.span_frames(span, frame_rate, clips) * frame_width
+                while remaining > 0:
+                    yield silence[:min(remaining, chunk_bytes)]
+                    remaining -= chunk_bytes
+                continue
+            for data in self.iter_span_data(span, frame_rate, frame_width, sources, clips):
+                for start in range(0, len(data), chunk_bytes):
+                    yield data[start:start + chunk_bytes]
+
+    def stream_mp3(self, sources, clips, output_path):
+        """
+        Renders straight into an ffmpeg encoder as the timeline is walked, so memory
+        use stays flat no matter how many rounds there are and encoding overlaps
+        with rendering
+        """
+        (frame_rate, channels, sample_width), sources, clips = self.prepare(sources, clips)
+        total_bytes = sum(self.span_frames(span, frame_rate, clips) for span in self.spans) * \
+            channels * sample_width
+        encode_pcm_stream(iter_with_progress(self.iter_pcm(sources, clips), "encode", total_bytes),
+                          output_path, frame_rate, channels, sample_width)
+
+    def cue_mixer(self, frame_rate, channels, sample_width, clips):
+        """A CueMixer with every cue placed at its frame in the rendered workout"""
+        span_starts = []
+        position = 0
+        for span in self.spans:
+            span_starts.append(position)
+            position += self.span_frames(span, frame_rate, clips)
+        placements = [(span_starts[cue.span] + int(cue.offset * frame_rate / 1000), cue.source)
+                      for cue in self.cues]
+        return CueMixer(placements, clips, frame_rate, channels, sample_width)
+
+    def frame_pieces(self, frame_rate, clips):
+        """
+        Snaps every span onto the MP3 frame grid. Returns (span, start sample in the
+        source, length in MP3 frames) for each span. Span edges are rounded to the
+        nearest frame from the start of the workout, so rounding never adds up.
+        """
+        pieces = []
+        position = 0
+        start_frame = 0
+        for span in self.spans:
+            position += self.span_frames(span, frame_rate, clips)
+            end_frame = int(round(position / MP3_FRAME_SAMPLES))
+            if end_frame > start_frame:
+                source_start = int(span.offset * frame_rate / 1000) if span.kind == "music" else 0
+                pieces.append((span, source_start, end_frame - start_frame))
+            start_frame = end_frame
+        return pieces
+
+    def piece_key(self, span, source_start, frames):
+        """Pieces with the same key sound exactly the same, so they only get encoded once"""
+        if span.kind == "music":
+            return ("music", span.source, source_start, frames, span.gain)
+        return (span.kind, span.source, 0, frames)
+
+    def splice_mp3(self, sources, clips, output_path, workers=ENCODE_WORKERS):
+        """
+        Encodes each distinct piece of the workout once and writes the output by
+        copying encoded frames. In "pull from start" mode every round uses the same
+        work and recovery audio, so a 100-round workout only encodes a handful of
+        pieces instead of re-encoding the same audio 100 times.
+        """
+        (frame_rate, channels, sample_width), sources, clips = self.prepare(sources, clips)
+        encoded = {}
+        pieces = self.frame_pieces(frame_rate, clips)
+        with MP3Writer(output_path, frame_rate, channels) as output, \
+                ParallelFrameEncoder(output, frame_rate, channels, sample_width, workers) as encoder:
+            for number, (span, source_start, frames) in enumerate(pieces):
+                report_progress("encode", number / len(pieces))
+                key = self.piece_key(span, source_start, frames)
+                if key not in encoded:
+                    with timed("render"):
+                        pcm = self.piece_pcm(span, source_start, frames, sources, clips,
+                                             channels * sample_width)
+                    encoded[key] = encoder.encode(pcm, frames)
+                encoder.write(encoded[key])
+
+    def copy_mp3(self, indexes, clips, output_path, workers=ENCODE_WORKERS):
+        """
+        Builds the workout by cutting the original MP3s on frame boundaries and
+        copying their frames straight into the output, with no decoding or
+        re-encoding of the music at all. Only the voice clips and silences get
+        encoded, at the music's sample rate. indexes maps source names to
+        MP3FrameIndex objects that passed frame_copy_compatible().
+
+        Cuts land within half a frame (about 13ms) of where they should be. If the
+        source uses the bit reservoir, the first frame after a cut borrows from
+        frames that aren't copied, so that one frame is decoded and encoded again
+        (see carry_reservoir) and everything after it is copied as it is.
+        """
+        first = next(iter(indexes.values()))
+        frame_rate, channels, sample_width = first.sample_rate, first.channels, 2
+        clips = {span.source: match_format(clips[span.source], frame_rate, channels, sample_width)
+                 for span in self.spans if span.kind == "voice"}
+        pieces = self.frame_pieces(frame_rate, clips)
+
+        # The first frames after cuts that borrow from the bit reservoir, and the
+        # decoded songs to encode them again from (only around those frames)
+        leads = {}
+        for span, source_start, frames in pieces:
+            if span.kind == "music":
+                index = indexes[span.source]
+                start_frame = index.frame_at(source_start)
+                if index.main_data_begin(start_frame):
+                    leads.setdefault(span.source, set()).add(start_frame)
+        songs = {}
+        for name, lead_frames in leads.items():
+            index = indexes[name]
+            songs[name] = LazySource(index.path, index.decoded_frames(), frame_rate, channels, sample_width)
+            songs[name].plan([(index.frame_start(number) - MP3_FRAME_SAMPLES,
+                               index.frame_start(number) + 2 * MP3_FRAME_SAMPLES) for number in lead_frames])
+
+        encoded = {}
+        try:
+            with MP3Writer(output_path, frame_rate, channels) as output, \
+                    ParallelFrameEncoder(output, frame_rate, channels, sample_width, workers) as encoder:
+                for number, (span, source_start, frames) in enumerate(pieces):
+                    report_progress("encode", number / len(pieces))
+                    if span.kind == "music":
+                        index = indexes[span.source]
+                        start_frame = index.frame_at(source_start)
+                        if start_frame in leads.get(span.source, ()):
+                            key = ("lead", span.source, start_frame)
+                            if key not in encoded:
+                                pcm = self.piece_pcm(span, index.frame_start(start_frame), 1, songs, {},
+                                                     channels * sample_width)
+                                following = (start_frame + 1) % len(index.frames)
+                                encoded[key] = encoder.encode(pcm, 1, index.reservoir(following))
+                            encoder.write(encoded[key])
+                            start_frame += 1
+                            frames -= 1
+                        for data, sizes in index.iter_frame_data(start_frame, frames):
+                            encoder.write((data, sizes))
+                        continue
+                    key = self.piece_key(span, source_start, frames)
+                    if key not in encoded:
+                        pcm = self.piece_pcm(span, source_start, frames, {}, clips,
+                                             channels * sample_width)
+                        encoded[key] = encoder.encode(pcm, frames)
+                    encoder.write(encoded[key])
+        finally:
+            for song in songs.values():
+                song.close()
+
+    def chunk_boundaries(self, frame_rate, clips, total_frames, workers=ENCODE_WORKERS):
+        """
+        Where chunked_mp3 splits the workout, in MP3 frames. Chunks end on span edges
+        (after the warm-up, after a few rounds, ...) once they're long enough, and
+        long spans get split in the middle so no chunk is much longer than the rest.
+        """
+        shortest, longest = (seconds * frame_rate // MP3_FRAME_SAMPLES for seconds in ENCODE_CHUNK_SECONDS)
+        target = min(max(total_frames // (workers * 2), shortest), longest)
+
+        boundaries = [0]
+        first_chunk = ENCODE_FIRST_CHUNK_SECONDS * frame_rate // MP3_FRAME_SAMPLES
+        if total_frames > first_chunk:
+            boundaries.append(first_chunk)
+        position = 0
+        for span in self.spans:
+            position += self.span_frames(span, frame_rate, clips)
+            edge = min(-(-position // MP3_FRAME_SAMPLES), total_frames)
+            while edge - boundaries[-1] > target * 2:
+                boundaries.append(boundaries[-1] + target)
+            if edge - boundaries[-1] >= target:
+                boundaries.append(edge)
+        if boundaries[-1] < total_frames:
+            boundaries.append(total_frames)
+        return boundaries
+
+    def chunked_mp3(self, sources, clips, output_path, workers=ENCODE_WORKERS):
+        """
+        Encodes the workout on several ffmpeg processes at once. The timeline is
+        rendered in order, cut into chunks on the MP3 frame grid (see
+        chunk_boundaries) and each chunk is encoded by its own encoder while the
+        next ones are rendered. The frames are joined back together in order, so
+        the result plays exactly like a single encode of the whole workout.
+        """
+        (frame_rate, channels, sample_width), sources, clips = self.prepare(sources, clips)
+        frame_width = channels * sample_width
+        total_samples = sum(self.span_frames(span, frame_rate, clips) for span in self.spans)
+        total_frames = -(-total_samples // MP3_FRAME_SAMPLES)
+        boundaries = self.chunk_boundaries(frame_rate, clips, total_frames, workers)
+        lead_in = MP3_FRAME_SAMPLES - LAME_ENCODER_DELAY
+
+        # Rendered PCM that's still needed, starting at sample `buffer_start` of the
+        # workout. Every chunk needs a little from before it (the lead-in) and one
+        # frame from after it, the same as the pieces piece_pcm lays out.
+        pcm = self.iter_pcm(sources, clips)
+        buffer = bytearray(lead_in * frame_width)
+        buffer_start = -lead_in
+
+        with MP3Writer(output_path, frame_rate, channels) as output, \
+                ParallelFrameEncoder(output, frame_rate, channels, sample_width, workers) as encoder:
+            output.padding = total_frames * MP3_FRAME_SAMPLES - total_samples
+            for number, (start, end) in enumerate(zip(boundaries, boundaries[1:])):
+                report_progress("encode", number / (len(boundaries) - 1))
+                needed = ((end + 1) * MP3_FRAME_SAMPLES - buffer_start) * frame_width
+                with timed("render"):
+                    for chunk in pcm:
+                        buffer += chunk
+                        if len(buffer) >= needed:
+                            break
+                if len(buffer) < needed:
+                    buffer += bytes(needed - len(buffer))  # Past the end of the workout
+
+                first = (start * MP3_FRAME_SAMPLES - lead_in - buffer_start) * frame_width
+                encoder.write(encoder.encode(bytes(buffer[first:needed]), end - start))
+
+                next_start = end * MP3_FRAME_SAMPLES - lead_in
+                del buffer[:(next_start - buffer_start) * frame_width]
+                buffer_start = next_start
+
+    def distinct_pieces(self, frame_rate, clips):
+        """How many pieces splice_mp3 would actually have to encode"""
+        pieces = self.frame_pieces(frame_rate, clips)
+        return len({self.piece_key(*piece) for piece in pieces}), len(pieces)
+
+    def piece_pcm(self, span, source_start, frames, sources, clips, frame_width):
+        """
+        Raw PCM for one piece, laid out so the encoder's output lines up with the
+        frame grid: a little audio from before the piece to cover LAME's delay, then
+        exactly `frames` MP3 frames of the piece, then one frame of what follows so
+        the last kept frame is encoded with its real continuation. encode_mp3_frames
+        throws away the extra frames again.
+        """
+        samples = frames * MP3_FRAME_SAMPLES
+        lead_in = MP3_FRAME_SAMPLES - LAME_ENCODER_DELAY
+
+        if span.kind == "music":
+            audio = sources[span.source]
+            if source_start >= lead_in:
+                before = list(iter_looped_frames(audio, source_start - lead_in, lead_in))
+            else:
+                before = [bytes(lead_in * frame_width)]
+            body = list(iter_looped_frames(audio, source_start, samples + MP3_FRAME_SAMPLES))
+            pcm = b"".join(before + body)
+            return apply_gain(pcm, span.gain, audio.sample_width) if span.gain else pcm
+
+        body = b""
+        if span.kind == "voice":
+            body = bytes(clips[span.source].raw_data[:samples * frame_width])
+        tail = (samples + MP3_FRAME_SAMPLES) * frame_width - len(body)
+        return bytes(lead_in * frame_width) + body + bytes(tail)
+
+    def export_mp3(self, sources, clips, output_path, workers=ENCODE_WORKERS):
+        """
+        Writes the workout as an MP3 using whichever encoder is cheapest: splicing
+        pre-encoded frames when most of the workout repeats itself, otherwise
+        encoding it in chunks on every core. Sample rates the frame grid doesn't
+        cover are streamed through a single encoder.
+        """
+        frame_rate, channels, sample_width = self.output_format(sources, clips)
+        if frame_rate not in MP3_SAMPLE_RATES[1]:
+            self.stream_mp3(sources, clips, output_path)
+            return
+        distinct, total = self.distinct_pieces(frame_rate, clips)
+        if distinct * 2 <= total and not self.cues:  # Pieces with cues over them aren't repeats
+            self.splice_mp3(sources, clips, output_path, workers)
+        else:
+            self.chunked_mp3(sources, clips, output_path, workers)
+
+
+class CueMixer:
+    """
+    Mixes voice cues over the rendered workout and ducks the music under them.
+    All the cue placements are turned into one gain envelope up front, stored as
+    breakpoints, so mixing a chunk of the workout is one np.interp for the gain
+    plus one add per cue that overlaps it. Audio outside the ducked regions is
+    passed through untouched, so the cost depends on how much of the workout has
+    cues over it, not on how long the workout is.
+
+    placements is a list of (start frame, clip name); clips must already be in
+    the output format.
+    """
+
+    def __init__(self, placements, clips, frame_rate, channels, sample_width):
+        self.channels = channels
+        self.sample_width = sample_width
+        self.samples = {name: segment_to_array(clips[name]) for _, name in placements}
+        self.cues = sorted((start, start + len(self.samples[name]), name) for start, name in placements)
+        self.cue_starts = np.array([start for start, _, _ in self.cues])
+        self.cue_ends = np.maximum.accumulate(np.array([end for _, end, _ in self.cues]))
+
+        # Cues whose ducking overlaps share one region, so the music doesn't pop back up between them
+        attack = int(CUE_DUCK_ATTACK_MS * frame_rate / 1000)
+        release = int(CUE_DUCK_RELEASE_MS * frame_rate / 1000)
+        self.regions = []
+        for start, end, _ in self.cues:
+            if self.regions and start - attack <= self.regions[-1][1]:
+                self.regions[-1][1] = max(self.regions[-1][1], end + release)
+            else:
+                self.regions.append([start - attack, end + release])
+
+        self.region_ends = np.array([end for _, end in self.regions])
+
+        duck = 10 ** (CUE_DUCK_DB / 20)
+        positions, gains = [], []
+        for start, end in self.regions:
+            positions += [start, start + attack, end - release, end]
+            gains += [1, duck, duck, 1]
+        self.envelope = (np.array(positions, dtype=np.float64), np.array(gains, dtype=np.float32))
+
+    def mix(self, data, start):
+        """Returns the PCM chunk that starts at frame `start` with the cues mixed in"""
+        frames = len(data) // (self.channels * self.sample_width)
+        end = start + frames
+        if not self.overlaps(start, end):
+            return data
+
+        samples = np.frombuffer(data, dtype=SAMPLE_TYPES[self.sample_width])
+        samples = samples.reshape(frames, self.channels).astype(np.float32)
+        samples *= np.interp(np.arange(start, end), *self.envelope).astype(np.float32)[:, None]
+
+        number = int(np.searchsorted(self.cue_ends, start, side="right"))
+        while number < len(self.cues) and self.cue_starts[number] < end:
+            cue_start, cue_end, name = self.cues[number]
+            low, high = max(start, cue_start), min(end, cue_end)
+            if low < high:
+                samples[low - start:high - start] += self.samples[name][low - cue_start:high - cue_start]
+            number += 1
+        return array_to_bytes(samples, self.sample_width)
+
+    def overlaps(self, start, end):
+        """True if any ducked region overlaps frames start to end"""
+        number = int(np.searchsorted(self.region_ends, start, side="right"))
+        return number < len(self.regions) and self.regions[number][0] < end
+
+    def iter_mixed(self, chunks):
+        """Mixes the cues into a stream of PCM chunks that starts at the start of the workout"""
+        frame_width = self.channels * self.sample_width
+        position = 0
+        for chunk in chunks:
+            yield self.mix(chunk, position)
+            position += len(chunk) // frame_width
+
+
+def iter_with_progress(chunks, stage, total_bytes):
+    """Passes chunks through, reporting how far through total_bytes they've got"""
+    done = 0
+    for chunk in chunks:
+        yield chunk
+        done += len(chunk)
+        report_progress(stage, done / max(total_bytes, 1))
+
+
+def match_format(audio, frame_rate, channels, sample_width):
+    """Converts an AudioSegment to the given format (no-op if it already matches)"""
+    if isinstance(audio, LazySource):
+        return audio.with_format(frame_rate, channels, sample_width)
+    if audio.frame_rate != frame_rate:
+        audio = audio.set_frame_rate(frame_rate)
+    if audio.channels != channels:
+        audio = audio.set_channels(channels)
+    if audio.sample_width != sample_width:
+        audio = audio.set_sample_width(sample_width)
+    return audio
+
+
+def iter_looped_frames(audio, start_frame, frame_count):
+    """
+    Yields raw PCM for frame_count frames of audio starting at start_frame,
+    looping back to the beginning of the song as many times as needed
+    """
+    total_frames = int(audio.frame_count())
+    if total_frames == 0:
+        yield bytes(frame_count * audio.frame_width)
+        return
+
+    position = start_frame % total_frames
+    while frame_count > 0:
+        frames = min(frame_count, total_frames - position)
+        yield read_frames(audio, position, frames)
+        frame_count -= frames
+        position = 0
+
+
+def read_frames(audio, start_frame, frame_count):
+    """Raw PCM for part of an AudioSegment or LazySource, without copying it if possible"""
+    if isinstance(audio, LazySource):
+        return audio.read_frames(start_frame, frame_count)
+    frame_width = audio.frame_width
+    return memoryview(audio.raw_data)[start_frame * frame_width:(start_frame + frame_count) * frame_width]
+
+
+class LazySource:
+    """
+    A song that only gets decoded where the workout actually uses it. It stands in
+    for an AudioSegment in a WorkoutTimeline (frame_rate, channels, len() and so
+    on), and the timeline hands it the ranges it will play through plan().
+
+    If only a small part of the song is needed (e.g. the first 20 seconds over and
+    over in "pull from start" mode), just those windows are decoded, using ffmpeg's
+    seeking, and kept. Otherwise (cycle-through mode) the song is decoded front to
+    back as the timeline reads it, keeping only what hasn't been played yet. A
+    complete front-to-back decode is handed to the DecodedAudioCache on the way,
+    so the next run doesn't need to decode at all.
+
+    The decoder needs a few frames after a seek before its output is right, so it
+    always starts SEEK_PREROLL early and that part is thrown away.
+    """
+
+    # Planned ranges closer together than this many seconds are decoded as one window
+    MERGE_GAP_SECONDS = 1
+    # Extra audio decoded around each window for the MP3 frame grid (see piece_pcm)
+    WINDOW_MARGIN = 2 * MP3_FRAME_SAMPLES
+    # Skipping further ahead than this many seconds restarts the decoder instead of reading through
+    SEEK_AHEAD_SECONDS = 10
+    # Frames can borrow up to 511 bytes from the frames before them (the bit
+    # reservoir), which reaches 8 frames back at 32 kbps, and each frame blends
+    # into the one before it, so a decoder that seeks straight to a sample gets the
+    # first few thousand samples after it wrong
+    SEEK_PREROLL = 12 * MP3_FRAME_SAMPLES
+    READ_BYTES = 256 * 1024
+
+    def __init__(self, path, total_frames, frame_rate, channels, sample_width=2,
+                 cache=None, cache_key=None, memory=None):
+        self.path = path
+        self.total_frames = total_frames
+        self.frame_rate = frame_rate
+        self.channels = channels
+        self.sample_width = sample_width
+        self.frame_width = channels * sample_width
+        self.cache = cache
+        self.cache_key = cache_key
+        self.memory = memory  # A MemoryLRU that decoded windows are counted against
+        self.windows = []  # [start, end, decoded data or None]
+        self.sequential = False
+        self.process = None
+        self.buffer = bytearray()
+        self.buffer_start = 0
+        self.cache_file = None
+        self.copies = []  # The LazySources with_format made, which close() closes too
+
+    def __len__(self):
+        return int(round(1000 * self.total_frames / self.frame_rate))
+
+    def __del__(self):
+        if getattr(self, "process", None) or getattr(self, "cache_file", None):
+            self.close()
+
+    def frame_count(self):
+        return float(self.total_frames)
+
+    def with_format(self, frame_rate, channels, sample_width):
+        """The same song, decoded at a different sample rate, channel count or sample width"""
+        if (frame_rate, channels, sample_width) == (self.frame_rate, self.channels, self.sample_width):
+            return self
+        total_frames = int(self.total_frames * frame_rate / self.frame_rate)
+        # Only the song's own format is stored in the cache
+        copy = LazySource(self.path, total_frames, frame_rate, channels, sample_width, memory=self.memory)
+        self.copies.append(copy)
+        return copy
+
+    def plan(self, ranges):
+        """Decides how to decode, given the (start, end) frame ranges that will be read"""
+        merged = []
+        gap = self.MERGE_GAP_SECONDS * self.frame_rate
+        for start, end in sorted(ranges):
+            start = max(0, start - self.WINDOW_MARGIN)
+            end = min(self.total_frames, end + self.WINDOW_MARGIN)
+            if merged and start <= merged[-1][1] + gap:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end, None])
+
+        # Decode front to back if most of the song gets played about once. If only a
+        # small part is needed, or the same parts are played over and over, decode
+        # those windows once and keep them instead.
+        covered = sum(end - start for start, end, _ in merged)
+        requested = sum(end - start for start, end in ranges)
+        self.sequential = covered > self.total_frames // 2 and requested < 2 * covered
+        self.windows = [] if self.sequential else merged
+
+    def read_frames(self, start_frame, frame_count):
+        if self.sequential:
+            return self.read_sequential(start_frame, frame_count)
+
+        for window in self.windows:
+            if window[0] <= start_frame and start_frame + frame_count <= window[1]:
+                report_event("cache", "music windows", window[2] is not None)
+                if window[2] is None:
+                    window[2] = self.decode(window[0], window[1])
+                    if self.memory:
+                        # Dropped again if memory runs short, and re-decoded if it's needed after that
+                        self.memory.put(id(window), window, len(window[2]),
+                                        lambda window=window: window.__setitem__(2, None))
+                elif self.memory:
+                    self.memory.get(id(window))
+                offset = (start_frame - window[0]) * self.frame_width
+                return memoryview(window[2])[offset:offset + frame_count * self.frame_width]
+
+        # Not something the plan asked for, so just decode it on its own
+        return self.decode(start_frame, start_frame + frame_count)
+
+    def decoder_command(self, start_frame, frame_count=None):
+        command = [AudioSegment.converter, "-hide_banner", "-loglevel", "error"]
+        if start_frame > 0:
+            command += ["-ss", "%.6f" % (start_frame / self.frame_rate)]
+        command += ["-i", self.path]
+        if frame_count is not None:
+            command += ["-t", "%.6f" % (frame_count / self.frame_rate)]
+        return command + ["-vn", "-f", PCM_FORMATS[self.sample_width], "-ar", str(self.frame_rate),
+                          "-ac", str(self.channels), "pipe:1"]
+
+    def decode(self, start_frame, end_frame):
+        """Decodes one window of the song, padded or trimmed to exactly the right length"""
+        preroll = min(start_frame, self.SEEK_PREROLL)
+        with timed("decode"):
+            returncode, stdout, stderr = run_process(
+                self.decoder_command(start_frame - preroll, end_frame - start_frame + preroll))
+        if returncode != 0:
+            raise CouldntDecodeError("Decoding failed. ffmpeg returned error code: {0}\n\n{1}".format(
+                returncode, stderr.decode(errors="replace")))
+        size = (end_frame - start_frame) * self.frame_width
+        report_event("bytes", "decoded", size)
+        data = stdout[preroll * self.frame_width:preroll * self.frame_width + size]
+        return data + bytes(size - len(data))
+
+    def read_sequential(self, start_frame, frame_count):
+        buffered_end = self.buffer_start + len(self.buffer) // self.frame_width
+        if (self.process is None or start_frame < self.buffer_start
+                or start_frame > buffered_end + self.SEEK_AHEAD_SECONDS * self.frame_rate):
+            self.start_decoder(start_frame)
+
+        # Everything before start_frame has been played (or is being skipped), so let it
+        # go, reading on through the decoder's output until start_frame if it's ahead
+        self.drop_before(start_frame)
+        needed = frame_count * self.frame_width
+        while self.buffer_start < start_frame or len(self.buffer) < needed:
+            with timed("decode"):
+                data = self.process.stdout.read(self.READ_BYTES) if self.process else b""
+            report_event("bytes", "decoded", len(data))
+            if not data:
+                self.finish_decoder()
+                self.buffer_start = start_frame
+                self.buffer += bytes(needed - len(self.buffer))  # Song came out a little short
+                break
+            self.buffer += data
+            if self.cache_file:
+                self.cache_file.write(data)
+            self.drop_before(start_frame)
+
+        if self.process and self.buffer_start + len(self.buffer) // self.frame_width >= self.total_frames:
+            # That's the whole song, so let the decoder finish (and the cache entry with it)
+            for data in iter(lambda: self.process.stdout.read(self.READ_BYTES), b""):
+                if self.cache_file:
+                    self.cache_file.write(data)
+            self.finish_decoder()
+        return bytes(self.buffer[:needed])
+
+    def drop_before(self, start_frame):
+        """Lets go of the buffered audio before start_frame"""
+        frames = min(start_frame - self.buffer_start, len(self.buffer) // self.frame_width)
+        if frames > 0:
+            del self.buffer[:frames * self.frame_width]
+            self.buffer_start += frames
+
+    def start_decoder(self, start_frame):
+        """Starts decoding SEEK_PREROLL before start_frame (read_sequential skips that part)"""
+        self.stop_decoder()
+        self.buffer = bytearray()
+        self.buffer_start = start_frame - min(start_frame, self.SEEK_PREROLL)
+        self.process = start_process(self.decoder_command(self.buffer_start),
+                                     stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        if self.cache and self.buffer_start == 0:
+            self.cache_file = self.cache.start_entry(self.cache_key)
+
+    def finish_decoder(self):
+        """Called when the decoder reaches the end of the song"""
+        if self.process:
+            process, self.process = self.process, None
+            finish_process(process)
+            complete = process.returncode == 0
+            if self.cache_file:
+                cache_file, self.cache_file = self.cache_file, None
+                self.cache.finish_entry(self.cache_key, cache_file, self, keep=complete)
+
+    def close(self):
+        """
+        Stops the decoder (if it's running), throws away any partial cache entry
+        and lets go of the decoded windows, and does the same for the copies
+        with_format made (the timeline only uses those, so it never closes them)
+        """
+        if self.memory:
+            for window in self.windows:
+                self.memory.discard(id(window))
+        copies, self.copies = self.copies, []
+        for copy in copies:
+            copy.close()
+        self.stop_decoder()
+
+    def stop_decoder(self):
+        """Stops the decoder (if it's running) and throws away any partial cache entry"""
+        if self.process:
+            process, self.process = self.process, None
+            process.kill()
+            process.wait()
+            if getattr(process, "job", None):
+                process.job.remove_process(process)
+        if self.cache_file:
+            cache_file, self.cache_file = self.cache_file, None
+            self.cache.finish_entry(self.cache_key, cache_file, self, keep=False)
+
+
+class GenerationCancelled(Exception):
+    """Raised inside a generation when its GenerationJob has been cancelled"""
+
+
+# Something that happened during a generation, as passed to GenerationJob listeners:
+#   kind "progress": name is the stage, value how far along it is (0 to 1)
+#   kind "stage":    the stage called name has finished, after value seconds
+#   kind "time":     one piece of work of the kind called name (e.g. "decode") took value seconds
+#   kind "bytes":    value more bytes were counted under name ("decoded", "encoded", "written")
+#   kind "cache":    a lookup in the cache called name, value is True for a hit
+GenerationEvent = namedtuple("GenerationEvent", ["kind", "name", "value"])
+
+
+class GenerationJob:
+    """
+    Lets a generation running on another thread report its progress and be
+    cancelled. Cancelling kills any ffmpeg processes the generation has running,
+    and the generation stops at the next progress report.
+
+    Listeners are called as listener(event) with a GenerationEvent for everything
+    the generation reports (see GenerationProfile for one that collects them).
+    Stages are "voice", "load" and "encode". Loading opens the songs and lays the
+    workout out, but most songs are decoded lazily while they're encoded, so it's
+    the "decode" timings, not the load stage, that show what decoding costs. Most
+    events come from the generating thread, but timings and byte counts also come
+    from encoder threads.
+    progress is a shortcut for a listener that only wants progress(stage, fraction).
+
+    If output is given, it's called as output(data) with the MP3's audio frames as
+    they're written, for streaming (the header frame only gets filled in at the
+    end, so it isn't included).
+    """
+
+    def __init__(self, progress=None, output=None, listeners=()):
+        self.listeners = list(listeners)
+        if progress:
+            self.listen(lambda event: progress(event.name, event.value) if event.kind == "progress" else None)
+        self.output = output
+        self.cancelled = threading.Event()
+        self.processes = set()
+        self.lock = threading.Lock()
+        self.last_report = (None, -1)
+        self.stage = None
+        self.stage_started = 0
+
+    def listen(self, listener):
+        self.listeners.append(listener)
+
+    def emit(self, kind, name, value):
+        event = GenerationEvent(kind, name, value)
+        for listener in self.listeners:
+            listener(event)
+
+    def cancel(self):
+        self.cancelled.set()
+        with self.lock:
+            processes = list(self.processes)
+        for process in processes:
+            try:
+                process.kill()
+            except OSError:
+                pass
+
+    def check(self):
+        if self.cancelled.is_set():
+            raise GenerationCancelled()
+
+    def report(self, stage, fraction):
+        self.check()
+        if stage != self.stage:
+            self.end_stage()
+            self.stage = stage
+            self.stage_started = time.perf_counter()
+        # Only pass on whole-percent changes so a long encode doesn't flood the GUI
+        percent = int(fraction * 100)
+        if (stage, percent) != self.last_report:
+            self.last_report = (stage, percent)
+            self.emit("progress", stage, fraction)
+
+    def end_stage(self):
+        """Reports how long the current stage ran (a stage runs until the next one starts)"""
+        if self.stage is not None:
+            self.emit("stage", self.stage, time.perf_counter() - self.stage_started)
+            self.stage = None
+
+    def add_process(self, process):
+        with self.lock:
+            self.processes.add(process)
+        if self.cancelled.is_set():
+            process.kill()
+
+    def remove_process(self, process):
+        with self.lock:
+            self.processes.discard(process)
+
+
+# The GenerationJob of the generation running on this thread (if any)
+current_job = threading.local()
+
+
+def report_progress(stage, fraction):
+    """Reports progress to the current thread's GenerationJob, and stops if it was cancelled"""
+    job = getattr(current_job, "job", None)
+    if job:
+        job.report(stage, fraction)
+
+
+def report_event(kind, name, value):
+    """Sends a GenerationEvent to the current thread's GenerationJob's listeners (if there is a job)"""
+    job = getattr(current_job, "job", None)
+    if job:
+        job.emit(kind, name, value)
+
+
+@contextlib.contextmanager
+def timed(name):
+    """Reports how long the with block took as a "time" event called name"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        report_event("time", name, time.perf_counter() - started)
+
+
+def current_rss():
+    """This process's resident memory in bytes (its peak so far where the current figure isn't available)"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    return peak_rss(resource.RUSAGE_SELF) if resource else 0
+
+
+def peak_rss(who):
+    """The peak resident memory in bytes of this process (RUSAGE_SELF) or its biggest child process"""
+    peak = resource.getrusage(who).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024  # Linux counts in KB
+
+
+class GenerationProfile:
+    """
+    A GenerationJob listener that adds up a generation's events into a performance
+    report: how long each stage took, the time spent on each kind of work, bytes
+    decoded/encoded/written and cache hit rates. Between start() and stop() it also
+    samples the memory in use (RSS) on a thread to find each stage's peak. That's
+    the whole process's memory, so generations running side by side share it.
+
+    Timed work can run on several threads at once (encoding does), so those
+    timings add up to more than the wall-clock time of their stage.
+    """
+    SAMPLE_SECONDS = 0.01
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.seconds = None
+        self.stages = OrderedDict()  # stage -> {"seconds": ..., "peak_rss": ...}
+        self.timings = OrderedDict()  # kind of work -> [seconds, count]
+        self.bytes = OrderedDict()
+        self.caches = OrderedDict()  # cache -> [hits, misses]
+        self.stage = None
+        self.peak = 0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.sampler = None
+
+    def __call__(self, event):
+        with self.lock:
+            if event.kind == "progress" and event.name != self.stage:
+                self.sample()  # The stage that's ending gets its final memory figure
+                self.stage = event.name
+                self.stages.setdefault(event.name, {"seconds": 0.0, "peak_rss": 0})
+            elif event.kind == "stage":
+                self.stages.setdefault(event.name, {"seconds": 0.0, "peak_rss": 0})["seconds"] += event.value
+            elif event.kind == "time":
+                timing = self.timings.setdefault(event.name, [0.0, 0])
+                timing[0] += event.value
+                timing[1] += 1
+            elif event.kind == "bytes":
+                self.bytes[event.name] = self.bytes.get(event.name, 0) + event.value
+            elif event.kind == "cache":
+                self.caches.setdefault(event.name, [0, 0])[0 if event.value else 1] += 1
+
+    def start(self):
+        """Starts sampling memory"""
+        self.sampler = threading.Thread(target=self.sample_until_stopped, daemon=True)
+        self.sampler.start()
+
+    def stop(self):
+        self.seconds = time.perf_counter() - self.started
+        if self.sampler:
+            self.stopped.set()
+            self.sampler.join()
+        with self.lock:
+            self.sample()
+            self.stage = None
+
+    def sample(self):
+        if self.sampler is None:
+            return
+        rss = current_rss()
+        self.peak = max(self.peak, rss)
+        if self.stage is not None:
+            numbers = self.stages[self.stage]
+            numbers["peak_rss"] = max(numbers["peak_rss"], rss)
+
+    def sample_until_stopped(self):
+        while not self.stopped.wait(self.SAMPLE_SECONDS):
+            with self.lock:
+                self.sample()
+
+    def report(self):
+        """Everything collected so far as a dict that can be saved as JSON (memory only if it was sampled)"""
+        def megabytes(value):
+            return round(value / 1024 ** 2, 1)
+
+        with self.lock:
+            report = OrderedDict(seconds=round(self.seconds if self.seconds is not None
+                                               else time.perf_counter() - self.started, 3))
+            report["stages"] = OrderedDict()
+            for stage, numbers in self.stages.items():
+                report["stages"][stage] = {"seconds": round(numbers["seconds"], 3)}
+                if self.sampler:
+                    report["stages"][stage]["peak_rss_mb"] = megabytes(numbers["peak_rss"])
+            report["timings"] = OrderedDict((name, {"seconds": round(seconds, 3), "count": count})
+                                            for name, (seconds, count) in self.timings.items())
+            report["bytes"] = OrderedDict(self.bytes)
+            report["caches"] = OrderedDict(
+                (name, {"hits": hits, "misses": misses, "hit_rate": round(hits / (hits + misses), 3)})
+                for name, (hits, misses) in self.caches.items())
+            if self.sampler:
+                report["peak_rss_mb"] = megabytes(self.peak)
+        return report
+
+    def summary(self):
+        """
+        A one-line summary, like "voice 0.4s, load 0.1s, encode 9.2s (decoding 3.1s)".
+        Decoding mostly happens while encoding, so it's shown on its own.
+        """
+        report = self.report()
+        summary = ", ".join("{0} {1:.1f}s".format(stage, numbers["seconds"])
+                            for stage, numbers in report["stages"].items())
+        if "decode" in report["timings"]:
+            summary += " (decoding {0:.1f}s)".format(report["timings"]["decode"]["seconds"])
+        return summary
+
+
+def performance_report_path(output_path):
+    """Where the JSON performance report for an output file goes: next to it, as name.perf.json"""
+    return os.path.splitext(output_path)[0] + ".perf.json"
+
+
+def start_process(command, **kwargs):
+    """subprocess.Popen, except the process gets killed if the current generation is cancelled"""
+    job = getattr(current_job, "job", None)
+    if job:
+        job.check()
+    process = subprocess.Popen(command, **kwargs)
+    if job:
+        job.add_process(process)
+        process.job = job
+    return process
+
+
+def finish_process(process):
+    """Waits for a process from start_process and forgets about it"""
+    process.wait()
+    job = getattr(process, "job", None)
+    if job:
+        job.remove_process(process)
+        job.check()  # A killed ffmpeg looks like a failure, report it as a cancel instead
+
+
+def run_process(command, input=None):
+    """Runs a process from start_process to the end and returns (returncode, stdout, stderr)"""
+    process = start_process(command, stdin=subprocess.PIPE if input is not None else None,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        stdout, stderr = process.communicate(input)
+    finally:
+        finish_process(process)
+    return process.returncode, stdout, stderr
+
+
+def encode_pcm_stream(pcm_chunks, output_path, frame_rate, channels, sample_width):
+    """Feeds raw PCM chunks into a single long-lived ffmpeg process that writes the MP3"""
+    command = [AudioSegment.converter, "-y", "-hide_banner", "-loglevel", "error",
+               "-f", PCM_FORMATS[sample_width], "-ar", str(frame_rate), "-ac", str(channels),
+               "-i", "pipe:0", "-b:a", MP3_BITRATE, "-f", "mp3", output_path]
+    process = start_process(command, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        for chunk in pcm_chunks:
+            process.stdin.write(chunk)
+    except BrokenPipeError:
+        pass  # ffmpeg quit early, the error is reported below
+    except BaseException:
+        process.kill()
+        process.wait()
+        if getattr(process, "job", None):
+            process.job.remove_process(process)
+        raise
+    finally:
+        if process.stdin:
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+    errors = process.stderr.read()
+    finish_process(process)
+    if process.returncode != 0:
+        raise CouldntEncodeError("Encoding failed. ffmpeg returned error code: {0}\n\n{1}".format(
+            process.returncode, errors.decode(errors="replace")))
+    for counter in ("encoded", "written"):
+        report_event("bytes", counter, os.path.getsize(output_path))
+
+
+def encode_mp3_frames(pcm, frame_rate, channels, sample_width, frames):
+    """
+    Encodes a piece laid out by WorkoutTimeline.piece_pcm and returns exactly
+    `frames` MP3 frames of it as (bytes, list of frame sizes), ready to be joined
+    to other pieces. The bit reservoir is turned off so every frame stands on its own.
+    """
+    command = [AudioSegment.converter, "-hide_banner", "-loglevel", "error",
+               "-f", PCM_FORMATS[sample_width], "-ar", str(frame_rate), "-ac", str(channels),
+               "-i", "pipe:0", "-c:a", "libmp3lame", "-b:a", MP3_BITRATE, "-reservoir", "0",
+               "-write_xing", "0", "-id3v2_version", "0", "-f", "mp3", "pipe:1"]
+    with timed("encode"):
+        returncode, stdout, stderr = run_process(command, input=pcm)
+    if returncode != 0:
+        raise CouldntEncodeError("Encoding failed. ffmpeg returned error code: {0}\n\n{1}".format(
+            returncode, stderr.decode(errors="replace")))
+
+    # The first frame only holds the encoder delay and the lead-in, so skip it
+    mp3_frames = list(iter_mp3_frames(stdout))[1:frames + 1]
+    if len(mp3_frames) < frames:
+        raise CouldntEncodeError("Encoder returned {0} frames, expected {1}".format(len(mp3_frames), frames))
+    data = memoryview(stdout)
+    encoded = b"".join(data[frame.offset:frame.offset + frame.length] for frame in mp3_frames)
+    report_event("bytes", "encoded", len(encoded))
+    return encoded, [frame.length for frame in mp3_frames]
+
+
+class ParallelFrameEncoder:
+    """
+    Runs encode_mp3_frames on several ffmpeg processes at once while the caller
+    carries on preparing the next pieces, and writes everything to an MP3Writer in
+    the order it was handed over. Only a few pieces are kept in flight, so memory
+    use doesn't grow with the length of the workout.
+    """
+
+    def __init__(self, output, frame_rate, channels, sample_width, workers=ENCODE_WORKERS):
+        self.output = output
+        self.format = (frame_rate, channels, sample_width)
+        self.job = getattr(current_job, "job", None)
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.pending = deque()
+        self.max_pending = workers * 2
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        try:
+            if exc_type is None:
+                while self.pending:
+                    self.write_next()
+        finally:
+            for piece in self.pending:
+                if isinstance(piece, Future):
+                    piece.cancel()
+            self.pool.shutdown()
+
+    def encode(self, pcm, frames, reservoir=None):
+        """
+        Starts encoding a piece laid out by piece_pcm and returns a Future of (bytes,
+        frame sizes). For a one-frame piece, reservoir is handed to carry_reservoir.
+        """
+        return self.pool.submit(self.run, pcm, frames, reservoir)
+
+    def run(self, pcm, frames, reservoir=None):
+        # Encoder threads belong to the same generation, so cancelling it kills their ffmpegs too
+        current_job.job = self.job
+        try:
+            data, sizes = encode_mp3_frames(pcm, *self.format, frames)
+            if reservoir is not None:
+                data = carry_reservoir(data, reservoir)
+                sizes = [len(data)]
+            return data, sizes
+        finally:
+            current_job.job = None
+
+    def write(self, piece):
+        """Queues frames for the output: a Future from encode(), or (bytes, frame sizes) ready to go"""
+        self.pending.append(piece)
+        while len(self.pending) > self.max_pending:
+            self.write_next()
+        # Pass on whatever is already finished right away, so streamed output starts early
+        while self.pending and (not isinstance(self.pending[0], Future) or self.pending[0].done()):
+            self.write_next()
+
+    def write_next(self):
+        piece = self.pending.popleft()
+        if isinstance(piece, Future):
+            piece = piece.result()
+        self.output.write(*piece)
+
+
+# One MP3 frame found in a file: where it is, how long it is, and what it holds
+MP3Frame = namedtuple("MP3Frame", ["offset", "length", "samples", "sample_rate", "channels",
+                                   "bitrate", "version", "side_info_length"])
+
+
+def parse_mp3_frame_header(data, offset):
+    """Decodes the 4-byte Layer III frame header at offset, or returns None if there isn't one"""
+    if offset + 4 > len(data) or data[offset] != 0xFF or (data[offset + 1] & 0xE0) != 0xE0:
+        return None
+    b1, b2, b3 = data[offset + 1], data[offset + 2], data[offset + 3]
+    version = {0: 2.5, 2: 2, 3: 1}.get((b1 >> 3) & 3)
+    layer = (b1 >> 1) & 3
+    bitrate_index = b2 >> 4
+    rate_index = (b2 >> 2) & 3
+    if version is None or layer != 1 or bitrate_index in (0, 15) or rate_index == 3:
+        return None
+
+    bitrate = MP3_BITRATES[1 if version == 1 else 2][bitrate_index] * 1000
+    sample_rate = MP3_SAMPLE_RATES[version][rate_index]
+    padding = (b2 >> 1) & 1
+    channels = 1 if (b3 >> 6) == 3 else 2
+    samples = 1152 if version == 1 else 576
+    length = (samples // 8) * bitrate // sample_rate + padding
+    if version == 1:
+        side_info = 17 if channels == 1 else 32
+    else:
+        side_info = 9 if channels == 1 else 17
+    if not b1 & 1:
+        side_info += 2  # CRC
+    return MP3Frame(offset, length, samples, sample_rate, channels, bitrate, version, side_info)
+
+
+def iter_mp3_frames(data, include_info=False):
+    """
+    Yields every audio frame in an MP3 file's bytes. ID3 tags and junk between
+    frames are skipped, and so is the Xing/Info/VBRI header frame unless
+    include_info is True.
+    """
+    offset = 0
+    # ID3v2 tags at the start (their size is stored as a "syncsafe" integer)
+    while data[offset:offset + 3] == b"ID3" and offset + 10 <= len(data):
+        size = 0
+        for byte in data[offset + 6:offset + 10]:
+            size = (size << 7) | (byte & 0x7F)
+        offset += 10 + size + (10 if data[offset + 5] & 0x10 else 0)
+
+    first = True
+    while offset + 4 <= len(data):
+        frame = parse_mp3_frame_header(data, offset)
+        if frame is None or frame.length < 4 or offset + frame.length > len(data):
+            if frame is not None and offset + frame.length > len(data):
+                break  # Truncated last frame
+            offset += 1  # Not a frame, look for the next sync word
+            continue
+        if first and not include_info:
+            first = False
+            tag_offset = offset + 4 + frame.side_info_length
+            if bytes(data[tag_offset:tag_offset + 4]) in (b"Xing", b"Info") or \
+                    bytes(data[offset + 36:offset + 40]) == b"VBRI":
+                offset += frame.length
+                continue
+        first = False
+        yield frame
+        offset += frame.length
+
+
+class MP3FrameIndex:
+    """
+    The position of every audio frame in an MP3 file, so the file can be cut on
+    frame boundaries without decoding it. The file is memory-mapped, not read in.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.frames = list(iter_mp3_frames(self.data))
+        self.encoder_delay, self.encoder_padding = read_encoder_delays(self.data)
+        first = self.frames[0] if self.frames else None
+        self.sample_rate = first.sample_rate if first else 0
+        self.channels = first.channels if first else 0
+        self.version = first.version if first else None
+        self.path = path
+
+    def is_uniform(self):
+        """True if every frame has the same sample rate, channels and MPEG version"""
+        return bool(self.frames) and all(
+            frame.sample_rate == self.sample_rate and frame.channels == self.channels
+            and frame.version == self.version for frame in self.frames)
+
+    def duration_ms(self):
+        return len(self.frames) * MP3_FRAME_SAMPLES * 1000 // max(self.sample_rate, 1)
+
+    def __len__(self):
+        # Measured in milliseconds, like an AudioSegment
+        return self.duration_ms()
+
+    def decoded_frames(self):
+        """How many audio frames (samples per channel) the song decodes to"""
+        samples = self.frames[0].samples if self.frames else 0
+        return max(0, len(self.frames) * samples - self.encoder_delay - self.encoder_padding)
+
+    def frame_at(self, sample):
+        """The frame a cut at `sample` of the decoded song starts copying from"""
+        return int(round((sample + self.encoder_delay) / MP3_FRAME_SAMPLES)) % len(self.frames)
+
+    def frame_start(self, number):
+        """Where frame `number` starts in the decoded song, in samples"""
+        return max(0, number * MP3_FRAME_SAMPLES - self.encoder_delay)
+
+    def main_data_begin(self, number):
+        """
+        How many bytes frame `number` borrows from the end of the frames before it
+        (the bit reservoir). A frame that borrows can't be copied on its own.
+        """
+        frame = self.frames[number]
+        offset = frame.offset + 4 + (0 if self.data[frame.offset + 1] & 1 else 2)  # After the CRC
+        return (self.data[offset] << 1) | (self.data[offset + 1] >> 7)
+
+    def reservoir(self, number):
+        """The bytes frame `number` borrows from the frames before it"""
+        needed = self.main_data_begin(number)
+        parts = []
+        while needed > 0 and number > 0:
+            number -= 1
+            frame = self.frames[number]
+            main_data = self.data[frame.offset + 4 + frame.side_info_length:frame.offset + frame.length]
+            parts.append(main_data[-needed:])
+            needed -= len(main_data)
+        return b"".join(reversed(parts))
+
+    def iter_frame_data(self, start_frame, count):
+        """
+        Yields (bytes, frame sizes) for count frames starting at start_frame, looping
+        back to the first frame at the end of the song. Frames that sit next to each
+        other in the file come out as one block.
+        """
+        total = len(self.frames)
+        position = start_frame % total
+        while count > 0:
+            frames = self.frames[position:position + count]
+            block_start = 0
+            for i in range(1, len(frames) + 1):
+                if i == len(frames) or frames[i].offset != frames[i - 1].offset + frames[i - 1].length:
+                    first, last = frames[block_start], frames[i - 1]
+                    yield (self.data[first.offset:last.offset + last.length],
+                           [frame.length for frame in frames[block_start:i]])
+                    block_start = i
+            count -= len(frames)
+            position = 0
+
+
+def read_encoder_delays(data):
+    """
+    Reads the encoder delay and padding (in samples) from an MP3's LAME tag. The
+    first frame of audio in the file starts `delay` samples before the song
+    actually does, and the last frame runs `padding` samples past its end.
+    Files without a LAME tag are assumed to have neither.
+    """
+    for frame in iter_mp3_frames(data, include_info=True):
+        tag = frame.offset + 4 + frame.side_info_length
+        if bytes(data[tag:tag + 4]) not in (b"Xing", b"Info"):
+            return 0, 0
+        flags = int.from_bytes(data[tag + 4:tag + 8], "big")
+        lame = tag + 8 + 4 * bool(flags & 1) + 4 * bool(flags & 2) + 100 * bool(flags & 4) + 4 * bool(flags & 8)
+        if bytes(data[lame:lame + 4]) not in (b"LAME", b"Lavf", b"Lavc"):
+            return 0, 0
+        delays = int.from_bytes(data[lame + 21:lame + 24], "big")
+        return delays >> 12, delays & 0xFFF
+    return 0, 0
+
+
+def carry_reservoir(frame, reservoir):
+    """
+    Rewrites a single MPEG-1 frame that doesn't borrow from the bit reservoir as a
+    320 kbps frame with `reservoir` at the very end. Decoders skip the extra
+    bytes when playing the frame itself, and the copied frame after it finds the
+    bytes it borrows right where it expects them.
+    """
+    header = parse_mp3_frame_header(frame, 0)
+    room = 144 * 320000 // header.sample_rate - len(frame) - len(reservoir)
+    if header.version != 1 or not frame[1] & 1 or room < 0:
+        raise CouldntEncodeError("Can't fit the bit reservoir into a re-encoded frame")
+    # Bitrate index 14 (320 kbps), no padding, the same sample rate and private bit
+    b2 = 0xE0 | (frame[2] & 0x0D)
+    return bytes(frame[:2]) + bytes([b2]) + bytes(frame[3:]) + bytes(room) + bytes(reservoir)
+
+
+def frame_copy_compatible(indexes):
+    """True if the MP3 files can be cut and joined frame by frame without re-encoding"""
+    indexes = list(indexes)
+    first = indexes[0]
+    return all(index.is_uniform() and index.version == 1
+               and index.sample_rate == first.sample_rate and index.channels == first.channels
+               for index in indexes)
+
+
+def crc16(data, crc=0):
+    """The CRC-16 used in LAME tags (polynomial 0x8005, bit-reversed)"""
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+    return crc
+
+
+class MP3Writer:
+    """
+    Writes MP3 frames to a file and then goes back and fills in a Xing/LAME
+    header frame, so players know the exact length (even when frames of different
+    bitrates are mixed) and can seek. The audio frames are expected to start
+    exactly at the start of the workout, so the LAME tag records no encoder delay.
+    Set padding to the number of silent samples the last frame was filled up with,
+    so gapless players stop where the workout really ends.
+    """
+
+    def __init__(self, path, sample_rate, channels):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.padding = 0
+        self.frame_sizes = []
+        self.file = open(path, "wb")
+        self.file.write(bytes(self.info_frame_length()))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
+
+    def write(self, data, frame_sizes):
+        self.file.write(data)
+        self.frame_sizes.extend(frame_sizes)
+        job = getattr(current_job, "job", None)
+        if job:
+            job.emit("bytes", "written", len(data))
+            if job.output:
+                job.output(bytes(data))
+
+    def info_frame_length(self):
+        # The header frame is written as a 128kbps MPEG-1 frame, which is big enough for the tag
+        return 144 * 128000 // self.sample_rate
+
+    def close(self):
+        self.file.seek(0)
+        self.file.write(self.info_frame())
+        self.file.close()
+
+    def info_frame(self):
+        length = self.info_frame_length()
+        total_bytes = length + sum(self.frame_sizes)
+        frame_count = len(self.frame_sizes)
+        vbr = len(set(self.frame_sizes)) > 2  # CBR frames only differ by the padding byte
+
+        header = bytes([0xFF, 0xFB, (9 << 4) | (MP3_SAMPLE_RATES[1].index(self.sample_rate) << 2),
+                        0xC0 if self.channels == 1 else 0x00])
+        side_info = bytes(17 if self.channels == 1 else 32)
+
+        # Table of contents: where in the file each percent of the duration starts
+        toc = bytearray(100)
+        offsets = [length]
+        for size in self.frame_sizes:
+            offsets.append(offsets[-1] + size)
+        for percent in range(100):
+            offset = offsets[percent * frame_count // 100] if frame_count else length
+            toc[percent] = min(255, offset * 256 // total_bytes)
+
+        xing = (b"Xing" if vbr else b"Info") + (0x0F).to_bytes(4, "big") + \
+            frame_count.to_bytes(4, "big") + total_bytes.to_bytes(4, "big") + bytes(toc) + \
+            (0).to_bytes(4, "big")
+
+        lame = bytearray(b"LAME3.100")
+        lame += bytes([0x00, 0x00]) + bytes(8) + bytes([0x00, 128])
+        lame += min(self.padding, 0xFFF).to_bytes(3, "big")  # 12 bits of encoder delay, 12 bits of padding
+        lame += bytes([0x00, 0x00]) + bytes(2)
+        lame += total_bytes.to_bytes(4, "big") + bytes(2)
+
+        frame = header + side_info + xing + bytes(lame)
+        frame += crc16(frame).to_bytes(2, "big")
+        return frame + bytes(length - len(frame))
+
+
+def write_file_atomically(path, data):
+    """Writes data to a temp file next to path and renames it, so readers never see half a file"""
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+class FileFingerprints:
+    """
+    Content hashes for files, remembered by (path, size, mtime) so a file is only
+    read and hashed again when it actually changes
+    """
+
+    def __init__(self, directory=CACHE_DIR):
+        self.index_path = os.path.join(directory, "fingerprints.json")
+        self.lock = threading.Lock()
+        try:
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+        except (OSError, ValueError):
+            self.index = {}
+
+    def content_hash(self, path):
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        stamp = "{0}:{1}".format(stat.st_size, stat.st_mtime_ns)
+        with self.lock:
+            entry = self.index.get(path)
+            if entry and entry["stamp"] == stamp:
+                return entry["hash"]
+
+        digest = hashlib.sha1()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+
+        with self.lock:
+            self.index[path] = {"stamp": stamp, "hash": digest.hexdigest()}
+            try:
+                os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+                write_file_atomically(self.index_path, json.dumps(self.index).encode())
+            except OSError:
+                pass  # Not being able to remember the hash just means hashing again next time
+        return digest.hexdigest()
+
+
+class MemoryLRU:
+    """
+    Decoded audio kept in memory, up to max_bytes in all. Adding something that
+    goes over the budget drops the least recently used entries (calling their
+    on_evict), but never the newest one, so a single song bigger than the budget
+    still works.
+    """
+
+    def __init__(self, max_bytes=DECODED_MEMORY_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (value, size, on_evict)
+        self.total = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """The value for key (now the most recently used), or None"""
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+
+    def put(self, key, value, size, on_evict=None):
+        evicted = []
+        with self.lock:
+            self.discard_locked(key)
+            self.entries[key] = (value, size, on_evict)
+            self.total += size
+            while self.total > self.max_bytes and len(self.entries) > 1:
+                _, (_, old_size, old_on_evict) = self.entries.popitem(last=False)
+                self.total -= old_size
+                evicted.append(old_on_evict)
+        for on_evict in evicted:
+            if on_evict:
+                on_evict()
+
+    def discard(self, key):
+        with self.lock:
+            self.discard_locked(key)
+
+    def discard_locked(self, key):
+        if key in self.entries:
+            self.total -= self.entries.pop(key)[1]
+
+
+class DecodedAudioCache:
+    """
+    Keeps decoded music around so each source file only goes through ffmpeg once.
+
+    Decoded PCM is written to disk as a raw file (plus a small JSON file with the
+    format) named after the file's content hash, and loaded back with mmap so
+    later runs don't decode at all and don't need to read the whole file into
+    memory up front. The disk cache is trimmed to max_bytes, oldest first.
+
+    The most recently used songs, and the windows LazySources decode, are kept in
+    memory up to memory_bytes between them, so a workout with a big pool of
+    tracks only ever has a few of them resident.
+
+    A song that open() handed out as a LazySource leaves a small ".opened" marker
+    file behind, so the next time it's opened (in this run or a later one) it gets
+    decoded whole and cached instead of decoding the same windows all over again.
+    """
+
+    def __init__(self, directory=None, max_bytes=DECODED_CACHE_MAX_BYTES,
+                 memory_bytes=DECODED_MEMORY_MAX_BYTES):
+        self.directory = directory or os.path.join(CACHE_DIR, "decoded")
+        self.max_bytes = max_bytes
+        self.memory = MemoryLRU(memory_bytes)
+        self.fingerprints = FileFingerprints(os.path.dirname(self.directory))
+        self.opened = set()  # Songs handed out as LazySources, in case the marker can't be written
+
+    def load(self, path):
+        """Returns the decoded AudioSegment for an MP3 file, decoding it only if needed"""
+        key = self.fingerprints.content_hash(path)
+        audio = self.memory.get(key)
+        report_event("cache", "music in memory", audio is not None)
+        if audio is not None:
+            return audio
+
+        audio = self.load_from_disk(key)
+        report_event("cache", "music on disk", audio is not None)
+        if audio is None:
+            return self.decode(key, path)
+        self.memory.put(key, audio, len(audio.raw_data))
+        return audio
+
+    def decode(self, key, path):
+        """Decodes a whole song with ffmpeg and caches it"""
+        with timed("decode"):
+            audio = AudioSegment.from_mp3(path)
+        report_event("bytes", "decoded", len(audio.raw_data))
+        audio = self.save_to_disk(key, audio, path) or audio
+        self.memory.put(key, audio, len(audio.raw_data))
+        return audio
+
+    def open(self, path):
+        """
+        Like load(), but the first time a song is used it comes back as a
+        LazySource, so only the parts the workout uses get decoded. After that
+        it's decoded whole, like load() does, since it's being used again.
+        """
+        key = self.fingerprints.content_hash(path)
+        audio = self.memory.get(key)
+        report_event("cache", "music in memory", audio is not None)
+        if audio is not None:
+            return audio
+        audio = self.load_from_disk(key)
+        report_event("cache", "music on disk", audio is not None)
+        if audio is not None:
+            self.memory.put(key, audio, len(audio.raw_data))
+            return audio
+        if key in self.opened or os.path.exists(self.marker_path(key)):
+            return self.decode(key, path)
+
+        index = MP3FrameIndex(path)
+        if not index.is_uniform():
+            return self.decode(key, path)  # Not something we can measure without decoding
+        self.opened.add(key)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            write_file_atomically(self.marker_path(key), b"")
+        except OSError:
+            pass  # It's still remembered for as long as this cache is around
+        return LazySource(path, index.decoded_frames(), index.sample_rate, index.channels,
+                          cache=self, cache_key=key, memory=self.memory)
+
+    def marker_path(self, key):
+        """The file that says a song has been opened as a LazySource before (see open())"""
+        return os.path.join(self.directory, key + ".opened")
+
+    def remove_marker(self, key):
+        """Called once the whole song is in the cache, so open() finds it there instead"""
+        self.opened.discard(key)
+        try:
+            os.remove(self.marker_path(key))
+        except OSError:
+            pass
+
+    def start_entry(self, key):
+        """Opens a temp file for a LazySource to write a full decode into (or None)"""
+        if os.path.exists(os.path.join(self.directory, key + ".pcm")):
+            return None
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            os.close(fd)
+            return open(temp_path, "wb")
+        except OSError:
+            return None
+
+    def finish_entry(self, key, cache_file, audio, keep):
+        """Turns a LazySource's full decode into a cache entry, or throws it away"""
+        cache_file.close()
+        info = {"frame_rate": audio.frame_rate, "channels": audio.channels,
+                "sample_width": audio.sample_width, "source": os.path.abspath(audio.path)}
+        try:
+            if keep:
+                os.replace(cache_file.name, os.path.join(self.directory, key + ".pcm"))
+                write_file_atomically(os.path.join(self.directory, key + ".json"), json.dumps(info).encode())
+                self.remove_marker(key)
+                self.trim(keep=key)
+            else:
+                os.remove(cache_file.name)
+        except OSError:
+            pass
+
+    def load_from_disk(self, key):
+        pcm_path = os.path.join(self.directory, key + ".pcm")
+        try:
+            with open(os.path.join(self.directory, key + ".json")) as f:
+                info = json.load(f)
+            with open(pcm_path, "rb") as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    data = b""
+                else:
+                    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            os.utime(pcm_path)  # Mark it as recently used
+        except (OSError, ValueError):
+            return None
+        return AudioSegment(data=data, sample_width=info["sample_width"],
+                            frame_rate=info["frame_rate"], channels=info["channels"])
+
+    def save_to_disk(self, key, audio, source_path):
+        """Writes the decoded audio to the cache and returns the memory-mapped copy"""
+        info = {"frame_rate": audio.frame_rate, "channels": audio.channels,
+                "sample_width": audio.sample_width, "source": os.path.abspath(source_path)}
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            write_file_atomically(os.path.join(self.directory, key + ".pcm"), audio.raw_data)
+            write_file_atomically(os.path.join(self.directory, key + ".json"), json.dumps(info).encode())
+            self.remove_marker(key)
+            self.trim(keep=key)
+        except OSError:
+            return None  # Caching is best-effort, the decoded audio is still fine to use
+        return self.load_from_disk(key)
+
+    def trim(self, keep=None):
+        """Removes the least recently used entries until the cache fits in max_bytes"""
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".pcm"):
+                path = os.path.join(self.directory, name)
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, name[:-4]))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            for extension in (".pcm", ".json"):
+                try:
+                    os.remove(os.path.join(self.directory, key + extension))
+                except OSError:
+                    pass  # Still mapped somewhere (Windows), try again next time
+            total -= size
+
+
+def segment_to_array(audio):
+    """An AudioSegment's samples as a float32 array shaped (frames, channels)"""
+    samples = np.frombuffer(audio.raw_data, dtype=SAMPLE_TYPES[audio.sample_width])
+    return samples.reshape(-1, audio.channels).astype(np.float32)
+
+
+def array_to_bytes(samples, sample_width):
+    """Raw PCM for a float array, rounded and clipped to the sample width"""
+    sample_type = SAMPLE_TYPES[sample_width]
+    limits = np.iinfo(sample_type)
+    return np.clip(np.round(samples), limits.min, limits.max).astype(sample_type).tobytes()
+
+
+def array_to_segment(samples, like):
+    """Turns a (frames, channels) array back into an AudioSegment in the same format as `like`"""
+    return like._spawn(array_to_bytes(samples, like.sample_width))
+
+
+def apply_gain(data, gain_db, sample_width):
+    """Raw PCM turned up or down by gain_db"""
+    samples = np.frombuffer(data, dtype=SAMPLE_TYPES[sample_width]).astype(np.float32)
+    return array_to_bytes(samples * 10 ** (gain_db / 20), sample_width)
+
+
+def wsola(signals, speed, frame_rate):
+    """
+    Time-stretches float arrays shaped (frames, channels) by `speed` without
+    changing their pitch, using WSOLA (waveform similarity overlap-add). The input
+    is cut into overlapping windows that are laid down `speed` times closer
+    together (or further apart), and each window is nudged by up to a quarter of
+    a window so its waveform lines up with what's already been written, which
+    avoids the clicks and phasing of plain chunk-and-crossfade.
+
+    All the signals (same frame rate and channels) are processed together: the
+    loop runs once per window position, and each step handles every signal that
+    is still going at once. Returns a list of arrays, each round(len / speed)
+    frames long.
+    """
+    if not signals:
+        return []
+    window = max(2, int(frame_rate * STRETCH_WINDOW_MS / 1000) // 2 * 2)
+    hop = window // 2
+    tolerance = hop // 2
+    # The best alignment is found on every `stride`th sample first, then refined
+    stride = max(1, frame_rate // 8000)
+    channels = signals[0].shape[1]
+
+    # Longest first, so the signals still being worked on are always the first rows
+    order = sorted(range(len(signals)), key=lambda n: -len(signals[n]))
+    out_lengths = [int(round(len(signals[n]) / speed)) for n in order]
+    last_steps = np.array([length // hop + 1 for length in out_lengths])
+    steps = last_steps[0] + 1
+
+    # Pad every signal to the same length, with room to search past both ends
+    padded_length = 2 * tolerance + int(steps * hop * speed) + 2 * window + stride
+    padded = np.zeros((len(signals), padded_length, channels), dtype=np.float32)
+    for row, number in enumerate(order):
+        padded[row, tolerance:tolerance + len(signals[number])] = signals[number]
+    mono = padded.mean(axis=2)
+
+    # A periodic Hann window, which adds up to exactly 1 at 50% overlap
+    fade = np.sin(np.pi * np.arange(window) / window, dtype=np.float32) ** 2
+    output = np.zeros((len(signals), steps * hop + window, channels), dtype=np.float32)
+    coverage = np.zeros(steps * hop + window, dtype=np.float32)
+
+    # Every window of every signal, as views (nothing is copied until it's indexed)
+    windows = np.lib.stride_tricks.sliding_window_view(mono, window, axis=1)
+    active_counts = [int(np.count_nonzero(last_steps >= step)) for step in range(steps)]
+    fine_lags = np.arange(-stride, stride + 1)
+
+    position = np.full(len(signals), tolerance)
+    for step, active in enumerate(active_counts):
+        rows = np.arange(active)
+        nominal = tolerance + int(round(step * hop * speed))
+        if step:
+            # Pick the window near `nominal` that best continues the previous one
+            follow = windows[rows, position[:active] + hop]
+            lowest = nominal - tolerance
+            candidates = windows[:active, lowest:nominal + tolerance + 1:stride, ::stride]
+            scores = np.einsum("bkw,bw->bk", candidates, follow[:, ::stride])
+            lags = lowest + scores.argmax(axis=1)[:, None] * stride + fine_lags
+            np.clip(lags, lowest, nominal + tolerance, out=lags)
+            scores = np.einsum("bkw,bw->bk", windows[rows[:, None], lags], follow)
+            position[:active] = lags[rows, scores.argmax(axis=1)]
+        start = step * hop
+        chosen = padded[rows[:, None], position[:active, None] + np.arange(window)]
+        output[:active, start:start + window] += chosen * fade[:, None]
+        coverage[start:start + window] += fade
+
+    # Only the first half window isn't covered twice; undo its fade-in
+    output /= np.maximum(coverage, 1e-3)[:, None]
+    stretched = [None] * len(signals)
+    for row, number in enumerate(order):
+        stretched[number] = output[row, :out_lengths[row]]
+    return stretched
+
+
+def time_stretch(segments, speed):
+    """
+    Speeds up (or slows down, for speed < 1) a list of AudioSegments without
+    changing their pitch, and returns the new list. Segments in the same format
+    are stretched together in one batch.
+    """
+    stretched = [None] * len(segments)
+    groups = {}
+    for number, audio in enumerate(segments):
+        groups.setdefault((audio.frame_rate, audio.channels), []).append(number)
+    for (frame_rate, _), numbers in groups.items():
+        signals = wsola([segment_to_array(segments[n]) for n in numbers], speed, frame_rate)
+        for number, signal in zip(numbers, signals):
+            stretched[number] = array_to_segment(signal, segments[number])
+    return stretched
+
+
+class GTTSBackend:
+    """Google Text-to-Speech (needs an internet connection). voice is the accent's domain, e.g. "co.uk" """
+    name = "gtts"
+    label = "Google (online)"
+
+    def is_available(self):
+        try:
+            import gtts  # noqa: F401
+        except ImportError:
+            return False
+        return True
+
+    def synthesize(self, text, language, voice, path):
+        from gtts import gTTS
+        path += ".mp3"
+        gTTS(text=text, lang=language, tld=voice or "com", slow=False).save(path)
+        return AudioSegment.from_mp3(path)
+
+
+class EspeakBackend:
+    """espeak / espeak-ng run locally, no network needed. voice is an espeak voice name"""
+    name = "espeak"
+    label = "espeak (offline)"
+
+    def executable(self):
+        return shutil.which("espeak-ng") or shutil.which("espeak")
+
+    def is_available(self):
+        return self.executable() is not None
+
+    def synthesize(self, text, language, voice, path):
+        path += ".wav"
+        subprocess.run([self.executable(), "-v", voice or language, "-w", path, text],
+                       check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        return AudioSegment.from_wav(path)
+
+
+class Pyttsx3Backend:
+    """pyttsx3 uses the voices built into the OS, no network needed. voice is a pyttsx3 voice id"""
+    name = "pyttsx3"
+    label = "pyttsx3 (offline)"
+    lock = threading.Lock()  # pyttsx3 engines can't be used from several threads at once
+
+    def is_available(self):
+        try:
+            import pyttsx3  # noqa: F401
+        except ImportError:
+            return False
+        return True
+
+    def synthesize(self, text, language, voice, path):
+        import pyttsx3
+        path += ".wav"
+        with self.lock:
+            engine = pyttsx3.init()
+            if voice:
+                engine.setProperty("voice", voice)
+            engine.save_to_file(text, path)
+            engine.runAndWait()
+        return AudioSegment.from_file(path)
+
+
+TTS_BACKENDS = OrderedDict((backend.name, backend) for backend in
+                           (GTTSBackend(), EspeakBackend(), Pyttsx3Backend()))
+
+
+class VoiceClipCache:
+    """
+    Makes the spoken announcements, doing as little text-to-speech work as possible.
+
+    Finished clips (already sped up) are stored on disk as WAV files named after a
+    hash of the text, language, engine, voice and speed, and kept in memory for the
+    session, so fixed phrases like "Begin warm-up." are only ever synthesized once.
+    Clips that aren't cached yet are synthesized at the same time on a thread pool.
+
+    backend is a name from TTS_BACKENDS (or an engine object), or "auto" to use the
+    first engine that is installed and falls back to the next one if it fails (e.g.
+    gTTS with no network).
+    """
+
+    def __init__(self, directory=None, language="en", voice="", speed=VOICE_SPEED):
+        self.directory = directory or os.path.join(CACHE_DIR, "voice")
+        self.language = language
+        self.voice = voice
+        self.speed = speed
+        self.memory = {}
+        self.lock = threading.Lock()
+
+    def backends_for(self, backend):
+        if not isinstance(backend, str):
+            return [backend]  # An engine object that isn't in TTS_BACKENDS, like the benchmark's
+        if backend == "auto":
+            return [b for b in TTS_BACKENDS.values() if b.is_available()]
+        if backend not in TTS_BACKENDS:
+            raise ValueError("Unknown text-to-speech engine: {0} (choose from auto, {1})".format(
+                backend, ", ".join(TTS_BACKENDS)))
+        engine = TTS_BACKENDS[backend]
+        if not engine.is_available():
+            raise RuntimeError("The {0} voice isn't installed. Install it or choose another "
+                               "voice.".format(engine.label))
+        return [engine]
+
+    def clip_key(self, text, backend):
+        description = json.dumps([text, self.language, backend.name, self.voice, self.speed, "wsola"])
+        return hashlib.sha1(description.encode("utf-8")).hexdigest()
+
+    def get_clips(self, texts, backend="auto"):
+        """Takes a dict of name -> text and returns a dict of name -> AudioSegment"""
+        backends = self.backends_for(backend)
+        if not backends:
+            raise RuntimeError("No text-to-speech engine is installed. "
+                               "Install gTTS, espeak or pyttsx3.")
+
+        clips = {}
+        missing = {}
+        for name, text in texts.items():
+            for engine in backends:
+                clip = self.cached_clip(self.clip_key(text, engine))
+                if clip is not None:
+                    clips[name] = clip
+                    break
+            else:
+                missing[name] = text
+            report_event("cache", "voice clips", name in clips)
+
+        for engine in backends:
+            if not missing:
+                break
+            try:
+                clips.update(self.synthesize_all(missing, engine))
+                missing = {}
+            except Exception:
+                if engine is backends[-1]:
+                    raise
+        return clips
+
+    def cached_clip(self, key):
+        with self.lock:
+            if key in self.memory:
+                return self.memory[key]
+        try:
+            clip = AudioSegment.from_wav(os.path.join(self.directory, key + ".wav"))
+        except (OSError, ValueError, EOFError):
+            return None
+        with self.lock:
+            self.memory[key] = clip
+        return clip
+
+    def synthesize_all(self, texts, backend):
+        """
+        Synthesizes several clips at once, since most of the time is spent waiting
+        on the engine, then speeds them all up in one batch
+        """
+        with timed("tts"), ThreadPoolExecutor(max_workers=min(VOICE_WORKERS, len(texts))) as pool:
+            futures = {name: pool.submit(self.synthesize, text, backend)
+                       for name, text in texts.items()}
+            raw = {name: future.result() for name, future in futures.items()}
+        names = list(raw)
+        clips = [raw[name] for name in names]
+        if self.speed != 1:
+            with timed("stretch"):
+                clips = time_stretch(clips, self.speed)
+        return {name: self.store(texts[name], backend, clip) for name, clip in zip(names, clips)}
+
+    def synthesize(self, text, backend):
+        """The engine's clip for text, before it's sped up"""
+        temp_dir = tempfile.mkdtemp()
+        try:
+            return backend.synthesize(text, self.language, self.voice, os.path.join(temp_dir, "clip"))
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    def store(self, text, backend, clip):
+        """Keeps a finished clip in memory and on disk"""
+        key = self.clip_key(text, backend)
+        with self.lock:
+            self.memory[key] = clip
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            os.close(fd)
+            clip.export(temp_path, format="wav")
+            os.replace(temp_path, os.path.join(self.directory, key + ".wav"))
+        except OSError:
+            pass  # The clip is still fine to use, it just won't be cached
+        return clip
+
+
+def format_time_for_speech(time_string):
+    """Converts time format (4:00) into natural speech (4 minutes)"""
+    parts = time_string.split(":")
+    minutes = int(parts[0])
+    seconds = int(parts[1])
+    
+    if seconds == 0:
+        return f"{minutes} minutes"
+    else:
+        return f"{minutes} minutes and {seconds} seconds"
+
+
+class TrackAnalysis:
+    """
+    What the workout needs to know about a song, worked out once from its decoded
+    audio (see TrackAnalysisIndex). Times are in milliseconds and levels in dB
+    relative to full scale.
+
+      loudness  the RMS level every HOP_MS
+      energy    the song's power in every ENERGY_WINDOW_MS, relative to its average power
+      onsets    where notes and drum hits start
+      tempo     beats per minute (0 if no beat was found), and beats, the beat grid
+      level     how loud the song is overall, leaving out quiet parts; peak is its loudest sample
+    """
+    VERSION = 1  # Bump this when the analysis changes, so old sidecars get redone
+    HOP_MS = 50
+    ONSET_HOP_MS = 10
+    ENERGY_WINDOW_MS = 1000
+    SILENCE_DB = -60
+    FFT_SIZE = 1024
+
+    def __init__(self, loudness, energy, onsets, tempo, beats, level, peak):
+        self.loudness = np.asarray(loudness, dtype=np.float32)
+        self.energy = np.asarray(energy, dtype=np.float32)
+        self.onsets = np.asarray(onsets, dtype=np.int64)
+        self.tempo = tempo
+        self.beats = np.asarray(beats, dtype=np.int64)
+        self.level = level
+        self.peak = peak
+
+    @classmethod
+    def from_dict(cls, values):
+        if values.get("version") != cls.VERSION:
+            raise ValueError("Analysis from a different version")
+        return cls(values["loudness"], values["energy"], values["onsets"], values["tempo"],
+                   values["beats"], values["level"], values["peak"])
+
+    def to_dict(self):
+        return {"version": self.VERSION, "level": self.level, "peak": self.peak, "tempo": self.tempo,
+                "beats": self.beats.tolist(), "onsets": self.onsets.tolist(),
+                "loudness": np.round(self.loudness, 1).tolist(), "energy": np.round(self.energy, 3).tolist()}
+
+    @classmethod
+    def from_audio(cls, audio):
+        """Analyses an AudioSegment (or anything read_frames can read)"""
+        power, flux, peak = cls.measure(audio)
+        if len(power) == 0:
+            return cls([], [], [], 0, [], cls.SILENCE_DB * 2, cls.SILENCE_DB * 2)
+
+        def window_means(values, size):
+            starts = np.arange(0, len(values), size)
+            return np.add.reduceat(values, starts) / np.diff(np.append(starts, len(values)))
+
+        loudness = 10 * np.log10(window_means(power, cls.HOP_MS // cls.ONSET_HOP_MS) + 1e-12)
+        energy = window_means(power, cls.ENERGY_WINDOW_MS // cls.ONSET_HOP_MS) / max(power.mean(), 1e-12)
+
+        # Overall level: the average power of 400ms blocks, leaving out silence and
+        # anything more than 10dB below the average (quiet intros, breaks), like EBU R128
+        blocks = window_means(power, 400 // cls.ONSET_HOP_MS)
+        blocks = blocks[blocks > 10 ** (cls.SILENCE_DB / 10)]
+        if len(blocks):
+            blocks = blocks[blocks > blocks.mean() / 10]
+        level = 10 * np.log10(blocks.mean()) if len(blocks) else cls.SILENCE_DB * 2
+
+        onsets = cls.find_onsets(flux)
+        tempo, beats = cls.find_beats(flux, loudness)
+        return cls(loudness, energy, onsets * cls.ONSET_HOP_MS, tempo, beats * cls.ONSET_HOP_MS,
+                   round(float(level), 2), round(float(20 * np.log10(max(peak, 1e-6))), 2))
+
+    @classmethod
+    def measure(cls, audio):
+        """
+        The power and spectral flux (how much the spectrum just got louder, which
+        jumps at every note and drum hit) of every ONSET_HOP_MS of the song, and its
+        peak sample, reading the song a block at a time
+        """
+        hop = audio.frame_rate * cls.ONSET_HOP_MS // 1000
+        overlap = cls.FFT_SIZE - hop
+        full_scale = float(np.iinfo(SAMPLE_TYPES[audio.sample_width]).max)
+        total_hops = int(audio.frame_count()) // hop
+        block_hops = 2000
+
+        window = np.hanning(cls.FFT_SIZE).astype(np.float32)
+        before = np.zeros(overlap, dtype=np.float32)  # The end of the previous block, for the first frames
+        last_spectrum = None
+        powers, fluxes, peak = [], [], 0.0
+        for first_hop in range(0, total_hops, block_hops):
+            hops = min(block_hops, total_hops - first_hop)
+            samples = np.frombuffer(read_frames(audio, first_hop * hop, hops * hop),
+                                    dtype=SAMPLE_TYPES[audio.sample_width]).reshape(-1, audio.channels)
+            peak = max(peak, float(np.abs(samples).max()) / full_scale)
+            mono = samples.astype(np.float32).mean(axis=1) / full_scale
+            powers.append((mono.reshape(hops, hop) ** 2).mean(axis=1))
+
+            # One FFT frame ending at the end of every hop
+            padded = np.concatenate([before, mono])
+            frames = np.lib.stride_tricks.sliding_window_view(padded, cls.FFT_SIZE)[::hop][:hops]
+            spectrum = np.log1p(100 * np.abs(np.fft.rfft(frames * window, axis=1)))
+            previous = np.vstack([spectrum[:1] if last_spectrum is None else last_spectrum, spectrum[:-1]])
+            fluxes.append(np.maximum(spectrum - previous, 0).sum(axis=1))
+            before = padded[-overlap:]
+            last_spectrum = spectrum[-1:]
+        if not powers:
+            return np.zeros(0), np.zeros(0), peak
+        return np.concatenate(powers), np.concatenate(fluxes), peak
+
+    @classmethod
+    def find_onsets(cls, flux):
+        """Hop numbers where the flux peaks clearly above its surroundings"""
+        if len(flux) < 3 or flux.max() <= 0:
+            return np.zeros(0, dtype=np.int64)
+        flux = flux / np.percentile(flux, 99)
+        width = min(51, len(flux))  # Half a second either side, or the whole of a very short song
+        surroundings = np.convolve(flux, np.ones(width) / width, mode="same")
+        padded = np.pad(flux, 3, mode="edge")
+        local_max = np.lib.stride_tricks.sliding_window_view(padded, 7).max(axis=1)
+        candidates = np.flatnonzero((flux >= local_max) & (flux > surroundings + 0.1))
+        onsets = []
+        for hop in candidates:
+            if not onsets or hop - onsets[-1] >= 5:  # At least 50ms apart
+                onsets.append(hop)
+        return np.array(onsets, dtype=np.int64)
+
+    @classmethod
+    def find_beats(cls, flux, loudness):
+        """
+        The tempo and the beat grid (as hop numbers): the beat period is the
+        strongest repetition in the flux between 60 and 200 BPM (leaning towards
+        120 BPM), lined up with the flux peaks, and each beat is then nudged onto
+        the nearest peak
+        """
+        shortest, longest = 60000 // 200 // cls.ONSET_HOP_MS, 60000 // 60 // cls.ONSET_HOP_MS
+        if len(flux) < longest * 4 or flux.max() <= 0:
+            return 0, np.zeros(0, dtype=np.int64)
+        centered = flux - flux.mean()
+        spectrum = np.fft.rfft(centered, 2 * len(centered))
+        autocorrelation = np.fft.irfft(np.abs(spectrum) ** 2)[:longest + 2]
+        lags = np.arange(shortest, longest + 1)
+        bpm = 60000 / (lags * cls.ONSET_HOP_MS)
+        scores = autocorrelation[lags] * np.exp(-0.5 * np.log2(bpm / 120) ** 2)
+        best = int(np.argmax(scores))
+        if scores[best] <= 0:
+            return 0, np.zeros(0, dtype=np.int64)
+        period = float(lags[best])
+        if 0 < best < len(scores) - 1:
+            # Parabolic interpolation between the neighbouring lags for a fractional period
+            left, middle, right = autocorrelation[lags[best] - 1:lags[best] + 2]
+            divisor = left - 2 * middle + right
+            if divisor < 0:
+                period += 0.5 * (left - right) / divisor
+
+        beat_count = int((len(flux) - 1) / period) + 1
+        phases = np.arange(int(period))
+        grid = np.round(phases[:, None] + np.arange(beat_count) * period).astype(np.int64)
+        phase_scores = np.where(grid < len(flux), flux[np.minimum(grid, len(flux) - 1)], 0).sum(axis=1)
+        beats = grid[int(np.argmax(phase_scores))]
+        beats = beats[beats < len(flux)]
+
+        # Nudge each beat onto the strongest flux within 40ms of it
+        reach = 4
+        padded = np.pad(flux, reach)
+        nearby = np.lib.stride_tricks.sliding_window_view(padded, 2 * reach + 1)[beats]
+        beats = beats + np.argmax(nearby, axis=1) - reach
+        # The nudge can push the first or last beat off either end of the song
+        beats = np.unique(np.clip(beats, 0, len(flux) - 1))
+
+        # No beats in silence
+        hops_per_loudness = cls.HOP_MS // cls.ONSET_HOP_MS
+        audible = loudness[np.minimum(beats // hops_per_loudness, len(loudness) - 1)] > cls.SILENCE_DB
+        return round(60000 / (float(period) * cls.ONSET_HOP_MS), 1), beats[audible]
+
+    def first_sound(self):
+        """Where the song starts making noise, after any silence at the beginning"""
+        audible = np.flatnonzero(self.loudness > self.SILENCE_DB)
+        return int(audible[0]) * self.HOP_MS if len(audible) else 0
+
+    def beat_at_or_after(self, position):
+        """The first beat at or after position, or position itself if there are no beats after it"""
+        index = np.searchsorted(self.beats, position)
+        return int(self.beats[index]) if index < len(self.beats) else position
+
+    def nearest_beat(self, position):
+        if len(self.beats) == 0:
+            return position
+        return int(self.beats[np.argmin(np.abs(self.beats - position))])
+
+    def energetic_start(self, duration):
+        """
+        Where the most energetic `duration` of the song starts (on a beat), e.g. the
+        chorus or the drop. If the song isn't much longer than that, it's the start.
+        """
+        windows = -(-duration // self.ENERGY_WINDOW_MS)
+        if windows >= len(self.energy):
+            return self.beat_at_or_after(self.first_sound())
+        totals = np.convolve(self.energy, np.ones(windows), mode="valid")
+        return self.nearest_beat(int(np.argmax(totals)) * self.ENERGY_WINDOW_MS)
+
+
+class TrackAnalysisIndex:
+    """
+    The TrackAnalysis of every song, worked out the first time the song is used and
+    kept as a small JSON sidecar named after the song's content hash (next to the
+    decoded music cache), so later workouts just read it back. Analysing a song
+    decodes all of it, through the DecodedAudioCache, so that isn't wasted either.
+    """
+
+    def __init__(self, audio_cache, directory=None):
+        self.audio_cache = audio_cache
+        self.directory = directory or os.path.join(os.path.dirname(audio_cache.directory), "analysis")
+        self.memory = {}
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        key = self.audio_cache.fingerprints.content_hash(path)
+        with self.lock:
+            analysis = self.memory.get(key)
+        if analysis is None:
+            analysis = self.load(key)
+        report_event("cache", "track analysis", analysis is not None)
+        if analysis is None:
+            audio = self.audio_cache.load(path)
+            with timed("analyze"):
+                analysis = TrackAnalysis.from_audio(audio)
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                write_file_atomically(os.path.join(self.directory, key + ".json"),
+                                      json.dumps(analysis.to_dict()).encode())
+            except OSError:
+                pass  # Analysed again next time
+        with self.lock:
+            self.memory[key] = analysis
+        return analysis
+
+    def load(self, key):
+        try:
+            with open(os.path.join(self.directory, key + ".json")) as f:
+                return TrackAnalysis.from_dict(json.load(f))
+        except (OSError, ValueError, KeyError):
+            return None
+
+
+def find_tracks(path):
+    """
+    The MP3s for one slot of the workout: path itself, every MP3 in it if it's a
+    folder (in name order), or the tracks listed in it if it's an .m3u playlist
+    """
+    if os.path.isdir(path):
+        tracks = sorted((os.path.join(path, name) for name in os.listdir(path)
+                         if name.lower().endswith(".mp3")), key=str.casefold)
+    elif path.lower().endswith(PLAYLIST_EXTENSIONS):
+        with open(path, encoding="utf-8-sig" if path.lower().endswith(".m3u8") else None,
+                  errors="replace") as f:
+            lines = [line.strip() for line in f]
+        tracks = [os.path.join(os.path.dirname(path), line) for line in lines
+                  if line and not line.startswith("#")]
+    else:
+        return [path]
+    if not tracks:
+        raise ValueError(f"No MP3 files found in {path}")
+    return tracks
+
+
+class TrackPool:
+    """
+    The music for one slot of the workout ("intense" or "moderate"): a single
+    song, a folder or a playlist (see find_tracks). Tracks are only opened, with
+    open_track(path), when the timeline gets to them, so a big pool costs nothing
+    for the tracks a workout never reaches. open_track returns something with a
+    length in milliseconds: an AudioSegment, LazySource or MP3FrameIndex.
+
+    analyze(path), if given, returns a track's TrackAnalysis. With align, tracks
+    then start on a beat instead of at the very beginning (see start()).
+    """
+
+    def __init__(self, slot, path, open_track, analyze=None, align=False):
+        self.slot = slot
+        self.paths = find_tracks(path)
+        self.open_track = open_track
+        self.analyze = analyze
+        self.align = align
+        self.opened = OrderedDict()  # Track name -> what open_track returned
+        self.analysed = {}  # Track number -> TrackAnalysis
+
+    def __len__(self):
+        return len(self.paths)
+
+    def name(self, number):
+        # A single song keeps the slot's name, so one-song workouts look like they always have
+        return self.slot if len(self.paths) == 1 else f"{self.slot} {number + 1}"
+
+    def track(self, number):
+        """Opens track `number` (if it isn't already) and returns its name"""
+        name = self.name(number)
+        if name not in self.opened:
+            audio = self.open_track(self.paths[number])
+            if len(audio) <= 0:
+                raise ValueError(f"{self.paths[number]} doesn't have any audio in it")
+            self.opened[name] = audio
+        return name
+
+    def length(self, number):
+        return len(self.opened[self.track(number)])
+
+    def analysis(self, number):
+        if not self.analyze:
+            return None
+        if number not in self.analysed:
+            self.analysed[number] = self.analyze(self.paths[number])
+        return self.analysed[number]
+
+    def analyses(self):
+        """Track name -> TrackAnalysis for every track that's been opened"""
+        return OrderedDict((self.name(number), self.analysis(number))
+                           for number in range(len(self.paths)) if self.name(number) in self.opened)
+
+    def start(self, number, position=0):
+        """
+        Where to play track `number` from, at or after position: with align that's
+        the next beat (skipping any silence at the start of the song), otherwise
+        just position
+        """
+        if not (self.align and self.analyze):
+            return position
+        analysis = self.analysis(number)
+        return analysis.beat_at_or_after(max(position, analysis.first_sound()))
+
+    def energetic_start(self, number, duration):
+        """Like start(), but with align it's the most energetic `duration` of the track"""
+        if not (self.align and self.analyze):
+            return 0
+        return self.analysis(number).energetic_start(duration)
+
+
+class TrackCursor:
+    """
+    Hands out one slot's music an interval at a time. In cycle-through mode it
+    carries on from wherever the last interval stopped and moves on to the next
+    track when one runs out, like a playlist. Otherwise every interval starts at
+    the beginning of the next track in the pool (so a single song just restarts
+    every time), or, if the pool aligns its tracks, on a beat (in the track's most
+    energetic part, with energetic).
+    """
+
+    def __init__(self, pool, energetic=False):
+        self.pool = pool
+        self.energetic = energetic
+        self.track = 0
+        self.position = 0  # Milliseconds into the current track
+
+    def add_interval(self, timeline, duration, cycle_mode):
+        if not cycle_mode:
+            track = self.pool.track(self.track)
+            if self.energetic:
+                offset = self.pool.energetic_start(self.track, duration)
+            else:
+                offset = self.pool.start(self.track)
+            timeline.add_music(track, offset, duration)
+            self.track = (self.track + 1) % len(self.pool)
+            return
+        if len(self.pool) == 1:
+            # One song loops around seamlessly
+            self.position = self.pool.start(0, self.position)
+            timeline.add_music(self.pool.track(0), self.position, duration)
+            self.position = (self.position + duration) % self.pool.length(0)
+            return
+        self.position = self.pool.start(self.track, self.position)
+        while duration > 0:
+            part = min(duration, self.pool.length(self.track) - self.position)
+            timeline.add_music(self.pool.track(self.track), self.position, part)
+            duration -= part
+            self.position += part
+            if self.position >= self.pool.length(self.track):
+                self.track = (self.track + 1) % len(self.pool)
+                self.position = self.pool.start(self.track)
+
+
+class WorkoutSettings:
+    """
+    Everything that describes one workout, as plain values, so it can be handed to
+    a worker thread (or another process) without touching the GUI. Times are in
+    seconds. voice_backend is a name from TTS_BACKENDS, or "auto". match_levels
+    plays every song at the same loudness, and align_to_beats starts the music on
+    beats (and intense intervals in the most energetic part of the song).
+    """
+
+    def __init__(self, intense_path, moderate_path, method="Tabata", rounds=None,
+                 warmup=180, cooldown=180, cycle_mode=False, custom_work=30, custom_recovery=30,
+                 voice_backend="auto", lossless_copy=True, round_cues=False,
+                 match_levels=False, align_to_beats=False):
+        if method not in WORKOUT_METHODS:
+            raise ValueError("Unknown workout method: {0}".format(method))
+        self.intense_path = intense_path
+        self.moderate_path = moderate_path
+        self.method = method
+        self.rounds = rounds if rounds is not None else WORKOUT_METHODS[method]["default_rounds"]
+        self.warmup = warmup
+        self.cooldown = cooldown
+        self.cycle_mode = cycle_mode
+        self.custom_work = custom_work
+        self.custom_recovery = custom_recovery
+        self.voice_backend = voice_backend
+        self.lossless_copy = lossless_copy
+        self.round_cues = round_cues
+        self.match_levels = match_levels
+        self.align_to_beats = align_to_beats
+
+    # How WorkoutSettings fields are spelled in batch manifests and on the command line
+    FIELD_NAMES = {"intense": "intense_path", "moderate": "moderate_path", "method": "method",
+                   "rounds": "rounds", "warmup": "warmup", "cooldown": "cooldown", "cycle": "cycle_mode",
+                   "work": "custom_work", "recovery": "custom_recovery", "voice": "voice_backend",
+                   "lossless": "lossless_copy", "cues": "round_cues", "levels": "match_levels",
+                   "beats": "align_to_beats"}
+    # The whole-number fields and the range each can take (the same as the GUI's spinboxes)
+    LIMITS = {"rounds": (1, 100), "warmup": (0, 600), "cooldown": (0, 600), "work": (1, 300), "recovery": (1, 300)}
+    SWITCHES = ("cycle", "lossless", "cues", "levels", "beats")
+
+    @classmethod
+    def from_dict(cls, values, base_dir=None):
+        """
+        Builds settings from a manifest entry like {"intense": "a.mp3", "moderate": "b.mp3",
+        "method": "Tabata", "rounds": 8}. Relative song paths are taken relative to base_dir.
+        Raises ValueError for anything the GUI wouldn't let through either.
+        """
+        unknown = set(values) - set(cls.FIELD_NAMES) - {"output"}
+        if unknown:
+            raise ValueError("Unknown workout setting(s): {0}".format(", ".join(sorted(unknown))))
+        for required in ("intense", "moderate"):
+            if not values.get(required):
+                raise ValueError("Missing '{0}' music file".format(required))
+            if not isinstance(values[required], str):
+                raise ValueError("'{0}' must be a file name, not {1!r}".format(required, values[required]))
+        for key, (low, high) in cls.LIMITS.items():
+            value = values.get(key, low)
+            if isinstance(value, bool) or not isinstance(value, int) or not low <= value <= high:
+                raise ValueError("'{0}' must be a whole number from {1} to {2}, not {3!r}".format(
+                    key, low, high, value))
+        for key in cls.SWITCHES:
+            if not isinstance(values.get(key, False), bool):
+                raise ValueError("'{0}' must be true or false, not {1!r}".format(key, values[key]))
+        method, voice = values.get("method", "Tabata"), values.get("voice", "auto")
+        if not isinstance(method, str) or method not in WORKOUT_METHODS:
+            raise ValueError("Unknown workout method: {0!r} (choose from {1})".format(
+                method, ", ".join(WORKOUT_METHODS)))
+        if not isinstance(voice, str) or voice not in ("auto", *TTS_BACKENDS):
+            raise ValueError("Unknown voice: {0!r} (choose from auto, {1})".format(voice, ", ".join(TTS_BACKENDS)))
+        kwargs = {cls.FIELD_NAMES[key]: value for key, value in values.items() if key in cls.FIELD_NAMES}
+        for key in ("intense_path", "moderate_path"):
+            kwargs[key] = os.path.normpath(os.path.join(base_dir or "", os.path.expanduser(kwargs[key])))
+        return cls(**kwargs)
+
+    def can_copy_frames(self):
+        """
+        False if the music has to be decoded whatever the MP3s are like: round cues
+        are mixed over it, and matching levels changes its volume
+        """
+        return self.lossless_copy and not self.round_cues and not self.match_levels
+
+    def work_seconds(self):
+        return self.custom_work if self.method == "Custom" else WORKOUT_METHODS[self.method]["work"]
+
+    def recovery_seconds(self):
+        return self.custom_recovery if self.method == "Custom" else WORKOUT_METHODS[self.method]["recovery"]
+
+    def workout_length(self):
+        """The length of the intervals (excluding warm-up/cool-down) as M:SS"""
+        total_seconds = (self.work_seconds() + self.recovery_seconds()) * self.rounds
+        return f"{total_seconds // 60}:{total_seconds % 60:02d}"
+
+    def voice_texts(self):
+        """Everything the voice says, by clip name"""
+        disclaimer_text = ("Warning: Consult with a medical professional before starting any new exercise regimen. "
+                           "Do not over-exert yourself. Listen to your body and stop if you feel pain or discomfort.")
+        
+        # Create method-specific announcement
+        if self.method == "Custom":
+            selected = "You have selected a custom workout. "
+        else:
+            selected = f"You have selected the {self.method} regimen. "
+        workout_info_text = (selected +
+                             f"{self.rounds} rounds. "
+                             f"Work intervals are {self.work_seconds()} seconds. "
+                             f"Recovery intervals are {self.recovery_seconds()} seconds. "
+                             f"Total workout time: {format_time_for_speech(self.workout_length())}.")
+        
+        texts = {
+            "disclaimer": disclaimer_text,
+            "info": workout_info_text,
+            "warmup": "Begin warm-up.",
+            "workout": "Begin workout.",
+            "cooldown": "Begin cool-down.",
+            "complete": "Workout complete. Great job!",
+        }
+        if self.round_cues:
+            texts.update({"go": "Go!", "rest": "Rest.", "three": "Three.", "two": "Two.", "one": "One."})
+            for round_num in range(1, self.rounds + 1):
+                texts[f"round_{round_num}"] = f"Round {round_num} of {self.rounds}."
+        return texts
+
+
+class WorkoutGenerator:
+    """
+    Turns WorkoutSettings into an MP3. It never touches the GUI, so it can run on
+    a worker thread, and it holds on to decoded music and voice clips between
+    generations. Several generations can run at once on different threads.
+    encode_workers is how many ffmpeg encoders each generation runs at once; lower
+    it when several generations (or processes) share the CPU.
+    """
+
+    def __init__(self, audio_cache=None, voice_cache=None, encode_workers=ENCODE_WORKERS):
+        self.audio_cache = audio_cache or DecodedAudioCache()
+        self.voice_cache = voice_cache or VoiceClipCache()
+        self.encode_workers = encode_workers
+        self.track_analysis = TrackAnalysisIndex(self.audio_cache)
+
+    def generate(self, settings, output_path, job=None, report_path=None):
+        """
+        Generates the workout MP3 at output_path. Pass a GenerationJob to get
+        progress reports and other events and to be able to cancel it; a cancelled
+        generation raises GenerationCancelled and leaves no output file behind.
+        With report_path, a GenerationProfile's JSON report is saved there as well.
+        """
+        profile = None
+        if report_path:
+            job = job or GenerationJob()
+            profile = GenerationProfile()
+            job.listen(profile)
+            profile.start()
+        current_job.job = job
+        try:
+            self.write_workout(settings, output_path)
+        except BaseException:
+            if os.path.exists(output_path):
+                os.remove(output_path)
+            raise
+        finally:
+            if job:
+                job.end_stage()
+            current_job.job = None
+            if profile:
+                profile.stop()
+        if profile:
+            report = OrderedDict(output=os.path.abspath(output_path), method=settings.method,
+                                 rounds=settings.rounds, **profile.report())
+            write_file_atomically(report_path, json.dumps(report, indent=2).encode())
+
+    def write_workout(self, settings, output_path):
+        # Create TTS segments
+        report_progress("voice", 0)
+        clips = self.voice_cache.get_clips(settings.voice_texts(), backend=settings.voice_backend)
+        report_progress("voice", 1)
+        report_progress("load", 0)
+        
+        # Songs are only analysed (once, then it's cached) if something needs it
+        analyze = None
+        if settings.match_levels or settings.align_to_beats:
+            analyze = self.track_analysis.get
+        
+        def lay_out(open_track):
+            with timed("layout"):
+                pools = (TrackPool("intense", settings.intense_path, open_track, analyze, settings.align_to_beats),
+                         TrackPool("moderate", settings.moderate_path, open_track, analyze, settings.align_to_beats))
+                timeline = self.build_timeline(clips, *pools,
+                                               settings.work_seconds() * 1000,  # Convert to milliseconds
+                                               settings.recovery_seconds() * 1000, settings.rounds,
+                                               settings.warmup * 1000, settings.cooldown * 1000,
+                                               settings.cycle_mode, settings.round_cues)
+                if settings.match_levels:
+                    timeline.match_levels(dict(pools[0].analyses(), **pools[1].analyses()))
+            return timeline, dict(pools[0].opened, **pools[1].opened)
+        
+        # Lay the workout out against the MP3 frame indexes first: if every track it
+        # reaches can be cut without re-encoding, there's no need to decode at all
+        # (round cues and level matching change the music, so they always need it decoded)
+        if settings.can_copy_frames():
+            try:
+                timeline, indexes = lay_out(MP3FrameIndex)
+            except ValueError:
+                indexes = {}  # Something that isn't an MP3 (ffmpeg can still decode it)
+            if indexes and frame_copy_compatible(indexes.values()):
+                report_progress("load", 1)
+                timeline.copy_mp3(indexes, clips, output_path, self.encode_workers)
+                report_progress("encode", 1)
+                return
+        
+        # Otherwise open the tracks the workout reaches. Only the parts it uses get
+        # decoded, as the timeline gets to them.
+        sources = {}
+        try:
+            timeline, sources = lay_out(self.audio_cache.open)
+            report_progress("load", 1)
+            timeline.export_mp3(sources, clips, output_path, self.encode_workers)
+            report_progress("encode", 1)
+        finally:
+            for audio in sources.values():
+                if isinstance(audio, LazySource):
+                    audio.close()
+    
+    def build_timeline(self, clips, intense, moderate, work_interval, recovery_interval,
+                       rounds, warmup_duration, cooldown_duration, cycle_mode, round_cues=False):
+        """
+        Lays out the whole workout as a WorkoutTimeline (no audio is copied here).
+        intense and moderate are TrackPools; the tracks the workout reaches get opened.
+        With round_cues, every round is announced and counted down over the music.
+        """
+        timeline = WorkoutTimeline()
+        timeline.add_silence(500)  # Start with half-second of silence
+        
+        # Add disclaimer
+        timeline.add_voice("disclaimer", clips["disclaimer"])
+        timeline.add_silence(1000)
+        
+        # Add workout info
+        timeline.add_voice("info", clips["info"])
+        timeline.add_silence(1000)
+        
+        # Add warm-up
+        timeline.add_voice("warmup", clips["warmup"])
+        timeline.add_silence(500)
+        
+        # Add warm-up music (use moderate music)
+        if warmup_duration > 0:
+            timeline.add_music(moderate.track(0), moderate.start(0), warmup_duration)
+            timeline.add_silence(500)
+        
+        # Add workout start announcement
+        timeline.add_voice("workout", clips["workout"])
+        timeline.add_silence(500)
+        
+        if round_cues:
+            # Round 1 is announced before the music starts, the others during the recovery before them
+            timeline.add_voice("round_1", clips["round_1"])
+            timeline.add_silence(3500)
+            self.add_countdown(timeline, len(timeline.spans) - 1, 3500)
+        
+        # Add the workout intervals
+        intense_cursor = TrackCursor(intense, energetic=True)  # Where we are in the intense music
+        moderate_cursor = TrackCursor(moderate)  # Where we are in the moderate music
+        
+        for round_num in range(rounds):
+            # Work interval (intense music)
+            work_span = len(timeline.spans)
+            intense_cursor.add_interval(timeline, work_interval, cycle_mode)
+            if round_cues and work_interval > 0:
+                timeline.add_cue("go", 0, work_span)
+            
+            # Recovery interval (moderate music)
+            recovery_span = len(timeline.spans)
+            moderate_cursor.add_interval(timeline, recovery_interval, cycle_mode)
+            if round_cues and recovery_interval > 0:
+                self.add_recovery_cues(timeline, recovery_span, clips, round_num + 2, rounds, recovery_interval)
+        
+        # Add cool-down
+        timeline.add_silence(500)
+        timeline.add_voice("cooldown", clips["cooldown"])
+        timeline.add_silence(500)
+        
+        if cooldown_duration > 0:
+            timeline.add_music(moderate.track(0), moderate.start(0), cooldown_duration)
+            timeline.add_silence(500)
+        
+        # Add completion message
+        timeline.add_voice("complete", clips["complete"])
+        timeline.add_silence(500)
+        
+        return timeline
+    
+    def add_countdown(self, timeline, span, length):
+        """Counts "three, two, one" into the end of the `length` ms starting at spans[span]"""
+        if length >= 3000:
+            for seconds_left, name in ((3, "three"), (2, "two"), (1, "one")):
+                timeline.add_cue(name, length - seconds_left * 1000, span)
+    
+    def add_recovery_cues(self, timeline, span, clips, next_round, rounds, recovery_interval):
+        """
+        Says "Rest" at the start of a recovery interval (starting at spans[span])
+        and, if there's room, announces the next round and counts down into it at the end
+        """
+        timeline.add_cue("rest", 0, span)
+        if next_round > rounds:
+            return
+        rest_end = len(clips["rest"]) + 250
+        countdown_start = recovery_interval - 3000
+        if countdown_start < rest_end:
+            return
+        self.add_countdown(timeline, span, recovery_interval)
+        announcement = f"round_{next_round}"
+        announcement_start = countdown_start - len(clips[announcement]) - 250
+        if announcement_start >= rest_end:
+            timeline.add_cue(announcement, announcement_start, span)
+
+
+class IntervalTrainingApp:
+    def __init__(self, root):
+        self.root = root
+        self.root.title("Interval Training MP3 Generator")
+        self.root.geometry("600x845")
+        
+        # Variables to store user choices
+        self.intense_mp3_path = tk.StringVar()
+        self.moderate_mp3_path = tk.StringVar()
+        self.selected_method = tk.StringVar(value="Tabata")
+        self.num_rounds = tk.IntVar(value=8)
+        self.warmup_time = tk.IntVar(value=180)  # 3 minutes in seconds
+        self.cooldown_time = tk.IntVar(value=180)  # 3 minutes in seconds
+        self.cycle_through = tk.BooleanVar(value=False)
+        self.workout_length = tk.StringVar(value="4:00")
+        self.custom_work = tk.IntVar(value=30)  # Custom work interval
+        self.custom_recovery = tk.IntVar(value=30)  # Custom recovery interval
+        self.voice_backend = tk.StringVar(value="Auto")
+        self.lossless_copy = tk.BooleanVar(value=True)
+        self.round_cues = tk.BooleanVar(value=False)
+        self.match_levels = tk.BooleanVar(value=False)
+        self.align_to_beats = tk.BooleanVar(value=False)
+        
+        # Decoded music stays loaded between generations (and on disk between runs)
+        self.generator = WorkoutGenerator()
+        
+        # Generations run on worker threads and send their progress back through this queue
+        self.events = queue.Queue()
+        self.progress_windows = {}
+        
+        self.create_widgets()
+        self.update_workout_length()  # Calculate initial workout length
+        
+    def create_widgets(self):
+        # Title
+        title_label = tk.Label(self.root, text="Interval Training MP3 Generator", 
+                              font=("Arial", 16, "bold"))
+        title_label.pack(pady=10)
+        
+        # Frame for MP3 file selections
+        file_frame = tk.LabelFrame(self.root, text="Select Music Files", padx=10, pady=10)
+        file_frame.pack(padx=10, pady=10, fill="x")
+        
+        # Intense MP3 selection
+        tk.Label(file_frame, text="Intense Music MP3:").grid(row=0, column=0, sticky="w", pady=5)
+        tk.Entry(file_frame, textvariable=self.intense_mp3_path, width=34).grid(row=0, column=1, padx=5)
+        tk.Button(file_frame, text="Browse", command=self.browse_intense_mp3).grid(row=0, column=2)
+        tk.Button(file_frame, text="Folder", command=lambda: self.browse_folder(
+            self.intense_mp3_path, "Select a Folder of Intense Music")).grid(row=0, column=3, padx=(5, 0))
+        
+        # Moderate MP3 selection
+        tk.Label(file_frame, text="Moderate Music MP3:").grid(row=1, column=0, sticky="w", pady=5)
+        tk.Entry(file_frame, textvariable=self.moderate_mp3_path, width=34).grid(row=1, column=1, padx=5)
+        tk.Button(file_frame, text="Browse", command=self.browse_moderate_mp3).grid(row=1, column=2)
+        tk.Button(file_frame, text="Folder", command=lambda: self.browse_folder(
+            self.moderate_mp3_path, "Select a Folder of Moderate Music")).grid(row=1, column=3, padx=(5, 0))
+        
+        # Frame for workout settings
+        settings_frame = tk.LabelFrame(self.root, text="Workout Settings", padx=10, pady=10)
+        settings_frame.pack(padx=10, pady=10, fill="x")
+        
+        # Method selection
+        tk.Label(settings_frame, text="Workout Method:").grid(row=0, column=0, sticky="w", pady=5)
+        method_dropdown = ttk.Combobox(settings_frame, textvariable=self.selected_method, 
+                                       values=list(WORKOUT_METHODS.keys()), state="readonly", width=15)
+        method_dropdown.grid(row=0, column=1, sticky="w", padx=5)
+        method_dropdown.bind("<<ComboboxSelected>>", lambda e: self.on_method_change())
+        
+        # Custom interval inputs (only visible when Custom is selected)
+        self.custom_frame = tk.Frame(settings_frame)
+        self.custom_frame.grid(row=1, column=0, columnspan=3, sticky="w", pady=5)
+        
+        tk.Label(self.custom_frame, text="  Work interval (seconds):").grid(row=0, column=0, sticky="w", padx=(20,5))
+        self.custom_work_spinbox = tk.Spinbox(self.custom_frame, from_=1, to=300, 
+                                              textvariable=self.custom_work, width=10,
+                                              command=self.update_workout_length)
+        self.custom_work_spinbox.grid(row=0, column=1, sticky="w")
+        # Update when user types (not just when using arrows)
+        self.custom_work.trace_add('write', lambda *args: self.update_workout_length())
+        
+        tk.Label(self.custom_frame, text="  Recovery interval (seconds):").grid(row=1, column=0, sticky="w", padx=(20,5))
+        self.custom_recovery_spinbox = tk.Spinbox(self.custom_frame, from_=1, to=300, 
+                                                  textvariable=self.custom_recovery, width=10,
+                                                  command=self.update_workout_length)
+        self.custom_recovery_spinbox.grid(row=1, column=1, sticky="w")
+        # Update when user types (not just when using arrows)
+        self.custom_recovery.trace_add('write', lambda *args: self.update_workout_length())
+        
+        # Hide custom inputs by default
+        self.custom_frame.grid_remove()
+        
+        # Number of rounds
+        tk.Label(settings_frame, text="Number of Rounds:").grid(row=2, column=0, sticky="w", pady=5)
+        rounds_spinbox = tk.Spinbox(settings_frame, from_=1, to=100, textvariable=self.num_rounds, 
+                                    width=10, command=self.update_workout_length)
+        rounds_spinbox.grid(row=2, column=1, sticky="w", padx=5)
+        # Update when user types (not just when using arrows)
+        self.num_rounds.trace_add('write', lambda *args: self.update_workout_length())
+        
+        # Workout length display (calculated automatically)
+        tk.Label(settings_frame, text="Workout Length:").grid(row=3, column=0, sticky="w", pady=5)
+        tk.Label(settings_frame, textvariable=self.workout_length, font=("Arial", 10, "bold")).grid(
+            row=3, column=1, sticky="w", padx=5)
+        
+        # Warm-up time
+        tk.Label(settings_frame, text="Warm-up Time (seconds):").grid(row=4, column=0, sticky="w", pady=5)
+        tk.Spinbox(settings_frame, from_=0, to=600, textvariable=self.warmup_time, 
+                  width=10).grid(row=4, column=1, sticky="w", padx=5)
+        
+        # Cool-down time
+        tk.Label(settings_frame, text="Cool-down Time (seconds):").grid(row=5, column=0, sticky="w", pady=5)
+        tk.Spinbox(settings_frame, from_=0, to=600, textvariable=self.cooldown_time, 
+                  width=10).grid(row=5, column=1, sticky="w", padx=5)
+        
+        # Cycle through option
+        tk.Checkbutton(settings_frame, text="Cycle through music (instead of repeating from start)", 
+                      variable=self.cycle_through).grid(row=6, column=0, columnspan=2, sticky="w", pady=(10, 0))
+        
+        # Lossless mode (only used when both MP3s have the same sample rate and channels)
+        tk.Checkbutton(settings_frame, text="Fast lossless mode (cut the MP3s without re-encoding)",
+                      variable=self.lossless_copy).grid(row=7, column=0, columnspan=2, sticky="w")
+        
+        # Round cues are mixed over the music, so they turn lossless mode off
+        tk.Checkbutton(settings_frame, text="Announce rounds with countdowns (\"Round 3 of 8\", 3-2-1, Go!)",
+                      variable=self.round_cues).grid(row=8, column=0, columnspan=2, sticky="w")
+        
+        # Both need every song analysed once (it's cached after that); matching levels turns lossless mode off
+        tk.Checkbutton(settings_frame, text="Play every song at the same loudness",
+                      variable=self.match_levels).grid(row=9, column=0, columnspan=2, sticky="w")
+        tk.Checkbutton(settings_frame, text="Start the music on the beat (intense music at its most energetic part)",
+                      variable=self.align_to_beats).grid(row=10, column=0, columnspan=2, sticky="w", pady=(0, 10))
+        
+        # Text-to-speech engine (the offline ones work without an internet connection)
+        tk.Label(settings_frame, text="Voice:").grid(row=11, column=0, sticky="w", pady=5)
+        ttk.Combobox(settings_frame, textvariable=self.voice_backend, state="readonly", width=15,
+                     values=["Auto"] + [b.label for b in TTS_BACKENDS.values() if b.is_available()]).grid(
+            row=11, column=1, sticky="w", padx=5)
+        
+        # Info box explaining the methods
+        info_frame = tk.LabelFrame(self.root, text="Method Information", padx=10, pady=10)
+        info_frame.pack(padx=10, pady=10, fill="both", expand=True)
+        
+        info_text = tk.Text(info_frame, height=8, wrap=tk.WORD)
+        info_text.pack(fill="both", expand=True)
+        info_text.insert("1.0", 
+            "Tabata: 20s work / 10s recovery (high intensity, short bursts)\n"
+            "Gibala: 60s work / 75s recovery (moderate volume for regular folks)\n"
+            "Zuniga: 30s work / 30s recovery (balanced work-rest ratio)\n"
+            "General: 30s work / 15s recovery (2:1 work-to-rest ratio)\n"
+            "Custom: Set your own work and recovery intervals\n\n"
+            "The program will create an MP3 with:\n"
+            "• Safety disclaimer at the start\n"
+            "• Warm-up section with your moderate music\n"
+            "• Alternating intense/moderate intervals\n"
+            "• Cool-down section with your moderate music")
+        info_text.config(state="disabled")
+        
+        # Generate button
+        generate_btn = tk.Button(self.root, text="Generate Workout MP3", 
+                                command=self.generate_mp3, bg="#4CAF50", fg="white", 
+                                font=("Arial", 12, "bold"), pady=10)
+        generate_btn.pack(padx=10, pady=20, fill="x")
+        
+    def browse_intense_mp3(self):
+        """Opens a file browser to select the intense music MP3 (or a playlist)"""
+        filename = filedialog.askopenfilename(
+            title="Select Intense Music MP3",
+            filetypes=[("MP3 files", "*.mp3"), ("Playlists", "*.m3u *.m3u8"), ("All files", "*.*")]
+        )
+        if filename:
+            self.intense_mp3_path.set(filename)
+    
+    def browse_moderate_mp3(self):
+        """Opens a file browser to select the moderate music MP3 (or a playlist)"""
+        filename = filedialog.askopenfilename(
+            title="Select Moderate Music MP3",
+            filetypes=[("MP3 files", "*.mp3"), ("Playlists", "*.m3u *.m3u8"), ("All files", "*.*")]
+        )
+        if filename:
+            self.moderate_mp3_path.set(filename)
+    
+    def browse_folder(self, path_var, title):
+        """Opens a folder browser, to use every MP3 in the folder"""
+        folder = filedialog.askdirectory(title=title)
+        if folder:
+            path_var.set(folder)
+    
+    def on_method_change(self):
+        """When the user changes the method, update the default rounds and workout length"""
+        method = self.selected_method.get()
+        
+        # Show or hide custom interval inputs
+        if method == "Custom":
+            self.custom_frame.grid()
+        else:
+            self.custom_frame.grid_remove()
+        
+        default_rounds = WORKOUT_METHODS[method]["default_rounds"]
+        self.num_rounds.set(default_rounds)
+        self.update_workout_length()
+    
+    def update_workout_length(self):
+        """Calculate and display the total workout time (excluding warm-up/cool-down)"""
+        method = self.selected_method.get()
+        
+        # Get work and recovery times based on method
+        if method == "Custom":
+            try:
+                work_time = self.custom_work.get()
+                recovery_time = self.custom_recovery.get()
+            except:
+                # If the boxes are empty or invalid, use default values
+                work_time = 30
+                recovery_time = 30
+        else:
+            work_time = WORKOUT_METHODS[method]["work"]
+            recovery_time = WORKOUT_METHODS[method]["recovery"]
+        
+        try:
+            rounds = self.num_rounds.get()
+        except:
+            rounds = 1
+        
+        total_seconds = (work_time + recovery_time) * rounds
+        minutes = total_seconds // 60
+        seconds = total_seconds % 60
+        
+        self.workout_length.set(f"{minutes}:{seconds:02d}")
+    
+    def selected_voice_backend(self):
+        """Turns the Voice dropdown label into a TTS_BACKENDS name (or "auto")"""
+        for backend in TTS_BACKENDS.values():
+            if backend.label == self.voice_backend.get():
+                return backend.name
+        return "auto"
+    
+    def current_settings(self):
+        """Takes a snapshot of the GUI's settings for a worker thread to use"""
+        return WorkoutSettings(
+            self.intense_mp3_path.get(), self.moderate_mp3_path.get(),
+            method=self.selected_method.get(),
+            rounds=self.num_rounds.get(),
+            warmup=self.warmup_time.get(),
+            cooldown=self.cooldown_time.get(),
+            cycle_mode=self.cycle_through.get(),
+            custom_work=self.custom_work.get(),
+            custom_recovery=self.custom_recovery.get(),
+            voice_backend=self.selected_voice_backend(),
+            lossless_copy=self.lossless_copy.get(),
+            round_cues=self.round_cues.get(),
+            match_levels=self.match_levels.get(),
+            align_to_beats=self.align_to_beats.get())
+    
+    def generate_mp3(self):
+        """Main function that generates the workout MP3 (on a worker thread, so the window stays responsive)"""
+        
+        # Validate inputs
+        if not self.intense_mp3_path.get() or not self.moderate_mp3_path.get():
+            messagebox.showerror("Error", "Please select both intense and moderate music MP3 files.")
+            return
+        
+        if not os.path.exists(self.intense_mp3_path.get()):
+            messagebox.showerror("Error", "Intense music file not found.")
+            return
+            
+        if not os.path.exists(self.moderate_mp3_path.get()):
+            messagebox.showerror("Error", "Moderate music file not found.")
+            return
+        
+        try:
+            settings = self.current_settings()
+        except (tk.TclError, ValueError) as e:
+            messagebox.showerror("Error", f"Please check your workout settings:\n\n{str(e)}")
+            return
+        
+        # Ask where to save the output
+        output_path = filedialog.asksaveasfilename(
+            defaultextension=".mp3",
+            filetypes=[("MP3 files", "*.mp3")],
+            title="Save Workout MP3 As"
+        )
+        
+        if not output_path:
+            return
+        
+        job = GenerationJob(progress=lambda stage, fraction: self.events.put(("progress", job, stage, fraction)))
+        job.profile = GenerationProfile()
+        job.listen(job.profile)
+        self.show_progress_window(job, output_path)
+        
+        worker = threading.Thread(target=self.run_generation, args=(job, settings, output_path), daemon=True)
+        worker.start()
+        if len(self.progress_windows) == 1:
+            self.root.after(100, self.poll_events)
+    
+    def run_generation(self, job, settings, output_path):
+        """Runs on the worker thread. Results go back to the GUI through self.events"""
+        try:
+            self.generator.generate(settings, output_path, job)
+            job.profile.stop()
+            self.events.put(("done", job, output_path))
+        except GenerationCancelled:
+            self.events.put(("cancelled", job))
+        except Exception as e:
+            self.events.put(("error", job, str(e)))
+    
+    def show_progress_window(self, job, output_path):
+        """Shows a progress window (with a Cancel button) for one generation"""
+        progress_window = tk.Toplevel(self.root)
+        progress_window.title("Generating...")
+        progress_window.geometry("360x150")
+        tk.Label(progress_window, text=f"Generating {os.path.basename(output_path)}",
+                 font=("Arial", 10)).pack(pady=(15, 5))
+        progress_window.stage_label = tk.Label(progress_window, text="Starting...", font=("Arial", 9))
+        progress_window.stage_label.pack()
+        progress_window.bar = ttk.Progressbar(progress_window, mode="determinate", maximum=100, length=300)
+        progress_window.bar.pack(pady=5)
+        progress_window.cancel_button = tk.Button(progress_window, text="Cancel", command=job.cancel)
+        progress_window.cancel_button.pack(pady=5)
+        progress_window.protocol("WM_DELETE_WINDOW", job.cancel)
+        self.progress_windows[job] = progress_window
+    
+    def poll_events(self):
+        """Applies progress and results sent by worker threads (runs on the Tk main thread)"""
+        stage_names = {"load": "Loading music", "voice": "Making voice announcements",
+                       "encode": "Encoding"}
+        while True:
+            try:
+                event = self.events.get_nowait()
+            except queue.Empty:
+                break
+            kind, job = event[0], event[1]
+            progress_window = self.progress_windows.get(job)
+            if progress_window is None:
+                continue
+            
+            if kind == "progress":
+                stage, fraction = event[2], event[3]
+                progress_window.stage_label.config(text=f"{stage_names.get(stage, stage)}... {int(fraction * 100)}%")
+                progress_window.bar["value"] = fraction * 100
+                if job.cancelled.is_set():
+                    progress_window.stage_label.config(text="Cancelling...")
+                continue
+            
+            # The generation is over one way or another
+            progress_window.destroy()
+            del self.progress_windows[job]
+            if kind == "done":
+                messagebox.showinfo("Success", f"Workout MP3 generated successfully!\n\nSaved to:\n{event[2]}\n\n"
+                                               f"Took {job.profile.seconds:.1f}s ({job.profile.summary()})")
+            elif kind == "error":
+                messagebox.showerror("Error", f"An error occurred while generating the MP3:\n\n{event[2]}")
+        
+        if self.progress_windows:
+            self.root.after(100, self.poll_events)
+
+
+# Each batch worker process keeps one generator (and its caches) for all the jobs it runs
+batch_generator = None
+
+
+def prepare_batch_source(path, analyze=False):
+    """
+    Decodes a song into the shared on-disk cache, so batch jobs only have to mmap it,
+    and with analyze, saves its TrackAnalysis too
+    """
+    cache = DecodedAudioCache()
+    cache.load(path)
+    if analyze:
+        TrackAnalysisIndex(cache).get(path)
+    return path
+
+
+def batch_tracks(settings):
+    """Every song a batch workout could use, from both of its track pools"""
+    try:
+        return [os.path.abspath(path) for pool in (settings.intense_path, settings.moderate_path)
+                for path in find_tracks(pool)]
+    except (OSError, ValueError):
+        return []  # Reported when the job itself runs
+
+
+def batch_can_copy(settings):
+    """True if a batch workout will (most likely) be cut from its MP3 frames without decoding"""
+    try:
+        tracks = batch_tracks(settings)
+        return bool(tracks) and frame_copy_compatible([MP3FrameIndex(path) for path in tracks])
+    except (OSError, ValueError):
+        return False
+
+
+def run_batch_job(number, values, base_dir, output_path, report=False, encode_workers=ENCODE_WORKERS):
+    """Runs one workout from a batch manifest in a worker process and returns its summary"""
+    global batch_generator
+    if batch_generator is None:
+        batch_generator = WorkoutGenerator(encode_workers=encode_workers)
+    summary = {"job": number, "output": output_path}
+    profile = GenerationProfile()
+    try:
+        settings = WorkoutSettings.from_dict(values, base_dir)
+        batch_generator.generate(settings, output_path, GenerationJob(listeners=[profile]),
+                                 performance_report_path(output_path) if report else None)
+        summary.update(status="ok", method=settings.method, rounds=settings.rounds,
+                       bytes=os.path.getsize(output_path))
+    except Exception as e:
+        summary.update(status="error", error=str(e))
+    profile.stop()
+    summary["seconds"] = round(profile.seconds, 2)
+    summary["stages"] = profile.report()["stages"]
+    return summary
+
+
+def load_manifest(path):
+    """
+    Reads a batch manifest. It's either a list of workouts, or an object like
+    {"defaults": {...}, "output_dir": "library", "workouts": [{...}, ...]} where
+    every workout gets the defaults plus its own settings and an "output" file name.
+    """
+    with open(path) as f:
+        manifest = json.load(f)
+    if isinstance(manifest, list):
+        manifest = {"workouts": manifest}
+    base_dir = os.path.dirname(os.path.abspath(path))
+    output_dir = os.path.join(base_dir, manifest.get("output_dir", ""))
+    defaults = manifest.get("defaults", {})
+
+    jobs = []
+    for number, workout in enumerate(manifest.get("workouts", []), 1):
+        values = dict(defaults, **workout)
+        output = values.pop("output", None) or "workout-{0:02d}.mp3".format(number)
+        jobs.append((number, values, base_dir, os.path.join(output_dir, output)))
+    return jobs
+
+
+def run_batch(manifest_path, processes=None, summary_path=None, reports=False):
+    """Renders every workout in a manifest in parallel across a process pool"""
+    jobs = load_manifest(manifest_path)
+    if not jobs:
+        print("The manifest doesn't have any workouts in it.", file=sys.stderr)
+        return 1
+    for _, _, _, output_path in jobs:
+        os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+
+    started = time.time()
+    processes = processes or os.cpu_count() or 1
+    # Every process encodes its own workout, so they share the cores instead of each using all of them
+    encode_workers = max(1, ENCODE_WORKERS // processes)
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        # Work shared between jobs is done once up front: every song is decoded
+        # into the on-disk cache (in parallel) and every voice clip is made,
+        # so the jobs themselves just memory-map songs and load cached clips
+        job_settings = {}
+        for number, values, base_dir, _ in jobs:
+            try:
+                job_settings[number] = WorkoutSettings.from_dict(values, base_dir)
+            except ValueError:
+                pass  # Reported when the job itself runs
+        settings = list(job_settings.values())
+        uses = {}
+        analyze = set()
+        for s in settings:
+            if s.match_levels or s.align_to_beats:
+                analyze.update(batch_tracks(s))  # Analysing decodes the whole song anyway
+            if s.can_copy_frames() and batch_can_copy(s):
+                continue  # Cut from the MP3 frames, nothing to decode
+            for path in set(batch_tracks(s)):
+                uses[path] = uses.get(path, 0) + 1
+        # A song only one job uses is decoded lazily by that job, like it would be on its own
+        shared = {path for path, count in uses.items() if count > 1}
+        prepare = sorted(path for path in shared | analyze if os.path.exists(path))
+        decodes = {path: pool.submit(prepare_batch_source, path, path in analyze) for path in prepare}
+
+        # A song that can't be decoded or a voice that can't be made fails the
+        # workouts that need it, not the whole batch
+        song_errors, voice_errors = {}, {}
+        for path, future in decodes.items():
+            try:
+                future.result()
+            except Exception as e:
+                song_errors[path] = "Couldn't decode {0}: {1}".format(path, e)
+        voice_cache = VoiceClipCache()
+        for backend in {s.voice_backend for s in settings}:
+            texts = {}
+            for s in settings:
+                if s.voice_backend == backend:
+                    texts.update({"{0}:{1}".format(name, text): text for name, text in s.voice_texts().items()})
+            try:
+                voice_cache.get_clips(texts, backend=backend)
+            except Exception as e:
+                voice_errors[backend] = "Couldn't make the voice clips: {0}".format(e)
+        print("Decoded {0} shared or analysed songs and made the voice clips in {1:.1f}s".format(
+            len(decodes) - len(song_errors), time.time() - started))
+
+        futures = []
+        for job in jobs:
+            s = job_settings.get(job[0])
+            failed = []
+            if s:
+                failed = [song_errors[path] for path in batch_tracks(s) if path in song_errors]
+                if s.voice_backend in voice_errors:
+                    failed.append(voice_errors[s.voice_backend])
+            if failed:
+                futures.append({"job": job[0], "output": job[3], "status": "error", "error": failed[0],
+                                "seconds": 0.0, "stages": {}})
+            else:
+                futures.append(pool.submit(run_batch_job, *job, report=reports, encode_workers=encode_workers))
+        summaries = []
+        for future in futures:
+            summary = future.result() if isinstance(future, Future) else future
+            summaries.append(summary)
+            if summary["status"] == "ok":
+                print("[{job:>3}] ok     {seconds:7.2f}s  {output}".format(**summary))
+            else:
+                print("[{job:>3}] FAILED {seconds:7.2f}s  {output}: {error}".format(**summary))
+
+    failed = sum(1 for summary in summaries if summary["status"] != "ok")
+    print("{0} workouts in {1:.1f}s with {2} processes, {3} failed".format(
+        len(summaries), time.time() - started, processes, failed))
+    if summary_path:
+        with open(summary_path, "w") as f:
+            json.dump(summaries, f, indent=2)
+    return 1 if failed else 0
+
+
+class ResultCache:
+    """
+    Finished workout MP3s on disk, named after a hash of everything that went
+    into them (see WorkoutService.cache_key), trimmed to max_bytes, least
+    recently used first
+    """
+
+    def __init__(self, directory=None, max_bytes=RESULT_CACHE_MAX_BYTES):
+        self.directory = directory or os.path.join(CACHE_DIR, "results")
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".mp3")
+
+    def open(self, key):
+        """The cached MP3 for key as an open file, or None"""
+        try:
+            f = open(self.path(key), "rb")
+        except OSError:
+            return None
+        os.utime(self.path(key))  # Mark it as recently used
+        return f
+
+    def temp_path(self):
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        os.close(fd)
+        return temp_path
+
+    def add(self, key, temp_path):
+        os.replace(temp_path, self.path(key))
+        self.trim(keep=key)
+
+    def trim(self, keep=None):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".mp3"):
+                stat = os.stat(os.path.join(self.directory, name))
+                entries.append((stat.st_mtime, stat.st_size, name[:-4]))
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if key != keep:
+                try:
+                    os.remove(self.path(key))
+                except OSError:
+                    pass  # Being downloaded (Windows), try again next time
+                total -= size
+
+
+class WorkoutService:
+    """
+    Generates workouts for the HTTP service (see run_service). Generations run on
+    a pool of worker threads sharing one WorkoutGenerator, so decoded music and
+    voice clips stay loaded from one request to the next, and finished workouts
+    go into a ResultCache, so asking for the same workout again is just a
+    download. Music can only come from music_dir.
+    """
+
+    # Request parameters that are numbers or yes/no, the rest are strings
+    INT_FIELDS = {"rounds", "warmup", "cooldown", "work", "recovery"}
+    BOOL_FIELDS = {"cycle", "cues", "lossless", "levels", "beats"}
+
+    def __init__(self, music_dir, workers=2, cache_bytes=RESULT_CACHE_MAX_BYTES):
+        self.music_dir = os.path.realpath(music_dir)
+        # The workers' generations share the cores between them
+        self.generator = WorkoutGenerator(encode_workers=max(1, ENCODE_WORKERS // workers))
+        self.results = ResultCache(max_bytes=cache_bytes)
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.in_progress = {}  # Cache key -> threading.Event, set when that generation ends
+        self.lock = threading.Lock()
+
+    def music_path(self, relative_path):
+        """A path inside music_dir, refusing anything that leads outside it"""
+        path = os.path.realpath(os.path.join(self.music_dir, relative_path))
+        if os.path.commonpath([path, self.music_dir]) != self.music_dir:
+            raise PermissionError(f"{relative_path} is outside the music folder")
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"{relative_path} not found")
+        return path
+
+    def music_files(self):
+        """Everything in music_dir that can fill a slot: MP3s, playlists and folders of MP3s"""
+        for directory, folders, files in os.walk(self.music_dir):
+            folders.sort()
+            relative = os.path.relpath(directory, self.music_dir)
+            if relative != "." and any(name.lower().endswith(".mp3") for name in files):
+                yield relative
+            for name in sorted(files):
+                if name.lower().endswith((".mp3",) + PLAYLIST_EXTENSIONS):
+                    yield os.path.normpath(os.path.join(relative, name))
+
+    def settings_for(self, values):
+        """
+        Turns request parameters (a query string or a JSON object) into WorkoutSettings.
+        They get the same checks as a batch manifest (see WorkoutSettings.from_dict):
+        numbers within the GUI's limits and a voice from TTS_BACKENDS or "auto".
+        Error messages only ever name paths relative to music_dir.
+        """
+        clean = {}
+        for key, value in values.items():
+            if key in self.INT_FIELDS and isinstance(value, str):
+                try:
+                    clean[key] = int(value)
+                except ValueError:
+                    raise ValueError(f"'{key}' must be a whole number, not {value!r}") from None
+            elif key in self.BOOL_FIELDS:
+                clean[key] = value if isinstance(value, bool) else str(value).lower() in ("1", "true", "yes", "on")
+            else:
+                clean[key] = value
+        for slot in ("intense", "moderate"):
+            if not clean.get(slot):
+                raise ValueError(f"Missing '{slot}' music")
+            relative_path = clean[slot]
+            clean[slot] = self.music_path(relative_path)
+            try:
+                tracks = find_tracks(clean[slot])
+            except (OSError, ValueError):
+                raise ValueError(f"No MP3 files found in {relative_path}") from None
+            for track in tracks:  # Playlists can't point outside either
+                try:
+                    self.music_path(track)
+                except PermissionError:
+                    raise PermissionError(f"{relative_path} lists a track outside the music folder") from None
+                except FileNotFoundError:
+                    raise FileNotFoundError(f"{relative_path} lists a track that isn't there") from None
+        return WorkoutSettings.from_dict(clean)
+
+    def cache_key(self, settings):
+        """A hash of the workout's normalized settings and the content of every track it could use"""
+        fingerprints = self.generator.audio_cache.fingerprints
+        description = {
+            "method": settings.method, "rounds": settings.rounds,
+            "work": settings.work_seconds(), "recovery": settings.recovery_seconds(),
+            "warmup": settings.warmup, "cooldown": settings.cooldown, "cycle": bool(settings.cycle_mode),
+            "voice": settings.voice_backend, "lossless": bool(settings.lossless_copy),
+            "cues": bool(settings.round_cues), "levels": bool(settings.match_levels),
+            "beats": bool(settings.align_to_beats),
+            "intense": [fingerprints.content_hash(path) for path in find_tracks(settings.intense_path)],
+            "moderate": [fingerprints.content_hash(path) for path in find_tracks(settings.moderate_path)],
+        }
+        return hashlib.sha1(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+    def claim(self, key):
+        """
+        Claims the generation of key. Returns None if it's ours to do, or an Event
+        to wait on if another request is already generating the same workout.
+        """
+        with self.lock:
+            if key in self.in_progress:
+                return self.in_progress[key]
+            self.in_progress[key] = threading.Event()
+            return None
+
+    def start(self, settings, key, job):
+        """Generates the workout on the worker pool and returns a Future (call claim() first)"""
+        return self.pool.submit(self.generate, settings, key, job)
+
+    def generate(self, settings, key, job):
+        profile = GenerationProfile()
+        job.listen(profile)
+        try:
+            temp_path = self.results.temp_path()
+            self.generator.generate(settings, temp_path, job)
+            self.results.add(key, temp_path)
+            profile.stop()
+            print(f"Generated {settings.method} x{settings.rounds} ({key[:10]}) in {profile.seconds:.1f}s: "
+                  f"{profile.summary()}", file=sys.stderr)
+        finally:
+            with self.lock:
+                self.in_progress.pop(key).set()
+
+    def warm_up(self, preload=False):
+        """
+        Makes the fixed voice clips for every method (and, with preload, decodes
+        all of the music) on the worker pool, so the first requests are quick too
+        """
+        texts = {}
+        for method in WORKOUT_METHODS:
+            settings = WorkoutSettings("", "", method=method)
+            texts.update({f"{method}:{name}": text for name, text in settings.voice_texts().items()})
+        jobs = [(self.generator.voice_cache.get_clips, texts)]
+        if preload:
+            for relative_path in self.music_files():
+                if relative_path.lower().endswith(".mp3"):
+                    jobs.append((self.generator.audio_cache.load, os.path.join(self.music_dir, relative_path)))
+        for function, argument in jobs:
+            self.pool.submit(function, argument).add_done_callback(self.report_warm_up_error)
+
+    def report_warm_up_error(self, future):
+        if future.exception():
+            print(f"Warm-up failed: {future.exception()}", file=sys.stderr)
+
+
+class WorkoutRequestHandler(BaseHTTPRequestHandler):
+    """
+    The HTTP API (server.service is the WorkoutService):
+        GET  /methods            the workout methods and their intervals
+        GET  /tracks             music that can be used for intense / moderate
+        GET  /workout?intense=fast.mp3&moderate=slow.mp3&method=Tabata&rounds=8
+        POST /workout            the same parameters as a JSON object
+    Workout parameters are the same as in batch manifests. The MP3 is streamed
+    back as it's encoded (or straight from the result cache if it's been made
+    before); the X-Cache header says which.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path == "/methods":
+            self.send_json(200, WORKOUT_METHODS)
+        elif url.path == "/tracks":
+            self.send_json(200, list(self.server.service.music_files()))
+        elif url.path == "/workout":
+            self.send_workout(dict(parse_qsl(url.query)))
+        else:
+            self.send_json(404, {"error": "Not found"})
+
+    def do_POST(self):
+        if urlsplit(self.path).path != "/workout":
+            self.send_json(404, {"error": "Not found"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            values = json.loads(self.rfile.read(length) or b"{}")
+            if not isinstance(values, dict):
+                raise ValueError("Expected a JSON object")
+        except ValueError as e:
+            self.send_json(400, {"error": f"Bad request: {e}"})
+            return
+        self.send_workout(values)
+
+    def send_json(self, status, value):
+        body = json.dumps(value, indent=2).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_workout(self, values):
+        service = self.server.service
+        try:
+            settings = service.settings_for(values)
+            key = service.cache_key(settings)
+        except PermissionError as e:
+            self.send_json(403, {"error": str(e)})
+            return
+        except FileNotFoundError as e:
+            self.send_json(404, {"error": str(e)})
+            return
+        except (TypeError, ValueError) as e:
+            self.send_json(400, {"error": str(e)})
+            return
+
+        while True:
+            cached = service.results.open(key)
+            if cached:
+                with cached:
+                    self.send_cached(cached)
+                return
+            busy = service.claim(key)
+            if busy is None:
+                break
+            busy.wait()  # Someone else is making the same workout, wait and send theirs
+
+        chunks = queue.Queue()
+        job = GenerationJob(output=chunks.put)
+        future = service.start(settings, key, job)
+        future.add_done_callback(lambda _: chunks.put(None))
+        self.stream_workout(key, chunks, future, job)
+
+    def send_cached(self, f):
+        self.send_response(200)
+        self.send_header("Content-Type", "audio/mpeg")
+        self.send_header("Content-Length", str(os.fstat(f.fileno()).st_size))
+        self.send_header("X-Cache", "hit")
+        self.end_headers()
+        shutil.copyfileobj(f, self.wfile)
+
+    def stream_workout(self, key, chunks, future, job):
+        """
+        Sends the MP3 frames as they're encoded, with chunked transfer encoding. The
+        stream has no Xing header (that's only known at the end), which players
+        handle fine for a constant bitrate file; the cached copy has one.
+        """
+        first = chunks.get()
+        if first is None:
+            # Failed (or finished without streaming anything) before the first frame
+            if future.exception():
+                self.send_json(500, {"error": f"An error occurred while generating the MP3: {future.exception()}"})
+                return
+            cached = self.server.service.results.open(key)
+            if cached is None:
+                self.send_json(500, {"error": "The workout was generated but couldn't be read back"})
+                return
+            with cached:
+                self.send_cached(cached)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "audio/mpeg")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.send_header("X-Cache", "miss")
+        self.end_headers()
+        try:
+            data = first
+            while data is not None:
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+                data = chunks.get()
+            if future.exception():
+                self.close_connection = True  # Cut the stream short so the client sees it failed
+                return
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            job.cancel()  # Nobody's listening any more
+            self.close_connection = True
+
+
+def run_service(music_dir, host="127.0.0.1", port=8750, workers=2, cache_mb=1024, preload=False):
+    """Runs the HTTP service until it's interrupted"""
+    service = WorkoutService(music_dir, workers, cache_mb * 1024 ** 2)
+    server = ThreadingHTTPServer((host, port), WorkoutRequestHandler)
+    server.daemon_threads = True
+    server.service = service
+    service.warm_up(preload)
+    print(f"Serving workouts from {service.music_dir} on http://{host}:{server.server_port}/", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.pool.shutdown(wait=False)
+    return 0
+
+
+def stretch_test_signals(frame_rate=24000):
+    """Synthetic clips for benchmark_time_stretch: a steady tone and something speech-like"""
+    time_axis = np.arange(frame_rate * 4) / frame_rate
+    tone = sum(np.sin(2 * np.pi * 150 * harmonic * time_axis) / harmonic for harmonic in range(1, 5))
+
+    # A voice-ish signal: a gliding pitch with falling harmonics, in 4 "syllables" a
+    # second, with a short burst of noise (a consonant) at the start of each
+    time_axis = np.arange(frame_rate * 8) / frame_rate
+    phase = 2 * np.pi * np.cumsum(110 + 35 * (1 + np.sin(2 * np.pi * 0.7 * time_axis))) / frame_rate
+    voiced = sum(np.sin(harmonic * phase) / harmonic ** 1.5 for harmonic in range(1, 9))
+    syllables = np.sin(np.pi * (time_axis * 4 % 1)) ** 2
+    consonants = np.random.default_rng(0).normal(0, 0.3, len(time_axis)) * ((time_axis * 4 % 1) < 0.06)
+    speech = voiced * syllables + consonants
+
+    signals = {}
+    for name, signal in (("tone", tone), ("speech-like", speech)):
+        samples = (signal / np.abs(signal).max() * 16000).astype(np.int16)
+        signals[name] = AudioSegment(data=samples.tobytes(), sample_width=2, frame_rate=frame_rate, channels=1)
+    return signals
+
+
+def spectral_distance(original, stretched):
+    """
+    How different two clips' average spectra are, in dB. Changing the speed without
+    changing the pitch should leave the spectrum alone, so lower is better.
+    """
+    def average_spectrum(audio):
+        samples = segment_to_array(audio).mean(axis=1)
+        frames = np.lib.stride_tricks.sliding_window_view(samples, 1024)[::512]
+        return np.abs(np.fft.rfft(frames * np.hanning(1024), axis=1)).mean(axis=0)
+
+    before, after = average_spectrum(original), average_spectrum(stretched)
+    loud = before > before.max() / 1000  # Ignore bins that are 60dB or more down
+    difference = 20 * np.log10((after[loud] + 1e-9) / before[loud])
+    return float(np.sqrt(np.mean(difference ** 2)))
+
+
+def benchmark_time_stretch(paths=(), speed=VOICE_SPEED, repeats=5):
+    """Compares time_stretch with pydub's speedup for speed and quality, and prints the results"""
+    clips = {os.path.basename(path): AudioSegment.from_file(path) for path in paths} or stretch_test_signals()
+    methods = OrderedDict([
+        ("speedup", lambda audio: audio.speedup(playback_speed=speed)),
+        ("wsola", lambda audio: time_stretch([audio], speed)[0]),
+    ])
+
+    def best_time(function):
+        times = []
+        for _ in range(repeats):
+            started = time.perf_counter()
+            result = function()
+            times.append(time.perf_counter() - started)
+        return min(times), result
+
+    print(f"Speed {speed}x, best of {repeats} runs. Length error is against length / speed;")
+    print("spectral distance is how far the stretched clip's spectrum moved (lower is better).\n")
+    print(f"{'clip':<16}{'method':<10}{'time':>10}{'length error':>15}{'spectral dist':>15}")
+    for name, audio in clips.items():
+        for method, stretch in methods.items():
+            seconds, stretched = best_time(lambda: stretch(audio))
+            error = len(stretched) - len(audio) / speed
+            print(f"{name[:15]:<16}{method:<10}{seconds * 1000:>8.1f}ms{error:>13.0f}ms"
+                  f"{spectral_distance(audio, stretched):>13.2f}dB")
+
+    batch = list(clips.values())
+    one_by_one, _ = best_time(lambda: [audio.speedup(playback_speed=speed) for audio in batch])
+    together, _ = best_time(lambda: time_stretch(batch, speed))
+    print(f"\nAll {len(batch)} clips: speedup {one_by_one * 1000:.1f}ms, "
+          f"wsola in one batch {together * 1000:.1f}ms ({one_by_one / together:.1f}x faster)")
+
+
+class StubTTSBackend:
+    """
+    A stand-in text-to-speech engine for benchmarks: a buzzing tone in 4 "syllables"
+    a second, about as long as the text would take to say, made without any engine
+    """
+    name = "stub"
+    label = "Stub (benchmarks)"
+
+    def is_available(self):
+        return True
+
+    def synthesize(self, text, language, voice, path):
+        frame_rate = 24000
+        time_axis = np.arange(int(frame_rate * (0.3 + 0.065 * len(text)))) / frame_rate
+        syllables = np.sin(np.pi * (time_axis * 4 % 1)) ** 2
+        signal = sum(np.sin(2 * np.pi * 140 * harmonic * time_axis) / harmonic for harmonic in range(1, 6))
+        samples = (signal * syllables / 2.5 * 12000).astype(np.int16)
+        return AudioSegment(data=samples.tobytes(), sample_width=2, frame_rate=frame_rate, channels=1)
+
+
+def make_benchmark_track(path, seconds, pitch, bpm, frame_rate=44100):
+    """Writes a synthetic stereo "song" MP3 for the benchmark: a chord with a noise hit on every beat"""
+    rng = np.random.default_rng(int(pitch))
+    total_frames = int(seconds * frame_rate)
+    beat = 60 / bpm
+
+    def chunks():
+        for start in range(0, total_frames, STREAM_CHUNK_FRAMES):
+            time_axis = np.arange(start, min(start + STREAM_CHUNK_FRAMES, total_frames)) / frame_rate
+            chord = sum(np.sin(2 * np.pi * pitch * ratio * time_axis) for ratio in (1, 1.25, 1.5)) / 3
+            hits = rng.normal(0, 0.5, len(time_axis)) * np.exp(-(time_axis % beat) * 30)
+            stereo = np.stack([0.4 * chord + 0.3 * hits, 0.3 * chord + 0.4 * hits], axis=1)
+            yield (np.clip(stereo, -1, 1) * 32767).astype(np.int16).tobytes()
+
+    encode_pcm_stream(chunks(), path, frame_rate, 2, 2)
+    return path
+
+
+def run_benchmark_case(case, intense_path, moderate_path):
+    """
+    Generates one benchmark workout with empty caches and returns the case with its
+    performance report (see GenerationProfile) added. Run it in a fresh process so
+    the memory figures don't include anything left over from the cases before it.
+    """
+    work_dir = tempfile.mkdtemp(prefix="interval-training-benchmark-")
+    try:
+        generator = WorkoutGenerator(DecodedAudioCache(os.path.join(work_dir, "decoded")),
+                                     VoiceClipCache(os.path.join(work_dir, "voice")))
+        settings = WorkoutSettings(intense_path, moderate_path, method=case["method"], rounds=case["rounds"],
+                                   cycle_mode=case["cycle"], custom_work=case["work"],
+                                   custom_recovery=case["recovery"], voice_backend=StubTTSBackend(),
+                                   lossless_copy=case["lossless"])
+        output_path = os.path.join(work_dir, "workout.mp3")
+        report_path = performance_report_path(output_path)
+        generator.generate(settings, output_path, report_path=report_path)
+        with open(report_path) as f:
+            report = json.load(f, object_pairs_hook=OrderedDict)
+        result = dict(case, workout_seconds=round(len(MP3FrameIndex(output_path)) / 1000, 1),
+                      output_bytes=os.path.getsize(output_path))
+        result.update((key, value) for key, value in report.items() if key not in ("output", "method", "rounds"))
+        if resource:
+            result["ffmpeg_peak_rss_mb"] = round(peak_rss(resource.RUSAGE_CHILDREN) / 1024 ** 2, 1)
+        return result
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def benchmark_cases(methods, rounds, cycle_modes, source_seconds, work=45, recovery=15, lossless=False):
+    """Every combination of the swept settings, each named so it can be matched against a baseline"""
+    cases = []
+    for seconds in source_seconds:
+        for method in methods:
+            for round_count in rounds:
+                for cycle in cycle_modes:
+                    name = "{0}/{1}r/{2}/{3}s{4}".format(method, round_count, "cycle" if cycle else "pull",
+                                                         seconds, "/copy" if lossless else "")
+                    cases.append({"case": name, "method": method, "rounds": round_count, "cycle": cycle,
+                                  "source_seconds": seconds, "work": work, "recovery": recovery,
+                                  "lossless": lossless})
+    return cases
+
+
+def compare_benchmarks(results, baseline, time_threshold=0.25, memory_threshold=0.25, min_seconds=0.1):
+    """
+    Compares benchmark results with an earlier run (both as written by run_benchmark)
+    and returns a line for every case that got slower or used more memory than the
+    thresholds allow (0.25 = 25% worse). Stages that take less than min_seconds longer
+    are ignored, since short stages are mostly noise.
+    """
+    before = {case["case"]: case for case in baseline.get("cases", [])}
+    regressions = []
+    for case in results["cases"]:
+        old = before.get(case["case"])
+        if old is None:
+            continue
+        checks = [("total time", case["seconds"], old["seconds"], time_threshold, min_seconds, "s")]
+        for stage, numbers in case["stages"].items():
+            if stage in old["stages"]:
+                checks.append((stage + " time", numbers["seconds"], old["stages"][stage]["seconds"],
+                               time_threshold, min_seconds, "s"))
+        # Songs are decoded during other stages, so decoding gets its own check
+        if "decode" in case.get("timings", {}) and "decode" in old.get("timings", {}):
+            checks.append(("decoding time", case["timings"]["decode"]["seconds"],
+                           old["timings"]["decode"]["seconds"], time_threshold, min_seconds, "s"))
+        checks.append(("peak memory", case["peak_rss_mb"], old["peak_rss_mb"], memory_threshold, 1, "MB"))
+        for what, now, then, threshold, slack, unit in checks:
+            if now > then * (1 + threshold) and now - then > slack:
+                change = " (+{0:.0f}%)".format((now / then - 1) * 100) if then else ""
+                regressions.append("{0}: {1} {2:.2f}{4} -> {3:.2f}{4}{5}".format(
+                    case["case"], what, then, now, unit, change))
+    return regressions
+
+
+def run_benchmark(args):
+    """
+    The "benchmark" command: generates a sweep of workouts from synthetic music with a
+    stub voice (no network or GUI needed), one fresh process per workout, and reports
+    how long each stage took and the peak memory. Results (with each workout's full
+    performance report) can be saved as JSON and checked against a saved baseline,
+    failing if anything regressed.
+    """
+    methods = args.methods or list(WORKOUT_METHODS)
+    cycle_modes = {"both": [False, True], "pull": [False], "cycle": [True]}[args.cycle]
+    cases = benchmark_cases(methods, args.rounds, cycle_modes, args.source_seconds,
+                            args.work, args.recovery, args.lossless)
+
+    source_dir = tempfile.mkdtemp(prefix="interval-training-benchmark-")
+    results = {"machine": {"platform": platform.platform(), "python": platform.python_version(),
+                           "cpus": os.cpu_count(), "encode_workers": ENCODE_WORKERS},
+               "cases": []}
+    print(f"{'case':<30}{'total':>9}  stages (peak memory)")
+    try:
+        sources = {}
+        for seconds in args.source_seconds:
+            sources[seconds] = (
+                make_benchmark_track(os.path.join(source_dir, f"intense-{seconds}.mp3"), seconds, 330, 150),
+                make_benchmark_track(os.path.join(source_dir, f"moderate-{seconds}.mp3"), seconds, 220, 100))
+
+        spawn = multiprocessing.get_context("spawn")
+        for case in cases:
+            with ProcessPoolExecutor(max_workers=1, mp_context=spawn) as pool:
+                result = pool.submit(run_benchmark_case, case, *sources[case["source_seconds"]]).result()
+            results["cases"].append(result)
+            stages = "  ".join("{0} {seconds:.2f}s ({peak_rss_mb:.0f}MB)".format(stage, **numbers)
+                               for stage, numbers in result["stages"].items())
+            print(f"{result['case']:<30}{result['seconds']:>8.2f}s  {stages}", flush=True)
+    finally:
+        shutil.rmtree(source_dir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if not args.baseline:
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare_benchmarks(results, baseline, args.time_threshold, args.memory_threshold)
+    for line in regressions:
+        print("REGRESSION " + line)
+    print("{0} regressions against {1}".format(len(regressions), args.baseline))
+    return 1 if regressions else 0
+
+
+def run_generate(args):
+    """The "generate" command: one workout, no GUI"""
+    values = {key: getattr(args, key) for key in WorkoutSettings.FIELD_NAMES if getattr(args, key) is not None}
+    try:
+        settings = WorkoutSettings.from_dict(values)
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 2
+    for path in (settings.intense_path, settings.moderate_path):
+        if not os.path.exists(path):
+            print(f"Error: music file not found: {path}", file=sys.stderr)
+            return 2
+
+    def show_progress(stage, fraction):
+        print(f"\r{stage:<8} {int(fraction * 100):3d}%", end="", file=sys.stderr, flush=True)
+
+    profile = GenerationProfile()
+    job = GenerationJob(progress=show_progress, listeners=[profile])
+    report_path = performance_report_path(args.output) if args.report else None
+    try:
+        WorkoutGenerator().generate(settings, args.output, job, report_path)
+    except Exception as e:
+        print(f"\nAn error occurred while generating the MP3: {e}", file=sys.stderr)
+        return 1
+    profile.stop()
+    print(f"\nSaved {args.output} in {profile.seconds:.1f}s ({profile.summary()})", file=sys.stderr)
+    if report_path:
+        print(f"Performance report saved to {report_path}", file=sys.stderr)
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        description="Interval Training MP3 Generator. Run with no arguments for the GUI.")
+    commands = parser.add_subparsers(dest="command")
+
+    generate = commands.add_parser("generate", help="generate one workout MP3 without the GUI")
+    generate.add_argument("--intense", required=True, help="intense music MP3")
+    generate.add_argument("--moderate", required=True, help="moderate music MP3")
+    generate.add_argument("-o", "--output", required=True, help="where to save the workout MP3")
+    generate.add_argument("--method", choices=list(WORKOUT_METHODS), default="Tabata")
+    generate.add_argument("--rounds", type=int, help="number of rounds (default depends on the method)")
+    generate.add_argument("--work", type=int, help="work interval in seconds (Custom method)")
+    generate.add_argument("--recovery", type=int, help="recovery interval in seconds (Custom method)")
+    generate.add_argument("--warmup", type=int, help="warm-up time in seconds (default 180)")
+    generate.add_argument("--cooldown", type=int, help="cool-down time in seconds (default 180)")
+    generate.add_argument("--cycle", action="store_true", default=None,
+                          help="cycle through the music instead of repeating from the start")
+    generate.add_argument("--voice", choices=["auto"] + list(TTS_BACKENDS), help="text-to-speech engine")
+    generate.add_argument("--cues", action="store_true", default=None,
+                          help='announce every round with a countdown ("Round 3 of 8", 3-2-1, Go!)')
+    generate.add_argument("--levels", action="store_true", default=None,
+                          help="play every song at the same loudness")
+    generate.add_argument("--beats", action="store_true", default=None,
+                          help="start the music on beats, and intense intervals in the most energetic part")
+    generate.add_argument("--no-lossless", dest="lossless", action="store_false", default=None,
+                          help="always decode and re-encode instead of cutting the MP3s")
+    generate.add_argument("--report", action="store_true",
+                          help="save a JSON performance report next to the output (name.perf.json)")
+
+    benchmark = commands.add_parser("benchmark-stretch",
+                                    help="compare the voice time-stretch with pydub's speedup")
+    benchmark.add_argument("clips", nargs="*", help="audio files to test with (default: synthetic clips)")
+    benchmark.add_argument("--speed", type=float, default=VOICE_SPEED)
+    benchmark.add_argument("--repeats", type=int, default=5)
+
+    def number_list(text):
+        return [int(value) for value in text.split(",") if value]
+
+    sweep = commands.add_parser("benchmark", help="time a sweep of workouts made from synthetic music")
+    sweep.add_argument("--methods", nargs="+", choices=list(WORKOUT_METHODS),
+                       help="workout methods to run (default: all of them)")
+    sweep.add_argument("--rounds", type=number_list, default=[1, 10, 50, 100],
+                       help="comma-separated round counts (default: 1,10,50,100)")
+    sweep.add_argument("--cycle", choices=["both", "pull", "cycle"], default="both",
+                       help="music modes to run (default: both)")
+    sweep.add_argument("--source-seconds", type=number_list, default=[240],
+                       help="comma-separated lengths of the synthetic songs (default: 240)")
+    sweep.add_argument("--work", type=int, default=45, help="work interval for the Custom method")
+    sweep.add_argument("--recovery", type=int, default=15, help="recovery interval for the Custom method")
+    sweep.add_argument("--lossless", action="store_true",
+                       help="measure the lossless MP3-cutting mode instead of decoding and re-encoding")
+    sweep.add_argument("-o", "--output", help="save the results to this JSON file")
+    sweep.add_argument("--baseline", help="results JSON from an earlier run to check for regressions")
+    sweep.add_argument("--time-threshold", type=float, default=0.25,
+                       help="how much slower a stage can get before it's a regression (default 0.25 = 25%%)")
+    sweep.add_argument("--memory-threshold", type=float, default=0.25,
+                       help="how much more peak memory is a regression (default 0.25 = 25%%)")
+
+    serve = commands.add_parser("serve", help="run a local HTTP service that makes workouts on request")
+    serve.add_argument("music_dir", help="folder the music comes from (requests can't use anything outside it)")
+    serve.add_argument("--host", default="127.0.0.1", help="address to listen on (default: this computer only)")
+    serve.add_argument("--port", type=int, default=8750)
+    serve.add_argument("--workers", type=int, default=2, help="workouts generated at the same time")
+    serve.add_argument("--cache-mb", type=int, default=RESULT_CACHE_MAX_BYTES // 1024 ** 2,
+                       help="disk space for finished workouts")
+    serve.add_argument("--preload", action="store_true", help="decode all of the music before the first request")
+
+    batch = commands.add_parser("batch", help="generate every workout in a JSON manifest in parallel")
+    batch.add_argument("manifest", help="JSON manifest describing the workouts")
+    batch.add_argument("-j", "--processes", type=int, help="worker processes (default: one per core)")
+    batch.add_argument("--summary", help="also write the per-job summary to this JSON file")
+    batch.add_argument("--reports", action="store_true",
+                       help="save a JSON performance report next to every workout (name.perf.json)")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.command == "generate":
+        sys.exit(run_generate(args))
+    if args.command == "batch":
+        sys.exit(run_batch(args.manifest, args.processes, args.summary, args.reports))
+    if args.command == "serve":
+        sys.exit(run_service(args.music_dir, args.host, args.port, args.workers, args.cache_mb, args.preload))
+    if args.command == "benchmark":
+        sys.exit(run_benchmark(args))
+    if args.command == "benchmark-stretch":
+        benchmark_time_stretch(args.clips, args.speed, args.repeats)
+        return
+
+    if tk is None:
+        sys.exit("tkinter isn't installed, so only the command line is available (see --help).")
+    root = tk.Tk()
+    app = IntervalTrainingApp(root)
+    root.mainloop()
+
+
+if __name__ == "__main__":
     main()
\ No newline at end of file
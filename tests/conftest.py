@@ -0,0 +1,32 @@
+import importlib.util
+import os
+import subprocess
+import sys
+
+import pytest
+
+# The generator is a single script with a hyphenated name, so it's loaded by path
+# and registered as interval_training for the tests to import
+SCRIPT = os.path.join(os.path.dirname(__file__), os.pardir, "interval-training-mp3-generator.py")
+
+spec = importlib.util.spec_from_file_location("interval_training", SCRIPT)
+module = importlib.util.module_from_spec(spec)
+sys.modules[spec.name] = module
+spec.loader.exec_module(module)
+
+
+@pytest.fixture
+def make_song(tmp_path):
+    """
+    Makes a noisy chord MP3 in tmp_path (128 kbps unless other ffmpeg options are
+    given), which LAME can't encode without borrowing from the bit reservoir
+    """
+    def make(name, seconds, *options):
+        path = tmp_path / name
+        subprocess.run(["ffmpeg", "-hide_banner", "-loglevel", "error", "-f", "lavfi", "-i",
+                        f"sine=frequency=440:duration={seconds}", "-f", "lavfi", "-i",
+                        f"anoisesrc=duration={seconds}:amplitude=0.3", "-filter_complex", "amix=inputs=2",
+                        "-ac", "2", "-ar", "44100", "-c:a", "libmp3lame", *(options or ("-b:a", "128k")),
+                        str(path)], check=True)
+        return str(path)
+    return make
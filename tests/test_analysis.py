@@ -0,0 +1,80 @@
+import shutil
+
+import numpy as np
+import pytest
+from pydub import AudioSegment
+
+import interval_training as itg
+
+
+def clicks(seconds, start=1.0, every=0.5, frame_rate=44100):
+    """Short noise bursts every `every` seconds after `start` seconds of silence"""
+    samples = np.zeros(int(seconds * frame_rate), dtype=np.int16)
+    burst = (np.random.default_rng(0).standard_normal(441) * 8000).astype(np.int16)
+    for time in np.arange(start, seconds, every):
+        position = int(time * frame_rate)
+        samples[position:position + len(burst)] = burst[:len(samples) - position]
+    return AudioSegment(data=samples.tobytes(), sample_width=2, frame_rate=frame_rate, channels=1)
+
+
+def test_beats_and_first_sound():
+    analysis = itg.TrackAnalysis.from_audio(clicks(9))
+    assert analysis.tempo == pytest.approx(120, abs=1)
+    assert analysis.first_sound() == 1000
+    assert analysis.beats[0] == 1000
+    assert (np.abs(np.diff(analysis.beats) - 500) <= itg.TrackAnalysis.ONSET_HOP_MS).all()
+
+
+@pytest.mark.parametrize("seconds", [0.02, 0.3, 0.6])
+def test_very_short_songs(seconds):
+    analysis = itg.TrackAnalysis.from_audio(clicks(seconds, start=0.1, every=0.2))
+    assert analysis.tempo == 0 and len(analysis.beats) == 0
+    assert (analysis.onsets < seconds * 1000).all()
+
+
+def test_beats_stay_on_the_song():
+    # A quiet (but not silent) intro with no peaks, so the first beat would be nudged before the start
+    flux = np.zeros(1000)
+    flux[100::50] = 1
+    tempo, beats = itg.TrackAnalysis.find_beats(flux, np.full(200, -40.0))
+    assert tempo == 120
+    assert beats.min() >= 0 and beats.max() < len(flux)
+    assert (np.diff(beats) > 0).all()
+
+    flux[-1] = 5
+    _, beats = itg.TrackAnalysis.find_beats(flux, np.full(200, -40.0))
+    assert beats.max() < len(flux)
+
+
+def render(timeline, sources):
+    _, sources, clips = timeline.prepare(sources, {})
+    return b"".join(bytes(chunk) for chunk in timeline.iter_pcm(sources, clips))
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="needs ffmpeg")
+@pytest.mark.parametrize("cycle_mode", [False, True])
+def test_beat_aligned_intervals_sound_like_the_song(tmp_path, cycle_mode):
+    path = itg.make_benchmark_track(str(tmp_path / "song.mp3"), 30, 330, 150)
+    full = AudioSegment.from_file(path)
+    analysis = itg.TrackAnalysis.from_audio(full)
+    cache = itg.DecodedAudioCache(str(tmp_path / "decoded"))
+
+    rendered = []
+    for lazily in (True, False):
+        open_track = cache.open if lazily else lambda path: full
+        pool = itg.TrackPool("intense", path, open_track, lambda path: analysis, align=True)
+        cursor = itg.TrackCursor(pool, energetic=True)
+        timeline = itg.WorkoutTimeline()
+        for _ in range(4):
+            cursor.add_interval(timeline, 4321, cycle_mode)
+        rendered.append(render(timeline, pool.opened))
+        song = pool.opened["intense"]
+        assert isinstance(song, itg.LazySource) == lazily
+        if lazily:
+            assert song.sequential == cycle_mode
+            song.close()
+
+    # The intervals start on a beat in the middle of the song, and decoding only the
+    # parts of it they use sounds exactly the same as decoding all of it
+    assert rendered[0] == rendered[1]
+    assert timeline.spans[0].offset > 0 and timeline.spans[0].offset in analysis.beats
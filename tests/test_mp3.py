@@ -0,0 +1,168 @@
+import shutil
+
+import pytest
+
+import interval_training as itg
+
+
+def make_frame(bitrate_index=9, padding=0, mono=False, crc=False, main_data_begin=0, fill=0):
+    """A 44.1kHz MPEG-1 Layer III frame whose main data is all `fill` bytes"""
+    header = bytes([0xFF, 0xFA if crc else 0xFB, (bitrate_index << 4) | (padding << 1), 0xC0 if mono else 0x00])
+    side_info = bytearray(17 if mono else 32)
+    side_info[0] = main_data_begin >> 1
+    side_info[1] = (main_data_begin & 1) << 7
+    bitrate = itg.MP3_BITRATES[1][bitrate_index] * 1000
+    length = 144 * bitrate // 44100 + padding
+    frame = header + (bytes(2) if crc else b"") + bytes(side_info)
+    return frame + bytes([fill]) * (length - len(frame))
+
+
+def write_frames(path, frames, padding=0):
+    with itg.MP3Writer(str(path), 44100, 2) as output:
+        output.padding = padding
+        output.write(b"".join(frames), [len(frame) for frame in frames])
+    return str(path)
+
+
+def test_frame_header():
+    frame = itg.parse_mp3_frame_header(make_frame(), 0)
+    assert (frame.length, frame.bitrate, frame.sample_rate, frame.channels) == (417, 128000, 44100, 2)
+    assert frame.side_info_length == 32
+    assert itg.parse_mp3_frame_header(make_frame(padding=1), 0).length == 418
+    assert itg.parse_mp3_frame_header(make_frame(mono=True), 0).side_info_length == 17
+    assert itg.parse_mp3_frame_header(make_frame(crc=True), 0).side_info_length == 34
+    assert itg.parse_mp3_frame_header(b"\xFF\xFB\xF0\x00" + make_frame()[4:], 0) is None  # Bitrate index 15
+    assert itg.parse_mp3_frame_header(b"\x00" + make_frame(), 0) is None
+
+
+def test_frames_skip_id3_junk_and_info_frame(tmp_path):
+    path = write_frames(tmp_path / "song.mp3", [make_frame(fill=n) for n in range(3)])
+    with open(path, "rb") as f:
+        data = f.read()
+    # A 20-byte ID3v2 tag (the size is a syncsafe integer) and some junk before the frames
+    data = b"ID3\x03\x00\x00\x00\x00\x00\x14" + bytes(20) + b"junk" + data
+
+    frames = list(itg.iter_mp3_frames(data))
+    assert [data[frame.offset + 40] for frame in frames] == [0, 1, 2]
+    assert len(list(itg.iter_mp3_frames(data, include_info=True))) == 4
+    # A truncated last frame isn't counted
+    assert len(list(itg.iter_mp3_frames(data[:-1]))) == 2
+
+
+def test_writer_tag_round_trip(tmp_path):
+    frames = [make_frame(padding=n % 2) for n in range(10)]
+    path = write_frames(tmp_path / "cbr.mp3", frames, padding=300)
+    with open(path, "rb") as f:
+        data = f.read()
+
+    info = next(itg.iter_mp3_frames(data, include_info=True))
+    tag = info.offset + 4 + info.side_info_length
+    assert data[tag:tag + 4] == b"Info"  # Only the padding byte differs, so it's CBR
+    assert int.from_bytes(data[tag + 8:tag + 12], "big") == 10
+    assert int.from_bytes(data[tag + 12:tag + 16], "big") == len(data)
+    assert int.from_bytes(data[190:192], "big") == itg.crc16(data[:190])
+    assert itg.read_encoder_delays(data) == (0, 300)
+
+    index = itg.MP3FrameIndex(path)
+    assert len(index.frames) == 10
+    assert index.decoded_frames() == 10 * itg.MP3_FRAME_SAMPLES - 300
+
+
+def test_writer_marks_mixed_bitrates_as_vbr(tmp_path):
+    path = write_frames(tmp_path / "vbr.mp3", [make_frame(), make_frame(padding=1), make_frame(bitrate_index=14)])
+    with open(path, "rb") as f:
+        data = f.read()
+    info = next(itg.iter_mp3_frames(data, include_info=True))
+    assert data[info.offset + 36:info.offset + 40] == b"Xing"
+
+
+def test_files_without_a_lame_tag_have_no_delays():
+    data = b"".join(make_frame() for _ in range(3))
+    assert itg.read_encoder_delays(data) == (0, 0)
+
+
+def test_main_data_begin_and_reservoir(tmp_path):
+    # Frame 2 borrows 500 bytes: all 381 of frame 1's main data and the last 119 of frame 0's
+    frames = [make_frame(fill=0xA0), make_frame(fill=0xA1, main_data_begin=40),
+              make_frame(fill=0xA2, main_data_begin=500), make_frame(crc=True, main_data_begin=3)]
+    index = itg.MP3FrameIndex(write_frames(tmp_path / "song.mp3", frames))
+    assert [index.main_data_begin(n) for n in range(4)] == [0, 40, 500, 3]
+    assert index.reservoir(0) == b""
+    assert index.reservoir(1) == b"\xA0" * 40
+    assert index.reservoir(2) == b"\xA0" * 119 + b"\xA1" * 381
+    assert index.reservoir(3) == b"\xA2" * 3
+
+
+def test_carry_reservoir():
+    frame = make_frame(fill=0x55)
+    carried = itg.carry_reservoir(frame, b"xyz")
+    header = itg.parse_mp3_frame_header(carried, 0)
+    assert (header.bitrate, header.sample_rate, header.channels) == (320000, 44100, 2)
+    assert header.length == len(carried)
+    assert carried[4:len(frame)] == frame[4:]
+    assert carried.endswith(b"xyz")
+
+    with pytest.raises(itg.CouldntEncodeError):
+        itg.carry_reservoir(make_frame(crc=True), b"")
+    with pytest.raises(itg.CouldntEncodeError):
+        itg.carry_reservoir(make_frame(bitrate_index=14), b"x" * 100)
+
+
+def test_frame_data_joins_neighbours_and_loops(tmp_path):
+    frames = [make_frame(fill=n, padding=n % 2) for n in range(5)]
+    index = itg.MP3FrameIndex(write_frames(tmp_path / "song.mp3", frames))
+
+    blocks = list(index.iter_frame_data(3, 4))
+    assert [sizes for _, sizes in blocks] == [[418, 417], [417, 418]]
+    assert b"".join(data for data, _ in blocks) == frames[3] + frames[4] + frames[0] + frames[1]
+
+
+def test_cuts_snap_to_frames(tmp_path):
+    index = itg.MP3FrameIndex(write_frames(tmp_path / "song.mp3", [make_frame() for _ in range(20)]))
+    index.encoder_delay = 576
+    for number in range(1, 20):
+        assert index.frame_at(index.frame_start(number)) == number
+        assert index.frame_at(index.frame_start(number) + 500) == number
+    assert index.frame_start(0) == 0
+    assert index.frame_at(20 * itg.MP3_FRAME_SAMPLES) == 0  # Past the end loops back
+
+
+def test_frame_pieces_cover_the_frame_grid():
+    timeline = itg.WorkoutTimeline()
+    timeline.add_silence(1000)
+    timeline.add_music("intense", 300, 2500)
+    timeline.add_silence(777)
+    timeline.add_music("moderate", 0, 10)  # Shorter than a frame, so it disappears
+    timeline.add_music("intense", 0, 1000)
+
+    pieces = timeline.frame_pieces(44100, {})
+    total_samples = sum(length * 44100 // 1000 for length in (1000, 2500, 777, 10, 1000))
+    assert sum(frames for _, _, frames in pieces) == round(total_samples / itg.MP3_FRAME_SAMPLES)
+    assert [span.source for span, _, _ in pieces] == [None, "intense", None, "intense"]
+    assert pieces[1][1] == 300 * 44100 // 1000
+    assert pieces[1][2] == round(3500 * 44100 / 1000 / 1152) - round(44100 / 1152)
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="needs ffmpeg")
+def test_copy_re_encodes_only_a_borrowing_first_frame(tmp_path, make_song):
+    index = itg.MP3FrameIndex(make_song("song.mp3", 4))
+    timeline = itg.WorkoutTimeline()
+    timeline.add_music("intense", 2000, 1000)
+    first = index.frame_at(2000 * 44100 // 1000)
+    assert index.main_data_begin(first) > 0
+
+    output = str(tmp_path / "workout.mp3")
+    timeline.copy_mp3({"intense": index}, {}, output)
+    with open(output, "rb") as f:
+        data = f.read()
+    frames = list(itg.iter_mp3_frames(data))
+    assert len(frames) == round(44100 / 1152)
+
+    # The first frame is a re-encode carrying the next frame's borrowed bytes, the rest are copies
+    lead = data[frames[0].offset:frames[0].offset + frames[0].length]
+    assert frames[0].bitrate == 320000
+    assert lead.endswith(index.reservoir(first + 1))
+    for frame, number in zip(frames[1:], range(first + 1, len(index.frames))):
+        source = index.frames[number]
+        assert data[frame.offset:frame.offset + frame.length] == \
+            index.data[source.offset:source.offset + source.length]
@@ -0,0 +1,45 @@
+import pytest
+
+import interval_training as itg
+
+
+@pytest.fixture
+def service(tmp_path, monkeypatch):
+    monkeypatch.setattr(itg, "CACHE_DIR", str(tmp_path / "cache"))
+    music = tmp_path / "music"
+    (music / "folder").mkdir(parents=True)
+    for name in ("fast.mp3", "slow.mp3", "folder/one.mp3"):
+        (music / name).write_bytes(b"")
+    (tmp_path / "secret.mp3").write_bytes(b"")
+    (music / "escape.m3u").write_text("fast.mp3\n../secret.mp3\n")
+    (music / "missing.m3u").write_text("gone.mp3\n")
+    (music / "empty.m3u").write_text("# nothing\n")
+    return itg.WorkoutService(str(music), workers=1)
+
+
+def test_settings_from_a_query_string(service):
+    settings = service.settings_for({"intense": "fast.mp3", "moderate": "folder", "rounds": "12",
+                                     "warmup": "0", "cycle": "yes", "voice": "auto"})
+    assert settings.intense_path == service.music_path("fast.mp3")
+    assert (settings.rounds, settings.warmup, settings.cycle_mode) == (12, 0, True)
+
+
+@pytest.mark.parametrize("values", [
+    {"rounds": "0"}, {"rounds": 101}, {"rounds": "eight"}, {"rounds": 8.5},
+    {"work": "301"}, {"recovery": "0"}, {"warmup": "-1"}, {"cooldown": 601},
+    {"voice": "nope"}, {"method": "HIIT"},
+])
+def test_settings_outside_the_limits_are_bad_requests(service, values):
+    with pytest.raises(ValueError):
+        service.settings_for(dict({"intense": "fast.mp3", "moderate": "slow.mp3"}, **values))
+
+
+@pytest.mark.parametrize("moderate, error", [
+    ("../secret.mp3", PermissionError), ("escape.m3u", PermissionError),
+    ("missing.m3u", FileNotFoundError), ("empty.m3u", ValueError), ("nothing.mp3", FileNotFoundError),
+])
+def test_errors_never_show_server_paths(service, tmp_path, moderate, error):
+    with pytest.raises(error) as raised:
+        service.settings_for({"intense": "fast.mp3", "moderate": moderate})
+    assert str(tmp_path) not in str(raised.value)
+    assert moderate in str(raised.value)
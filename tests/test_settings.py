@@ -0,0 +1,37 @@
+import re
+
+import pytest
+
+import interval_training as itg
+
+
+def test_from_dict_reads_manifest_values(tmp_path):
+    settings = itg.WorkoutSettings.from_dict(
+        {"intense": "fast.mp3", "moderate": "music/slow.mp3", "method": "Custom", "rounds": 3,
+         "work": 40, "recovery": 20, "warmup": 0, "cycle": True, "voice": "auto"}, str(tmp_path))
+    assert settings.intense_path == str(tmp_path / "fast.mp3")
+    assert settings.moderate_path == str(tmp_path / "music" / "slow.mp3")
+    assert (settings.rounds, settings.work_seconds(), settings.recovery_seconds()) == (3, 40, 20)
+    assert (settings.warmup, settings.cooldown, settings.cycle_mode) == (0, 180, True)
+
+
+@pytest.mark.parametrize("values, message", [
+    ({"rounds": "8"}, "'rounds' must be a whole number from 1 to 100"),
+    ({"rounds": 0}, "'rounds'"),
+    ({"rounds": True}, "'rounds'"),
+    ({"warmup": -5}, "'warmup' must be a whole number from 0 to 600"),
+    ({"cooldown": 601}, "'cooldown'"),
+    ({"work": 2.5}, "'work' must be a whole number from 1 to 300"),
+    ({"recovery": 0}, "'recovery'"),
+    ({"cycle": "yes"}, "'cycle' must be true or false"),
+    ({"lossless": 1}, "'lossless'"),
+    ({"voice": "nope"}, "Unknown voice: 'nope'"),
+    ({"voice": ["gtts"]}, "Unknown voice"),
+    ({"method": "HIIT"}, "Unknown workout method: 'HIIT'"),
+    ({"moderate": 5}, "'moderate' must be a file name"),
+    ({"moderate": ""}, "Missing 'moderate' music file"),
+    ({"speed": 2}, "Unknown workout setting(s): speed"),
+])
+def test_from_dict_rejects_what_the_gui_would(values, message):
+    with pytest.raises(ValueError, match=re.escape(message)):
+        itg.WorkoutSettings.from_dict(dict({"intense": "a.mp3", "moderate": "b.mp3"}, **values))
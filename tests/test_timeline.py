@@ -0,0 +1,243 @@
+import os
+import shutil
+
+import numpy as np
+import pytest
+from pydub import AudioSegment
+
+import interval_training as itg
+
+needs_ffmpeg = pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="needs ffmpeg")
+
+
+@pytest.mark.parametrize("speed", [0.8, 1, 1.15, 2])
+def test_wsola_output_lengths(speed):
+    rng = np.random.default_rng(1)
+    signals = [rng.standard_normal((length, 2)).astype(np.float32) * 1000 for length in (24000, 1000, 7, 0)]
+    stretched = itg.wsola(signals, speed, 24000)
+    assert [len(signal) for signal in stretched] == [int(round(len(signal) / speed)) for signal in signals]
+    assert all(signal.shape[1] == 2 for signal in stretched)
+
+
+def test_wsola_keeps_the_pitch():
+    tone = np.sin(2 * np.pi * 300 * np.arange(24000) / 24000)[:, None].astype(np.float32)
+    stretched = itg.wsola([tone], 1.15, 24000)[0]
+    spectrum = np.abs(np.fft.rfft(stretched[:, 0]))
+    assert abs(spectrum.argmax() * 24000 / len(stretched) - 300) < 3
+    assert itg.wsola([], 1.15, 24000) == []
+
+
+def clip(value, frames, frame_rate=1000):
+    return AudioSegment(data=np.full(frames, value, dtype=np.int16).tobytes(),
+                        sample_width=2, frame_rate=frame_rate, channels=1)
+
+
+def mixed(mixer, music, start=0):
+    return np.frombuffer(mixer.mix(music.tobytes(), start), dtype=np.int16)
+
+
+def test_cue_mixer_ducks_the_music_under_a_cue():
+    # At 1kHz the attack is 60 frames and the release 250
+    mixer = itg.CueMixer([(500, "go")], {"go": clip(1000, 100)}, 1000, 1, 2)
+    music = np.full(2000, 10000, dtype=np.int16)
+    out = mixed(mixer, music)
+
+    duck = 10000 * 10 ** (itg.CUE_DUCK_DB / 20)
+    assert (out[:440] == 10000).all()
+    assert out[470] == pytest.approx((10000 + duck) / 2, abs=2)
+    assert (np.abs(out[560:600] - (duck + 1000)) <= 1).all()
+    assert out[600] == pytest.approx(duck, abs=2)
+    assert out[725] == pytest.approx((10000 + duck) / 2, abs=2)
+    assert (out[850:] == 10000).all()
+
+
+def test_cue_mixer_passes_untouched_chunks_through():
+    mixer = itg.CueMixer([(500, "go")], {"go": clip(1000, 100)}, 1000, 1, 2)
+    chunk = np.full(100, 10000, dtype=np.int16).tobytes()
+    assert mixer.mix(chunk, 0) is chunk
+    assert mixer.mix(chunk, 850) is chunk
+    assert mixer.mix(chunk, 400) is not chunk
+
+
+def test_cue_mixer_merges_overlapping_ducks_and_mixes_in_chunks():
+    mixer = itg.CueMixer([(700, "go"), (500, "go")], {"go": clip(1000, 100)}, 1000, 1, 2)
+    assert [list(region) for region in mixer.regions] == [[440, 1050]]
+
+    music = np.full(2000, 10000, dtype=np.int16)
+    whole = mixed(mixer, music)
+    chunks = [music[start:start + 128].tobytes() for start in range(0, 2000, 128)]
+    in_chunks = np.frombuffer(b"".join(mixer.iter_mixed(chunks)), dtype=np.int16)
+    assert np.array_equal(whole, in_chunks)
+    assert whole[650] < whole[400]  # Still ducked between the two cues
+
+
+def lazy_song(seconds=60, frame_rate=44100):
+    return itg.LazySource("song.mp3", seconds * frame_rate, frame_rate, 2)
+
+
+def test_lazy_source_decodes_short_parts_as_windows():
+    song = lazy_song()
+    second = 44100
+    margin = song.WINDOW_MARGIN
+    song.plan([(0, 5 * second), (5 * second + 1000, 6 * second), (30 * second, 35 * second)])
+    assert not song.sequential
+    assert [window[:2] for window in song.windows] == [[0, 6 * second + margin],
+                                                       [30 * second - margin, 35 * second + margin]]
+
+
+def test_lazy_source_decodes_front_to_back_when_most_of_it_plays():
+    song = lazy_song()
+    song.plan([(0, 40 * 44100), (40 * 44100, 60 * 44100)])
+    assert song.sequential and song.windows == []
+
+    # The same stretch played over and over is kept, not decoded again each time
+    song.plan([(0, 35 * 44100)] * 3)
+    assert not song.sequential
+
+
+def open_lazily(path):
+    index = itg.MP3FrameIndex(path)
+    return itg.LazySource(path, index.decoded_frames(), index.sample_rate, index.channels)
+
+
+def full_decode(path):
+    return np.frombuffer(AudioSegment.from_file(path).raw_data, dtype=np.int16)
+
+
+@needs_ffmpeg
+@pytest.mark.parametrize("bitrate", [["-b:a", "128k"], ["-q:a", "4"], ["-b:a", "32k"]])
+def test_lazy_source_matches_a_full_decode(make_song, bitrate):
+    path = make_song("song.mp3", 12, *bitrate)
+    full = full_decode(path)
+    second = 44100
+
+    # Windows that start mid-song (pull from start)
+    song = open_lazily(path)
+    ranges = [(3 * second + 1234, 4 * second), (8 * second + 777, 9 * second)]
+    song.plan(ranges)
+    assert not song.sequential
+    for start, end in ranges:
+        assert np.array_equal(np.frombuffer(song.read_frames(start, end - start), dtype=np.int16),
+                              full[start * 2:end * 2])
+    song.close()
+
+    # Front to back from the middle of the song, skipping ahead between spans (cycle through)
+    song = open_lazily(path)
+    ranges = [(start, start + second) for start in range(second // 2 + 1234, 11 * second, second + 3000)]
+    song.plan(ranges)
+    assert song.sequential
+    for start, end in ranges:
+        assert np.array_equal(np.frombuffer(song.read_frames(start, end - start), dtype=np.int16),
+                              full[start * 2:end * 2])
+    song.close()
+
+
+@needs_ffmpeg
+def test_closing_a_song_stops_the_decoders_of_its_copies(make_song):
+    song = open_lazily(make_song("song.mp3", 12))
+    assert song.with_format(44100, 2, 2) is song
+    copy = song.with_format(48000, 1, 2)
+    copy.sequential = True
+    assert len(copy.read_frames(48000, 4800)) == 4800 * 2
+    assert copy.process is not None
+    song.close()
+    assert copy.process is None
+
+
+@needs_ffmpeg
+def test_songs_are_decoded_whole_once_they_are_used_again(tmp_path, make_song):
+    path = make_song("song.mp3", 3)
+    directory = str(tmp_path / "decoded")
+    song = itg.DecodedAudioCache(directory).open(path)
+    assert isinstance(song, itg.LazySource)
+    song.close()
+
+    # The next run decodes all of it into the cache, and the one after that just loads it
+    song = itg.DecodedAudioCache(directory).open(path)
+    assert isinstance(song, AudioSegment)
+    assert np.array_equal(np.frombuffer(song.raw_data, dtype=np.int16), full_decode(path))
+    assert sorted(name.rsplit(".")[-1] for name in os.listdir(directory)) == ["json", "pcm"]
+    cache = itg.DecodedAudioCache(directory)
+    assert bytes(cache.open(path).raw_data) == bytes(song.raw_data)
+    assert cache.open(path) is cache.open(path)
+
+
+class FakeTrack:
+    def __init__(self, length):
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+
+class FakeAnalysis:
+    """Beats every 500ms after a second of silence"""
+
+    def first_sound(self):
+        return 1000
+
+    def beat_at_or_after(self, position):
+        return max(1000, -(-position // 500) * 500)
+
+    def energetic_start(self, duration):
+        return 7000
+
+
+def make_pool(tmp_path, lengths, align=False):
+    folder = tmp_path / "intense"
+    folder.mkdir()
+    for name in lengths:
+        (folder / name).write_bytes(b"")
+    open_track = lambda path: FakeTrack(lengths[os.path.basename(path)])
+    analyze = (lambda path: FakeAnalysis()) if align else None
+    return itg.TrackPool("intense", str(folder) if len(lengths) > 1 else str(folder / next(iter(lengths))),
+                         open_track, analyze, align)
+
+
+def music_spans(timeline):
+    return [(span.source, span.offset, span.length) for span in timeline.spans]
+
+
+def test_cursor_restarts_a_single_song(tmp_path):
+    cursor = itg.TrackCursor(make_pool(tmp_path, {"a.mp3": 10000}))
+    timeline = itg.WorkoutTimeline()
+    for _ in range(3):
+        cursor.add_interval(timeline, 4000, cycle_mode=False)
+    assert music_spans(timeline) == [("intense", 0, 4000)] * 3
+
+
+def test_cursor_loops_a_single_song_in_cycle_mode(tmp_path):
+    cursor = itg.TrackCursor(make_pool(tmp_path, {"a.mp3": 10000}))
+    timeline = itg.WorkoutTimeline()
+    for _ in range(3):
+        cursor.add_interval(timeline, 4000, cycle_mode=True)
+    assert music_spans(timeline) == [("intense", 0, 4000), ("intense", 4000, 4000), ("intense", 8000, 4000)]
+    assert cursor.position == 2000
+
+
+def test_cursor_moves_through_a_folder(tmp_path):
+    pool = make_pool(tmp_path, {"a.mp3": 10000, "b.mp3": 5000})
+    cycle = itg.TrackCursor(pool)
+    timeline = itg.WorkoutTimeline()
+    for _ in range(4):
+        cycle.add_interval(timeline, 4000, cycle_mode=True)
+    assert music_spans(timeline) == [("intense 1", 0, 4000), ("intense 1", 4000, 4000),
+                                     ("intense 1", 8000, 2000), ("intense 2", 0, 2000),
+                                     ("intense 2", 2000, 3000), ("intense 1", 0, 1000)]
+
+    restart = itg.TrackCursor(pool)
+    timeline = itg.WorkoutTimeline()
+    for _ in range(3):
+        restart.add_interval(timeline, 4000, cycle_mode=False)
+    assert [source for source, _, _ in music_spans(timeline)] == ["intense 1", "intense 2", "intense 1"]
+
+
+def test_cursor_starts_on_beats_when_aligned(tmp_path):
+    pool = make_pool(tmp_path, {"a.mp3": 10000}, align=True)
+    timeline = itg.WorkoutTimeline()
+    itg.TrackCursor(pool).add_interval(timeline, 4000, cycle_mode=False)
+    itg.TrackCursor(pool, energetic=True).add_interval(timeline, 4000, cycle_mode=False)
+    cycle = itg.TrackCursor(pool)
+    for _ in range(2):
+        cycle.add_interval(timeline, 3700, cycle_mode=True)
+    assert [offset for _, offset, _ in music_spans(timeline)] == [1000, 7000, 1000, 5000]